@@ -1,200 +1,1828 @@
-from flask import Flask, render_template, request, jsonify
-from threading import Thread
+import threading
+from concurrent.futures import ThreadPoolExecutor
 import discord
+from discord import app_commands
 from discord.ext import commands, tasks
 from discord.ui import Button, View, Select, Modal, TextInput
 import os
 import asyncio
-from datetime import datetime, timedelta
+from datetime import datetime, timedelta, timezone
 import json
+import logging
+import logging.handlers
+import tracemalloc
+import types
+import itertools
+import queue
+import sys
+import signal
 import sqlite3
 import aiohttp
+from aiohttp import web
+import math
 import secrets
-from typing import Dict, List, Optional
+import heapq
+import time
+import random
+import re
+import functools
+import bisect
+import difflib
+from collections import OrderedDict, deque
+from urllib.parse import urlencode
+from typing import Callable, Dict, List, Optional, Tuple
 
-# Конфигурация Flask для Railway
-app = Flask(__name__)
-app.config['SECRET_KEY'] = os.environ.get('SECRET_KEY', 'dev-secret-key')
+# Порт HTTP-сервера для Railway
 port = int(os.environ.get("PORT", 8080))
 
-@app.route('/')
-def home():
-    return "🟢 Multi Bot System Online"
+# ========== ЛОГИРОВАНИЕ ==========
+LOG_LEVEL = os.environ.get("LOG_LEVEL", "INFO").upper()
+LOG_QUEUE_SIZE = int(os.environ.get("LOG_QUEUE_SIZE", 10000))
+# Частые события (автобан, выдача ролей) пишутся раз в N повторений
+LOG_SAMPLE_EVERY = max(int(os.environ.get("LOG_SAMPLE_EVERY", 10)), 1)
 
-@app.errorhandler(500)
-def internal_error(error):
-    return "❌ Internal Server Error", 500
+class JsonFormatter(logging.Formatter):
+    """Одна запись - одна строка JSON с полями сервера, пользователя и обработчика"""
+    FIELDS = ('guild', 'user', 'handler', 'sampled')
+    
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {
+            'ts': datetime.fromtimestamp(record.created, timezone.utc).isoformat(timespec='milliseconds'),
+            'level': record.levelname,
+            'logger': record.name,
+            'message': record.getMessage(),
+        }
+        for field in self.FIELDS:
+            value = getattr(record, field, None)
+            if value is not None:
+                entry[field] = value
+        if record.exc_info:
+            entry['exc'] = self.formatException(record.exc_info)
+        return json.dumps(entry, ensure_ascii=False, default=str)
+
+class SamplingFilter(logging.Filter):
+    """Пропускает каждую N-ю запись с полем sample; предупреждения и ошибки не отбрасываются"""
+    def __init__(self, every: int):
+        super().__init__()
+        self.every = every
+        self.seen: Dict[str, int] = {}
+    
+    def filter(self, record: logging.LogRecord) -> bool:
+        key = getattr(record, 'sample', None)
+        if key is None or record.levelno >= logging.WARNING:
+            return True
+        seen = self.seen[key] = self.seen.get(key, 0) + 1
+        if (seen - 1) % self.every:
+            return False
+        record.sampled = self.every
+        return True
+
+class DroppingQueueHandler(logging.handlers.QueueHandler):
+    """Кладет запись в ограниченную очередь и отбрасывает ее при переполнении вместо ожидания"""
+    def __init__(self, log_queue: queue.Queue):
+        super().__init__(log_queue)
+        self.dropped = 0
+    
+    def enqueue(self, record: logging.LogRecord):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
 
-@app.errorhandler(404)
-def not_found(error):
-    return "🔍 Page Not Found", 404
+def setup_logging() -> Tuple[DroppingQueueHandler, logging.handlers.QueueListener]:
+    """Все логгеры пишут в очередь, а в stdout ее выгружает фоновый поток"""
+    handler = DroppingQueueHandler(queue.Queue(LOG_QUEUE_SIZE))
+    # JSON собирается до постановки в очередь, потоку записи остается только вывод
+    handler.setFormatter(JsonFormatter())
+    handler.addFilter(SamplingFilter(LOG_SAMPLE_EVERY))
+    
+    output = logging.StreamHandler(sys.stdout)
+    output.setFormatter(logging.Formatter('%(message)s'))
+    listener = logging.handlers.QueueListener(handler.queue, output)
+    
+    root = logging.getLogger()
+    root.handlers[:] = [handler]
+    root.setLevel(LOG_LEVEL)
+    listener.start()
+    return handler, listener
+
+def log_extra(handler: str, guild=None, user=None, **fields) -> dict:
+    """Поля для extra= : id сервера и пользователя вместо объектов discord"""
+    fields['handler'] = handler
+    fields['guild'] = getattr(guild, 'id', guild)
+    fields['user'] = getattr(user, 'id', user)
+    return fields
+
+log_handler, log_listener = setup_logging()
+log = logging.getLogger('multibot')
+
+# ========== МЕТРИКИ ==========
+class Histogram:
+    """Гистограмма длительностей с метками в формате Prometheus"""
+    BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+    
+    def __init__(self, name: str, description: str, label: Optional[str] = None):
+        self.name = name
+        self.description = description
+        self.label = label
+        # значение метки -> [счетчики по корзинам, сумма, количество]
+        self.series: Dict[str, list] = {}
+    
+    def observe(self, seconds: float, label_value: str = ''):
+        series = self.series.get(label_value)
+        if series is None:
+            series = self.series[label_value] = [[0] * len(self.BUCKETS), 0.0, 0]
+        index = bisect.bisect_left(self.BUCKETS, seconds)
+        if index < len(self.BUCKETS):
+            series[0][index] += 1
+        series[1] += seconds
+        series[2] += 1
+    
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.description}", f"# TYPE {self.name} histogram"]
+        for label_value, (buckets, total, count) in sorted(self.series.items()):
+            labels = f'{self.label}="{label_value}",' if self.label else ''
+            cumulative = 0
+            for bound, bucket_count in zip(self.BUCKETS, buckets):
+                cumulative += bucket_count
+                lines.append(f'{self.name}_bucket{{{labels}le="{bound}"}} {cumulative}')
+            lines.append(f'{self.name}_bucket{{{labels}le="+Inf"}} {count}')
+            suffix = f"{{{labels.rstrip(',')}}}" if labels else ''
+            lines.append(f"{self.name}_sum{suffix} {total}")
+            lines.append(f"{self.name}_count{suffix} {count}")
+        return lines
+
+class Metrics:
+    """Реестр метрик бота для эндпоинта /metrics"""
+    def __init__(self):
+        self.handlers = Histogram('bot_handler_duration_seconds', 'Время обработки команд, кнопок, форм и событий', 'handler')
+        self.queries = Histogram('bot_db_query_duration_seconds', 'Время запросов к SQLite, включая ожидание потока', 'query')
+        self.loop_lag = Histogram('bot_event_loop_lag_seconds', 'Задержка цикла событий по контрольному таймеру')
+        # имя -> (тип, описание, функция текущего значения)
+        self.values: Dict[str, Tuple[str, str, Callable[[], float]]] = {}
+    
+    def gauge(self, name: str, description: str, fn: Callable[[], float]):
+        """Текущий уровень: глубина очереди, число ожидающих"""
+        self.values[name] = ('gauge', description, fn)
+    
+    def counter(self, name: str, description: str, fn: Callable[[], float]):
+        """Значение, которое только растет (сбрасывается при перезапуске): для rate() в Prometheus"""
+        self.values[f"{name}_total"] = ('counter', description, fn)
+    
+    def render(self) -> str:
+        lines = []
+        for histogram in (self.handlers, self.queries, self.loop_lag):
+            lines.extend(histogram.render())
+        for name, (kind, description, fn) in self.values.items():
+            lines.append(f"# HELP {name} {description}")
+            lines.append(f"# TYPE {name} {kind}")
+            lines.append(f"{name} {fn()}")
+        return "\n".join(lines) + "\n"
+
+metrics = Metrics()
+
+def timed(func):
+    """Записать длительность обработчика в гистограмму handler"""
+    name = func.__qualname__.replace('.<locals>', '')
+    
+    @functools.wraps(func)
+    async def wrapper(*args, **kwargs):
+        started = time.perf_counter()
+        try:
+            return await func(*args, **kwargs)
+        finally:
+            metrics.handlers.observe(time.perf_counter() - started, name)
+    
+    return wrapper
 
-def run_flask():
-    app.run(host='0.0.0.0', port=port, debug=False)
+async def cancel_tasks(tasks):
+    """Отменить фоновые задачи и дождаться их завершения (при остановке, до закрытия базы)"""
+    tasks = [task for task in tasks if task is not None and not task.done()]
+    for task in tasks:
+        task.cancel()
+    await asyncio.gather(*tasks, return_exceptions=True)
 
-def keep_alive():
-    t = Thread(target=run_flask)
-    t.daemon = True
-    t.start()
+async def monitor_loop_lag(interval: float = 0.5):
+    """Контрольный таймер: насколько позже запланированного просыпается цикл событий"""
+    loop = asyncio.get_running_loop()
+    while True:
+        started = loop.time()
+        await asyncio.sleep(interval)
+        metrics.loop_lag.observe(max(loop.time() - started - interval, 0.0))
 
 # ========== БАЗА ДАННЫХ ==========
+DB_PATH = os.environ.get('DB_PATH', 'bot_data.db')
+DB_READERS = int(os.environ.get('DB_READERS', 4))
+
+# Миграции схемы: номер версии = позиция в списке, текущая версия хранится в PRAGMA user_version.
+# Уже выпущенные миграции не меняются - только добавляются новые в конец.
+MIGRATIONS = [
+    # 1: исходные таблицы
+    [
+        '''
+        CREATE TABLE IF NOT EXISTS role_links (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            server_id INTEGER,
+            role_id INTEGER,
+            link_code TEXT UNIQUE,
+            role_name TEXT,
+            uses_limit INTEGER DEFAULT 0,
+            uses_count INTEGER DEFAULT 0,
+            expires_at DATETIME,
+            created_by INTEGER,
+            created_by_name TEXT,
+            created_at DATETIME DEFAULT CURRENT_TIMESTAMP,
+            is_active BOOLEAN DEFAULT TRUE
+        )
+        ''',
+        '''
+        CREATE TABLE IF NOT EXISTS storage (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            server_id INTEGER,
+            resource_name TEXT,
+            resource_amount INTEGER DEFAULT 0,
+            resource_description TEXT,
+            last_updated DATETIME DEFAULT CURRENT_TIMESTAMP,
+            updated_by INTEGER,
+            updated_by_name TEXT
+        )
+        ''',
+    ],
+    # 2: индексы под горячие запросы и уникальность ресурса на сервере
+    [
+        '''
+        DELETE FROM storage WHERE id NOT IN (
+            SELECT MAX(id) FROM storage GROUP BY server_id, resource_name
+        )
+        ''',
+        'CREATE UNIQUE INDEX IF NOT EXISTS idx_storage_server_resource ON storage (server_id, resource_name)',
+        'CREATE INDEX IF NOT EXISTS idx_role_links_server_active ON role_links (server_id, is_active, created_at)',
+    ],
+    # 3: время деактивации ссылки для очистки старых записей
+    [
+        'ALTER TABLE role_links ADD COLUMN deactivated_at DATETIME',
+        'UPDATE role_links SET deactivated_at = CURRENT_TIMESTAMP WHERE is_active = FALSE',
+        'CREATE INDEX IF NOT EXISTS idx_role_links_deactivated ON role_links (is_active, deactivated_at)',
+    ],
+    # 4: задания массовой выдачи ролей с точкой продолжения
+    [
+        '''
+        CREATE TABLE IF NOT EXISTS bulk_role_jobs (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            server_id INTEGER,
+            role_id INTEGER,
+            filter TEXT,
+            channel_id INTEGER,
+            message_id INTEGER,
+            started_by_name TEXT,
+            last_member_id INTEGER DEFAULT 0,
+            processed INTEGER DEFAULT 0,
+            granted INTEGER DEFAULT 0,
+            failed INTEGER DEFAULT 0,
+            total INTEGER DEFAULT 0,
+            status TEXT DEFAULT 'running',
+            created_at DATETIME DEFAULT CURRENT_TIMESTAMP
+        )
+        ''',
+        'CREATE INDEX IF NOT EXISTS idx_bulk_role_jobs_status ON bulk_role_jobs (status)',
+    ],
+    # 5: сообщения, ожидающие удаления (переживают перезапуск)
+    [
+        '''
+        CREATE TABLE IF NOT EXISTS pending_deletions (
+            channel_id INTEGER,
+            message_id INTEGER PRIMARY KEY,
+            delete_at REAL
+        )
+        ''',
+    ],
+    # 6: очередь действий модерации (баны при выходе) с повтором после перезапуска
+    [
+        '''
+        CREATE TABLE IF NOT EXISTS moderation_actions (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            server_id INTEGER,
+            user_id INTEGER,
+            user_name TEXT,
+            action TEXT DEFAULT 'ban',
+            status TEXT DEFAULT 'pending',
+            attempts INTEGER DEFAULT 0,
+            last_error TEXT,
+            created_at DATETIME DEFAULT CURRENT_TIMESTAMP,
+            UNIQUE (server_id, user_id, action)
+        )
+        ''',
+        'CREATE INDEX IF NOT EXISTS idx_moderation_actions_status ON moderation_actions (status)',
+    ],
+    # 7: сервер удаляемого сообщения - процесс с частью шардов поднимает только свои
+    [
+        'ALTER TABLE pending_deletions ADD COLUMN server_id INTEGER',
+    ],
+]
+
+# Первая таблица запроса: FROM/INTO/UPDATE <таблица>
+QUERY_LABEL_RE = re.compile(r'\b(?:FROM|INTO|UPDATE)\s+(\w+)', re.IGNORECASE)
+
 class Database:
-    def __init__(self):
-        self.conn = sqlite3.connect('bot_data.db', check_same_thread=False)
-        self.create_tables()
-    
-    def create_tables(self):
-        cursor = self.conn.cursor()
-        
-        # Таблица для ссылок ролей
-        cursor.execute('''
-            CREATE TABLE IF NOT EXISTS role_links (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                server_id INTEGER,
-                role_id INTEGER,
-                link_code TEXT UNIQUE,
-                role_name TEXT,
-                uses_limit INTEGER DEFAULT 0,
-                uses_count INTEGER DEFAULT 0,
-                expires_at DATETIME,
-                created_by INTEGER,
-                created_by_name TEXT,
-                created_at DATETIME DEFAULT CURRENT_TIMESTAMP,
-                is_active BOOLEAN DEFAULT TRUE
-            )
-        ''')
+    """Асинхронный доступ к SQLite: один поток записи и пул читающих соединений (WAL)"""
+    def __init__(self, path: str = DB_PATH, readers: int = DB_READERS):
+        self.path = path
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        self.conn.execute('PRAGMA synchronous=NORMAL')
+        self.migrate()
         
-        # Таблица для склада
-        cursor.execute('''
-            CREATE TABLE IF NOT EXISTS storage (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                server_id INTEGER,
-                resource_name TEXT,
-                resource_amount INTEGER DEFAULT 0,
-                resource_description TEXT,
-                last_updated DATETIME DEFAULT CURRENT_TIMESTAMP,
-                updated_by INTEGER,
-                updated_by_name TEXT
-            )
-        ''')
-        
-        self.conn.commit()
+        # Все записи идут через один поток, чтения - через пул соединений только для чтения
+        self._local = threading.local()
+        self._writer = ThreadPoolExecutor(max_workers=1, thread_name_prefix='db-writer')
+        self._readers = ThreadPoolExecutor(max_workers=readers, thread_name_prefix='db-reader',
+                                           initializer=self._open_reader)
+    
+    def migrate(self):
+        """Применить недостающие миграции схемы по порядку"""
+        version = self.conn.execute('PRAGMA user_version').fetchone()[0]
+        for number, statements in enumerate(MIGRATIONS[version:], start=version + 1):
+            self.conn.execute('BEGIN')
+            with self.conn:
+                for sql in statements:
+                    self.conn.execute(sql)
+                self.conn.execute(f'PRAGMA user_version = {number}')
+            log.info('🗄️ Схема базы данных обновлена до версии %s', number)
+    
+    def _open_reader(self):
+        self._local.conn = sqlite3.connect(f'file:{self.path}?mode=ro', uri=True, check_same_thread=False)
+    
+    def _read(self, sql: str, params: tuple, one: bool):
+        cursor = self._local.conn.execute(sql, params)
+        return cursor.fetchone() if one else cursor.fetchall()
+    
+    def _write(self, fn):
+        # Контекстный менеджер соединения делает commit или rollback
+        with self.conn:
+            return fn(self.conn)
+    
+    @staticmethod
+    def query_label(sql: str) -> str:
+        """Метка запроса для метрик: команда и первая таблица"""
+        match = QUERY_LABEL_RE.search(sql)
+        verb = sql.split(None, 1)[0].upper()
+        return f"{verb} {match.group(1)}" if match else verb
+    
+    async def _run(self, executor, label: str, fn, *args):
+        loop = asyncio.get_running_loop()
+        started = time.perf_counter()
+        try:
+            return await loop.run_in_executor(executor, fn, *args)
+        finally:
+            metrics.queries.observe(time.perf_counter() - started, label)
+    
+    async def fetchone(self, sql: str, params: tuple = ()):
+        return await self._run(self._readers, self.query_label(sql), self._read, sql, params, True)
+    
+    async def fetchall(self, sql: str, params: tuple = ()) -> List:
+        return await self._run(self._readers, self.query_label(sql), self._read, sql, params, False)
+    
+    async def transaction(self, fn, label: Optional[str] = None):
+        """Выполнить fn(conn) в потоке записи одной транзакцией"""
+        return await self._run(self._writer, label or f"TRANSACTION {fn.__name__}", self._write, fn)
+    
+    async def execute(self, sql: str, params: tuple = ()) -> List:
+        """Выполнить запрос на запись и вернуть строки (для RETURNING)"""
+        return await self.transaction(lambda conn: conn.execute(sql, params).fetchall(), self.query_label(sql))
+    
+    async def executemany(self, sql: str, seq_of_params) -> None:
+        await self.transaction(lambda conn: conn.executemany(sql, seq_of_params), self.query_label(sql))
+    
+    def close(self):
+        self._writer.shutdown(wait=True)
+        self._readers.shutdown(wait=True)
+        self.conn.close()
 
 db = Database()
 
+# ========== КЭШ ПО СЕРВЕРАМ ==========
+class GuildCache:
+    """LRU-кэш результатов запросов по серверам: server_id -> {ключ: значение}"""
+    def __init__(self, max_guilds: int, max_keys: int):
+        self.max_guilds = max_guilds
+        # Ограничение записей одного сервера: листание большого склада не вытесняет остальные серверы
+        self.max_keys = max_keys
+        self.hits = 0
+        self.misses = 0
+        self._guilds: OrderedDict = OrderedDict()
+        # Поколение сервера растет при каждой инвалидации: чтение, начатое до записи, не попадет в кэш
+        self._generations: Dict[int, int] = {}
+    
+    def generation(self, server_id: int) -> int:
+        return self._generations.get(server_id, 0)
+    
+    def get(self, server_id: int, key):
+        entries = self._guilds.get(server_id)
+        if entries is not None and key in entries:
+            self._guilds.move_to_end(server_id)
+            entries.move_to_end(key)
+            self.hits += 1
+            return entries[key]
+        self.misses += 1
+        return None
+    
+    def put(self, server_id: int, key, value, generation: int):
+        if generation != self.generation(server_id):
+            return
+        entries = self._guilds.setdefault(server_id, OrderedDict())
+        entries[key] = value
+        entries.move_to_end(key)
+        while len(entries) > self.max_keys:
+            entries.popitem(last=False)
+        self._guilds.move_to_end(server_id)
+        while len(self._guilds) > self.max_guilds:
+            self._guilds.popitem(last=False)
+    
+    def __len__(self) -> int:
+        return sum(map(len, self._guilds.values()))
+    
+    def invalidate(self, server_id: int):
+        self._generations[server_id] = self.generation(server_id) + 1
+        self._guilds.pop(server_id, None)
+
 # ========== СИСТЕМА ССЫЛОК РОЛЕЙ ==========
+COUNTER_FLUSH_MS = int(os.environ.get('COUNTER_FLUSH_MS', 500))
+COUNTER_FLUSH_EVENTS = int(os.environ.get('COUNTER_FLUSH_EVENTS', 100))
+EXPIRY_SWEEP_SECONDS = int(os.environ.get('EXPIRY_SWEEP_SECONDS', 30))
+LINK_RETENTION_DAYS = int(os.environ.get('LINK_RETENTION_DAYS', 7))
+LINKS_PAGE_SIZE = 5
+
+class LinkEntry:
+    """Запись горячего индекса кодов: всё, что нужно для погашения без обращения к SQLite"""
+    __slots__ = ('id', 'server_id', 'role_id', 'role_name', 'uses_limit', 'uses_count', 'expires_at', 'active')
+    
+    def __init__(self, id: int, server_id: int, role_id: int, role_name: str, uses_limit: int, uses_count: int,
+                 expires_at: Optional[datetime]):
+        self.id = id
+        self.server_id = server_id
+        self.role_id = role_id
+        self.role_name = role_name
+        self.uses_limit = uses_limit
+        self.uses_count = uses_count
+        self.expires_at = expires_at
+        # False, когда ссылка исчерпана или истекла, но фоновая очистка ее еще не деактивировала
+        self.active = True
+    
+    def is_exhausted(self) -> bool:
+        return self.uses_limit > 0 and self.uses_count >= self.uses_limit
+    
+    def is_expired(self, now: datetime) -> bool:
+        return self.expires_at is not None and now > self.expires_at
+
+class UsageCounterBuffer:
+    """Write-behind буфер счетчиков: копит увеличения uses_count и пишет их одной транзакцией"""
+    def __init__(self, max_events: int = COUNTER_FLUSH_EVENTS):
+        self.max_events = max_events
+        self.pending: Dict[int, int] = {}
+        self.pending_events = 0
+        self.commits = 0
+        self._lock = asyncio.Lock()
+        self._flush_task: Optional[asyncio.Task] = None
+    
+    def add(self, link_id: int):
+        self.pending[link_id] = self.pending.get(link_id, 0) + 1
+        self.pending_events += 1
+        if self.pending_events >= self.max_events and (self._flush_task is None or self._flush_task.done()):
+            self._flush_task = asyncio.create_task(self.flush())
+    
+    async def flush(self):
+        async with self._lock:
+            if not self.pending:
+                return
+            batch, self.pending, self.pending_events = self.pending, {}, 0
+            try:
+                await db.executemany(
+                    'UPDATE role_links SET uses_count = uses_count + ? WHERE id = ?',
+                    [(count, link_id) for link_id, count in batch.items()]
+                )
+                self.commits += 1
+            except Exception:
+                # Возвращаем увеличения в буфер, чтобы не потерять их до следующей попытки
+                for link_id, count in batch.items():
+                    self.pending[link_id] = self.pending.get(link_id, 0) + count
+                    self.pending_events += count
+                raise
+    
+    @tasks.loop(seconds=COUNTER_FLUSH_MS / 1000)
+    async def flush_loop(self):
+        await self.flush()
+    
+    @flush_loop.error
+    async def flush_loop_error(self, error):
+        log.error("Ошибка при записи счетчиков ссылок", exc_info=error, extra=log_extra('counters.flush_loop'))
+        self.flush_loop.restart()
+
 class RoleLinkSystem:
     def __init__(self):
-        self.base_url = os.environ.get('RAILWAY_STATIC_URL', f'http://localhost:{port}')
+        base_url = os.environ.get('RAILWAY_STATIC_URL', f'http://localhost:{port}').rstrip('/')
+        # Railway отдает домен без схемы
+        self.base_url = base_url if base_url.startswith(('http://', 'https://')) else f'https://{base_url}'
+        # link_code -> LinkEntry для всех активных ссылок; счетчики в памяти - источник истины
+        self.index: Dict[str, LinkEntry] = {}
+        self.counters = UsageCounterBuffer()
+        # Минимальная куча (expires_at, link_code) и коды, переставшие действовать, - для фоновой очистки
+        self.expiry_heap: List[Tuple[datetime, str]] = []
+        self.finished: List[str] = []
+        # server_id -> число действующих ссылок: уменьшается сразу, а не при следующей очистке
+        # server_id -> id ссылок, которые уже не действуют, но в базе еще is_active (до очистки)
+        self.retired: Dict[int, set] = {}
+        self.active_counts: Dict[int, int] = {}
+    
+    async def load_index(self):
+        """Загрузить активные ссылки в память (вызывается один раз при старте)"""
+        rows = await db.fetchall(f'''
+            SELECT id, link_code, server_id, role_id, role_name, uses_limit, uses_count, expires_at
+            FROM role_links
+            WHERE is_active = TRUE {shard_filter()}
+        ''')
+        self.index = {
+            link_code: LinkEntry(
+                link_id, server_id, role_id, role_name, uses_limit, uses_count,
+                datetime.fromisoformat(expires_at) if expires_at else None
+            )
+            for link_id, link_code, server_id, role_id, role_name, uses_limit, uses_count, expires_at in rows
+        }
+        self.expiry_heap = [(entry.expires_at, code) for code, entry in self.index.items() if entry.expires_at]
+        heapq.heapify(self.expiry_heap)
+        self.finished = []
+        self.active_counts = {}
+        for entry in self.index.values():
+            self.active_counts[entry.server_id] = self.active_counts.get(entry.server_id, 0) + 1
+        for code, entry in self.index.items():
+            if entry.is_exhausted():
+                self._retire(code, entry)
     
-    def create_role_link(self, server_id: int, role_id: int, role_name: str, created_by: int, created_by_name: str,
-                        uses_limit: int = 0, expires_hours: int = 0) -> str:
+    async def create_role_link(self, server_id: int, role_id: int, role_name: str, created_by: int, created_by_name: str,
+                               uses_limit: int = 0, expires_hours: int = 0) -> str:
         link_code = secrets.token_urlsafe(8)
         
         expires_at = None
         if expires_hours > 0:
             expires_at = datetime.now() + timedelta(hours=expires_hours)
         
-        cursor = db.conn.cursor()
-        cursor.execute('''
+        rows = await db.execute('''
             INSERT INTO role_links 
             (server_id, role_id, role_name, link_code, uses_limit, expires_at, created_by, created_by_name)
             VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+            RETURNING id
         ''', (server_id, role_id, role_name, link_code, uses_limit, expires_at, created_by, created_by_name))
-        db.conn.commit()
         
+        self.index[link_code] = LinkEntry(rows[0][0], server_id, role_id, role_name, uses_limit, 0, expires_at)
+        self.active_counts[server_id] = self.active_counts.get(server_id, 0) + 1
+        if expires_at:
+            heapq.heappush(self.expiry_heap, (expires_at, link_code))
         return link_code
     
-    def use_role_link(self, link_code: str, server_id: int) -> Dict:
-        cursor = db.conn.cursor()
-        cursor.execute('''
-            SELECT * FROM role_links 
-            WHERE link_code = ? AND server_id = ? AND is_active = TRUE
-        ''', (link_code, server_id))
-        link = cursor.fetchone()
-        
-        if not link:
+    async def use_role_link(self, link_code: str, server_id: int) -> Dict:
+        entry = self.index.get(link_code)
+        if entry is None or entry.server_id != server_id:
             return {"success": False, "error": "Ссылка не найдена"}
         
-        # Проверяем лимит использований
-        if link[5] > 0 and link[6] >= link[5]:
+        # Проверка и увеличение идут без await между ними, поэтому лимит соблюдается точно
+        if entry.is_exhausted():
             return {"success": False, "error": "Лимит использований исчерпан"}
         
-        # Проверяем срок действия
-        if link[7] and datetime.now() > datetime.fromisoformat(link[7]):
+        if entry.is_expired(datetime.now()):
+            self._retire(link_code, entry)
             return {"success": False, "error": "Срок действия ссылки истек"}
         
-        # Обновляем счетчик использований
-        cursor.execute('''
-            UPDATE role_links SET uses_count = uses_count + 1 
-            WHERE id = ?
-        ''', (link[0],))
-        db.conn.commit()
+        entry.uses_count += 1
+        self.counters.add(entry.id)
+        if entry.is_exhausted():
+            self._retire(link_code, entry)
         
         return {
             "success": True, 
-            "role_id": link[2],
-            "role_name": link[3],
-            "uses_count": link[6] + 1,
-            "uses_limit": link[5]
+            "role_id": entry.role_id,
+            "role_name": entry.role_name,
+            "uses_count": entry.uses_count,
+            "uses_limit": entry.uses_limit
         }
     
-    def get_active_links(self, server_id: int) -> List:
-        cursor = db.conn.cursor()
-        cursor.execute('''
-            SELECT link_code, role_name, uses_limit, uses_count, expires_at, created_by_name, created_at
-            FROM role_links 
-            WHERE server_id = ? AND is_active = TRUE
-            ORDER BY created_at DESC
-        ''', (server_id,))
-        return cursor.fetchall()
+    def link_url(self, link_code: str) -> str:
+        return f"{self.base_url}/role/{link_code}"
+    
+    def _retire(self, link_code: str, entry: LinkEntry):
+        """Ссылка перестала действовать: счетчик уменьшается сразу, индекс и база - при очистке"""
+        if entry.active:
+            entry.active = False
+            self.active_counts[entry.server_id] -= 1
+            self.retired.setdefault(entry.server_id, set()).add(entry.id)
+            self.finished.append(link_code)
+    
+    def _retire_expired(self, now: datetime):
+        # Из кучи достаем только истекшие записи - O(истекших), а не O(всех ссылок)
+        while self.expiry_heap and self.expiry_heap[0][0] <= now:
+            link_code = heapq.heappop(self.expiry_heap)[1]
+            entry = self.index.get(link_code)
+            if entry:
+                self._retire(link_code, entry)
+    
+    def count_active_links(self, server_id: int) -> int:
+        # Истекшие с прошлой очистки не считаем - страница их тоже не показывает
+        self._retire_expired(datetime.now())
+        return self.active_counts.get(server_id, 0)
+    
+    async def get_active_links(self, server_id: int, after: Optional[Tuple[str, int]] = None,
+                               before: Optional[Tuple[str, int]] = None, start: Optional[Tuple[str, int]] = None,
+                               limit: int = LINKS_PAGE_SIZE) -> Tuple[List, bool, bool]:
+        """Страница активных ссылок по курсору (created_at, id), новые сверху: (строки, есть_раньше, есть_дальше).
+        after/before - строго после/до курсора, start - страница начиная с курсора включительно (обновление)"""
+        self._retire_expired(datetime.now())
+        # Исчерпанные ссылки в базе активны до очистки: исключаем их в запросе, чтобы страница была полной
+        retired = tuple(self.retired.get(server_id, ()))
+        exclude = f"AND id NOT IN ({', '.join('?' * len(retired))})" if retired else ""
+        
+        if before is not None:
+            rows = await db.fetchall(f'''
+                SELECT link_code, role_name, uses_limit, uses_count, expires_at, created_by_name, created_at, id
+                FROM role_links
+                WHERE server_id = ? AND is_active = TRUE AND (expires_at IS NULL OR expires_at > ?)
+                  AND (created_at, id) > (?, ?) {exclude}
+                ORDER BY created_at, id
+                LIMIT ?
+            ''', (server_id, datetime.now(), *before, *retired, limit + 1))
+            has_prev, has_next = len(rows) > limit, True
+            rows = rows[:limit][::-1]
+        else:
+            cursor = after or start or ('9999-12-31', 0)
+            operator = '<=' if start is not None and after is None else '<'
+            rows = await db.fetchall(f'''
+                SELECT link_code, role_name, uses_limit, uses_count, expires_at, created_by_name, created_at, id
+                FROM role_links
+                WHERE server_id = ? AND is_active = TRUE AND (expires_at IS NULL OR expires_at > ?)
+                  AND (created_at, id) {operator} (?, ?) {exclude}
+                ORDER BY created_at DESC, id DESC
+                LIMIT ?
+            ''', (server_id, datetime.now(), *cursor, *retired, limit + 1))
+            has_prev, has_next = after is not None or start is not None, len(rows) > limit
+            rows = rows[:limit]
+        
+        # Счетчик в базе отстает на буфер записи - показываем значение из индекса
+        links = []
+        for link_code, role_name, uses_limit, uses_count, expires_at, created_by_name, created_at, link_id in rows:
+            entry = self.index.get(link_code)
+            if entry:
+                uses_count = entry.uses_count
+            links.append((link_code, role_name, uses_limit, uses_count, expires_at, created_by_name, created_at, link_id))
+        return links, has_prev, has_next
+    
+    async def sweep(self):
+        """Деактивировать истекшие и исчерпанные ссылки и удалить давно неактивные"""
+        self._retire_expired(datetime.now())
+        finished = self.finished
+        self.finished = []
+        entries = [(link_code, self.index[link_code]) for link_code in finished if link_code in self.index]
+        
+        if entries:
+            try:
+                await db.executemany('''
+                    UPDATE role_links SET is_active = FALSE, deactivated_at = CURRENT_TIMESTAMP
+                    WHERE id = ?
+                ''', [(entry.id,) for _, entry in entries])
+            except Exception:
+                # Запись не удалась - ссылки остаются в очереди на деактивацию до следующей очистки
+                self.finished = finished + self.finished
+                raise
+        
+        # Из индекса и списка исключений убираем только после записи в базу,
+        # иначе страница на мгновение увидела бы эти ссылки снова
+        for link_code, entry in entries:
+            self.index.pop(link_code, None)
+            retired = self.retired.get(entry.server_id)
+            if retired is not None:
+                retired.discard(entry.id)
+                if not retired:
+                    del self.retired[entry.server_id]
+        
+        await db.execute('''
+            DELETE FROM role_links
+            WHERE is_active = FALSE AND deactivated_at < datetime('now', ?)
+        ''', (f'-{LINK_RETENTION_DAYS} days',))
+    
+    @tasks.loop(seconds=EXPIRY_SWEEP_SECONDS)
+    async def sweep_loop(self):
+        await self.sweep()
+    
+    @sweep_loop.error
+    async def sweep_loop_error(self, error):
+        log.error("Ошибка при очистке ссылок", exc_info=error, extra=log_extra('role_links.sweep_loop'))
+        self.sweep_loop.restart()
 
 role_link_system = RoleLinkSystem()
 
 # ========== СИСТЕМА СКЛАДА ==========
+STORAGE_CACHE_GUILDS = int(os.environ.get('STORAGE_CACHE_GUILDS', 500))
+STORAGE_CACHE_KEYS_PER_GUILD = int(os.environ.get('STORAGE_CACHE_KEYS_PER_GUILD', 50))
+# Сколько строк таблицы помещается в поле embed (1024 символа) с запасом
+STORAGE_PAGE_SIZE = 10
+# Лимит вариантов в выпадающем списке Discord
+RESOURCE_SELECT_PAGE_SIZE = 25
+
+class StorageAggregate:
+    """Агрегаты склада сервера, которые обновляются при каждой записи, а не пересчитываются"""
+    def __init__(self, rows: List):
+        self.amounts: Dict[str, int] = dict(rows)
+        # Ресурсы, упорядоченные по (количество, название), - для топа и минимальных за O(k)
+        self.ordered: List[Tuple[int, str]] = sorted((amount, name) for name, amount in self.amounts.items())
+        self.total = sum(self.amounts.values())
+    
+    @property
+    def count(self) -> int:
+        return len(self.amounts)
+    
+    def set(self, resource_name: str, amount: int):
+        self.remove(resource_name)
+        self.amounts[resource_name] = amount
+        bisect.insort(self.ordered, (amount, resource_name))
+        self.total += amount
+    
+    def remove(self, resource_name: str):
+        amount = self.amounts.pop(resource_name, None)
+        if amount is None:
+            return
+        del self.ordered[bisect.bisect_left(self.ordered, (amount, resource_name))]
+        self.total -= amount
+    
+    def top(self, k: int) -> List[Tuple[str, int]]:
+        return [(name, amount) for amount, name in reversed(self.ordered[-k:])]
+    
+    def bottom(self, k: int) -> List[Tuple[str, int]]:
+        return [(name, amount) for amount, name in self.ordered[:k]]
+
 class StorageSystem:
-    def add_resource(self, server_id: int, resource_name: str, amount: int, description: str, user_id: int, user_name: str):
+    def __init__(self):
+        self.cache = GuildCache(STORAGE_CACHE_GUILDS, STORAGE_CACHE_KEYS_PER_GUILD)
+        self.aggregates: OrderedDict = OrderedDict()
+    
+    async def add_resource(self, server_id: int, resource_name: str, amount: int, description: str, user_id: int, user_name: str):
         """Добавить или обновить ресурс на складе"""
-        cursor = db.conn.cursor()
-        cursor.execute('''
+        await db.execute('''
             INSERT OR REPLACE INTO storage 
             (server_id, resource_name, resource_amount, resource_description, updated_by, updated_by_name)
             VALUES (?, ?, ?, ?, ?, ?)
         ''', (server_id, resource_name, amount, description, user_id, user_name))
-        db.conn.commit()
-    
-    def get_resources(self, server_id: int) -> List:
-        """Получить все ресурсы склада"""
-        cursor = db.conn.cursor()
-        cursor.execute('''
-            SELECT resource_name, resource_amount, resource_description, updated_by_name, last_updated
-            FROM storage 
-            WHERE server_id = ?
-            ORDER BY resource_name
+        self.cache.invalidate(server_id)
+        
+        aggregate = self.aggregates.get(server_id)
+        if aggregate:
+            aggregate.set(resource_name, amount)
+    
+    async def get_resources_page(self, server_id: int, after: Optional[str] = None, before: Optional[str] = None,
+                                 limit: int = STORAGE_PAGE_SIZE) -> Tuple[List, bool, bool]:
+        """Получить страницу ресурсов по ключу resource_name (без OFFSET): (строки, есть_раньше, есть_дальше)"""
+        key = ('page', after, before, limit)
+        page = self.cache.get(server_id, key)
+        if page is not None:
+            return page
+        
+        generation = self.cache.generation(server_id)
+        if before is not None:
+            rows = await db.fetchall('''
+                SELECT resource_name, resource_amount, resource_description, updated_by_name, last_updated
+                FROM storage
+                WHERE server_id = ? AND resource_name < ?
+                ORDER BY resource_name DESC
+                LIMIT ?
+            ''', (server_id, before, limit + 1))
+            has_prev, has_next = len(rows) > limit, True
+            rows = rows[:limit][::-1]
+        else:
+            rows = await db.fetchall('''
+                SELECT resource_name, resource_amount, resource_description, updated_by_name, last_updated
+                FROM storage
+                WHERE server_id = ? AND resource_name > ?
+                ORDER BY resource_name
+                LIMIT ?
+            ''', (server_id, after or '', limit + 1))
+            has_prev, has_next = after is not None, len(rows) > limit
+            rows = rows[:limit]
+        
+        page = (rows, has_prev, has_next)
+        self.cache.put(server_id, key, page, generation)
+        return page
+    
+    async def get_resource_amount(self, server_id: int, resource_name: str) -> Optional[int]:
+        row = await db.fetchone(
+            'SELECT resource_amount FROM storage WHERE server_id = ? AND resource_name = ?',
+            (server_id, resource_name)
+        )
+        return row[0] if row else None
+    
+    async def get_aggregate(self, server_id: int) -> StorageAggregate:
+        """Получить агрегаты склада (строятся одним запросом, дальше поддерживаются записями)"""
+        aggregate = self.aggregates.get(server_id)
+        if aggregate:
+            self.aggregates.move_to_end(server_id)
+            return aggregate
+        
+        generation = self.cache.generation(server_id)
+        rows = await db.fetchall('''
+            SELECT resource_name, resource_amount FROM storage WHERE server_id = ?
         ''', (server_id,))
-        return cursor.fetchall()
+        aggregate = StorageAggregate(rows)
+        
+        # Если за время чтения была запись, строим заново при следующем обращении
+        if generation == self.cache.generation(server_id):
+            self.aggregates[server_id] = aggregate
+            while len(self.aggregates) > STORAGE_CACHE_GUILDS:
+                self.aggregates.popitem(last=False)
+        return aggregate
     
-    def update_resource_amount(self, server_id: int, resource_name: str, new_amount: int, user_id: int, user_name: str):
+    async def update_resource_amount(self, server_id: int, resource_name: str, new_amount: int, user_id: int, user_name: str):
         """Обновить количество ресурса"""
-        cursor = db.conn.cursor()
-        cursor.execute('''
+        await db.execute('''
             UPDATE storage 
             SET resource_amount = ?, updated_by = ?, updated_by_name = ?, last_updated = CURRENT_TIMESTAMP
             WHERE server_id = ? AND resource_name = ?
         ''', (new_amount, user_id, user_name, server_id, resource_name))
-        db.conn.commit()
+        self.cache.invalidate(server_id)
+        
+        aggregate = self.aggregates.get(server_id)
+        if aggregate and resource_name in aggregate.amounts:
+            aggregate.set(resource_name, new_amount)
     
-    def delete_resource(self, server_id: int, resource_name: str):
+    async def delete_resource(self, server_id: int, resource_name: str):
         """Удалить ресурс со склада"""
-        cursor = db.conn.cursor()
-        cursor.execute('''
+        await db.execute('''
             DELETE FROM storage 
             WHERE server_id = ? AND resource_name = ?
         ''', (server_id, resource_name))
-        db.conn.commit()
+        self.cache.invalidate(server_id)
+        
+        aggregate = self.aggregates.get(server_id)
+        if aggregate:
+            aggregate.remove(resource_name)
 
 storage_system = StorageSystem()
 
+# ========== ИНДЕКС РОЛЕЙ ==========
+ROLE_PAGE_SIZE = 25
+ROLE_INDEX_GUILDS = int(os.environ.get('ROLE_INDEX_GUILDS', 1000))
+
+class RoleIndex:
+    """Индекс выдаваемых ролей по серверам: поиск по префиксу, подстроке и нечеткий поиск"""
+    def __init__(self, max_guilds: int = ROLE_INDEX_GUILDS):
+        self.max_guilds = max_guilds
+        # server_id -> отсортированный список (имя в нижнем регистре, role_id); давно не нужные серверы вытесняются
+        self._guilds: OrderedDict = OrderedDict()
+    
+    @staticmethod
+    def is_assignable(role: discord.Role) -> bool:
+        return not role.is_default() and not role.managed
+    
+    def _entries(self, guild: discord.Guild) -> List[Tuple[str, int]]:
+        # Сервер индексируется при первом обращении, дальше поддерживается событиями ролей
+        entries = self._guilds.get(guild.id)
+        if entries is None:
+            entries = sorted((role.name.lower(), role.id) for role in guild.roles if self.is_assignable(role))
+            self._guilds[guild.id] = entries
+            while len(self._guilds) > self.max_guilds:
+                self._guilds.popitem(last=False)
+        else:
+            self._guilds.move_to_end(guild.id)
+        return entries
+    
+    def __len__(self) -> int:
+        return sum(map(len, self._guilds.values()))
+    
+    def add(self, role: discord.Role):
+        entries = self._guilds.get(role.guild.id)
+        if entries is not None and self.is_assignable(role):
+            bisect.insort(entries, (role.name.lower(), role.id))
+    
+    def remove(self, role: discord.Role):
+        entries = self._guilds.get(role.guild.id)
+        if entries is None:
+            return
+        key = (role.name.lower(), role.id)
+        position = bisect.bisect_left(entries, key)
+        if position < len(entries) and entries[position] == key:
+            del entries[position]
+    
+    def update(self, before: discord.Role, after: discord.Role):
+        self.remove(before)
+        self.add(after)
+    
+    def forget_guild(self, guild_id: int):
+        self._guilds.pop(guild_id, None)
+    
+    def count(self, guild: discord.Guild) -> int:
+        return len(self._entries(guild))
+    
+    def page(self, guild: discord.Guild, page: int, size: int = ROLE_PAGE_SIZE) -> List[int]:
+        entries = self._entries(guild)
+        return [role_id for _, role_id in entries[page * size:(page + 1) * size]]
+    
+    def search(self, guild: discord.Guild, query: str, limit: int = ROLE_PAGE_SIZE) -> List[int]:
+        """Сначала совпадения по префиксу, затем по подстроке, затем нечеткие"""
+        entries = self._entries(guild)
+        query = query.strip().lower()
+        if not query:
+            return [role_id for _, role_id in entries[:limit]]
+        
+        result = []
+        position = bisect.bisect_left(entries, (query, 0))
+        while position < len(entries) and len(result) < limit and entries[position][0].startswith(query):
+            result.append(entries[position][1])
+            position += 1
+        
+        if len(result) < limit:
+            found = set(result)
+            for name, role_id in entries:
+                if role_id not in found and query in name:
+                    result.append(role_id)
+                    if len(result) >= limit:
+                        break
+        
+        if not result:
+            ids_by_name = {}
+            for name, role_id in entries:
+                ids_by_name.setdefault(name, role_id)
+            result = [ids_by_name[name] for name in difflib.get_close_matches(query, ids_by_name, n=limit, cutoff=0.5)]
+        
+        return result
+
+role_index = RoleIndex()
+
+# ========== ВЫДАЧА РОЛЕЙ ==========
+ROLE_EDITS_PER_SECOND = float(os.environ.get('ROLE_EDITS_PER_SECOND', 5))
+ROLE_EDITS_BURST = int(os.environ.get('ROLE_EDITS_BURST', 10))
+ROLE_EDIT_RETRIES = 3
+
+class TokenBucket:
+    """Ведро токенов: не больше rate операций в секунду со всплеском до capacity"""
+    def __init__(self, rate: float, capacity: int):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = float(capacity)
+        self.updated = time.monotonic()
+    
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+    
+    async def acquire(self):
+        while True:
+            self._refill()
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return
+            await asyncio.sleep((1 - self.tokens) / self.rate)
+    
+    def drain(self, seconds: float):
+        """Discord ответил 429 - не выдаем токены ближайшие seconds секунд"""
+        self._refill()
+        self.tokens = min(self.tokens, 0) - seconds * self.rate
+
+class PendingRoleEdit:
+    """Накопленные изменения ролей одного участника: role_id -> (роль, выдать?)"""
+    __slots__ = ('member', 'changes', 'futures')
+    
+    def __init__(self, member: discord.Member):
+        self.member = member
+        self.changes: Dict[int, Tuple[discord.Role, bool]] = {}
+        self.futures: List[asyncio.Future] = []
+
+class RoleAssignmentQueue:
+    """Очереди изменений ролей по серверам с ведром токенов, склейкой и повторами"""
+    def __init__(self, rate: float = ROLE_EDITS_PER_SECOND, burst: int = ROLE_EDITS_BURST):
+        self.rate = rate
+        self.burst = burst
+        # (server_id, member_id) -> изменения, еще не отправленные в Discord
+        self.pending: Dict[Tuple[int, int], PendingRoleEdit] = {}
+        self.queues: Dict[int, deque] = {}
+        self.buckets: Dict[int, TokenBucket] = {}
+        self.workers: Dict[int, asyncio.Task] = {}
+        self.coalesced = 0
+        self.applied = 0
+        self.failed = 0
+        self.retried = 0
+    
+    def depth(self, server_id: Optional[int] = None) -> int:
+        """Сколько участников ждут изменения ролей (на сервере или всего)"""
+        if server_id is None:
+            return len(self.pending)
+        return len(self.queues.get(server_id, ()))
+    
+    def submit(self, member: discord.Member, role: discord.Role, add: bool = True) -> asyncio.Future:
+        future = asyncio.get_running_loop().create_future()
+        future.add_done_callback(self._log_failure)
+        
+        key = (member.guild.id, member.id)
+        edit = self.pending.get(key)
+        if edit is None:
+            edit = self.pending[key] = PendingRoleEdit(member)
+            self.queues.setdefault(member.guild.id, deque()).append(key)
+        else:
+            # Участник уже в очереди - последнее действие с ролью заменяет предыдущее
+            self.coalesced += 1
+        edit.member = member
+        edit.changes[role.id] = (role, add)
+        edit.futures.append(future)
+        
+        worker = self.workers.get(member.guild.id)
+        if worker is None or worker.done():
+            self.workers[member.guild.id] = asyncio.create_task(self._run(member.guild.id))
+        return future
+    
+    @staticmethod
+    def _log_failure(future: asyncio.Future):
+        # Ошибку забираем всегда: выдача по ссылке не ждет результата
+        if not future.cancelled() and future.exception():
+            log.error("Ошибка при изменении ролей", exc_info=future.exception(), extra=log_extra('role_queue'))
+    
+    async def _run(self, server_id: int):
+        queue = self.queues[server_id]
+        bucket = self.buckets.setdefault(server_id, TokenBucket(self.rate, self.burst))
+        while queue:
+            edit = self.pending.pop(queue.popleft())
+            try:
+                await self._apply(edit, bucket)
+            except Exception as e:
+                self.failed += 1
+                for future in edit.futures:
+                    if not future.done():
+                        future.set_exception(e)
+            else:
+                for future in edit.futures:
+                    if not future.done():
+                        future.set_result(True)
+        self.queues.pop(server_id, None)
+        self.workers.pop(server_id, None)
+    
+    async def _apply(self, edit: PendingRoleEdit, bucket: TokenBucket):
+        member = edit.member
+        current = {role.id for role in member.roles}
+        for role, add in edit.changes.values():
+            # Склеенные выдача и снятие могли дать исходное состояние - тогда запрос не нужен
+            if (role.id in current) == add:
+                continue
+            for attempt in range(ROLE_EDIT_RETRIES + 1):
+                await bucket.acquire()
+                try:
+                    if add:
+                        await member.add_roles(role, reason="Выдача роли по команде")
+                    else:
+                        await member.remove_roles(role, reason="Снятие роли по команде")
+                    self.applied += 1
+                    break
+                except discord.HTTPException as e:
+                    retryable = e.status == 429 or e.status >= 500
+                    if not retryable or attempt == ROLE_EDIT_RETRIES:
+                        raise
+                    self.retried += 1
+                    delay = 2 ** attempt + random.random()
+                    if e.status == 429:
+                        bucket.drain(delay)
+                    await asyncio.sleep(delay)
+
+role_queue = RoleAssignmentQueue()
+
+async def claim_role_code(guild: discord.Guild, user: discord.abc.User, link_code: str,
+                          handler: str) -> Tuple[Optional[discord.Role], str]:
+    """Погасить код для любого входа (!роль, /роль, форма, HTTP): (роль, "") или (None, текст ошибки)"""
+    entry = role_link_system.index.get(link_code)
+    role = None
+    if entry is not None and entry.server_id == guild.id:
+        # Роль и права проверяем до погашения, чтобы ошибка не тратила использование
+        role = guild.get_role(entry.role_id)
+        if role is None:
+            return None, "❌ Роль не найдена на сервере"
+        if not guild.me.guild_permissions.manage_roles or role >= guild.me.top_role:
+            return None, "❌ У бота нет прав для выдачи ролей"
+    
+    result = await role_link_system.use_role_link(link_code, guild.id)
+    log.info("🎫 Код %s: %s", link_code, "принят" if result["success"] else result["error"],
+             extra=log_extra(handler, guild, user, sample='role_redeem'))
+    if not result["success"]:
+        return None, f"❌ {result['error']}"
+    return role, ""
+
+async def redeem_role_code(guild: discord.Guild, member: discord.Member, link_code: str, handler: str,
+                           wait: bool = False) -> str:
+    """Погашение кода с переключением роли; возвращает ответ пользователю"""
+    role, error = await claim_role_code(guild, member, link_code, handler)
+    if role is None:
+        return error
+    
+    remove = role in member.roles
+    future = role_queue.submit(member, role, add=not remove)
+    text = f"✅ Роль **{role.name}** {'убрана' if remove else 'выдана'}!"
+    # Взаимодействия не ждут очередь из-за срока ответа 3 с; !роль ждет и сообщает об ошибке
+    if wait:
+        try:
+            await future
+        except discord.Forbidden:
+            return "❌ У бота нет прав для выдачи ролей"
+        except discord.HTTPException:
+            return "❌ Не удалось изменить роль, попробуйте позже"
+    return text
+
+BULK_CHUNK_SIZE = int(os.environ.get('BULK_CHUNK_SIZE', 50))
+BULK_PROGRESS_SECONDS = 5
+
+# Фильтры участников для массовой выдачи: ключ -> (название, условие)
+BULK_FILTERS = {
+    'all': ("Всем участникам", lambda member: True),
+    'humans': ("Только людям", lambda member: not member.bot),
+    'no_roles': ("Участникам без ролей", lambda member: len(member.roles) <= 1),
+}
+
+def member_outranks(member: discord.Member, role: discord.Role) -> bool:
+    """Иерархия Discord: выдавать можно только роли ниже своей высшей (владельцу сервера - любые)"""
+    return member.id == member.guild.owner_id or role < member.top_role
+
+class BulkRoleJob:
+    """Состояние одного задания массовой выдачи"""
+    def __init__(self, job_id: int, guild: discord.Guild, role: discord.Role, filter_key: str, message,
+                 started_by_name: str, last_member_id: int = 0, processed: int = 0, granted: int = 0,
+                 failed: int = 0, total: int = 0):
+        self.id = job_id
+        self.guild = guild
+        self.role = role
+        self.filter_key = filter_key
+        self.message = message
+        self.started_by_name = started_by_name
+        self.last_member_id = last_member_id
+        self.processed = processed
+        self.granted = granted
+        self.failed = failed
+        self.total = total
+        self.status = 'running'
+
+class BulkRoleAssigner:
+    """Массовая выдача роли: участники идут пачками через очередь ролей, прогресс сохраняется в SQLite"""
+    def __init__(self):
+        # job_id -> (server_id, задача)
+        self.tasks: Dict[int, Tuple[int, asyncio.Task]] = {}
+        # Серверы, где задание уже запускается, но еще не попало в tasks (ответ, загрузка участников, INSERT)
+        self.starting: set = set()
+    
+    def is_running(self, server_id: int) -> bool:
+        return server_id in self.starting or any(
+            not task.done() and job_guild == server_id for (job_guild, task) in self.tasks.values()
+        )
+    
+    def reserve(self, server_id: int) -> bool:
+        """Занять сервер до первого await: второй запуск в это время получит отказ"""
+        if self.is_running(server_id):
+            return False
+        self.starting.add(server_id)
+        return True
+    
+    def release(self, server_id: int):
+        self.starting.discard(server_id)
+    
+    async def start(self, guild: discord.Guild, role: discord.Role, filter_key: str,
+                    channel: discord.abc.Messageable, started_by_name: str) -> int:
+        message = await channel.send(embed=discord.Embed(title="🎭 Массовая выдача ролей", description="⏳ Подготовка...", color=0x3498db))
+        
+        await member_chunker.ensure(guild)
+        check = BULK_FILTERS[filter_key][1]
+        total = sum(1 for member in guild.members if check(member))
+        rows = await db.execute('''
+            INSERT INTO bulk_role_jobs (server_id, role_id, filter, channel_id, message_id, started_by_name, total)
+            VALUES (?, ?, ?, ?, ?, ?, ?)
+            RETURNING id
+        ''', (guild.id, role.id, filter_key, message.channel.id, message.id, started_by_name, total))
+        
+        job = BulkRoleJob(rows[0][0], guild, role, filter_key, message, started_by_name, total=total)
+        self.tasks[job.id] = (guild.id, asyncio.create_task(self._run(job)))
+        return job.id
+    
+    async def stop(self):
+        # Задания остаются в статусе running и продолжатся с last_member_id после перезапуска
+        await cancel_tasks([task for _, task in self.tasks.values()])
+    
+    async def resume(self):
+        """Продолжить незавершенные задания после перезапуска"""
+        rows = await db.fetchall(f'''
+            SELECT id, server_id, role_id, filter, channel_id, message_id, started_by_name,
+                   last_member_id, processed, granted, failed, total
+            FROM bulk_role_jobs
+            WHERE status = 'running' {shard_filter()}
+        ''')
+        for (job_id, server_id, role_id, filter_key, channel_id, message_id, started_by_name,
+             last_member_id, processed, granted, failed, total) in rows:
+            if job_id in self.tasks:
+                continue
+            
+            guild = bot.get_guild(server_id)
+            role = guild.get_role(role_id) if guild else None
+            channel = guild.get_channel(channel_id) if guild else None
+            if not role or not channel or filter_key not in BULK_FILTERS:
+                await db.execute("UPDATE bulk_role_jobs SET status = 'cancelled' WHERE id = ?", (job_id,))
+                continue
+            
+            job = BulkRoleJob(job_id, guild, role, filter_key, channel.get_partial_message(message_id), started_by_name,
+                              last_member_id, processed, granted, failed, total)
+            self.tasks[job_id] = (server_id, asyncio.create_task(self._run(job)))
+            log.info("🎭 Массовая выдача #%s продолжена с участника %s", job_id, last_member_id,
+                     extra=log_extra('bulk_roles.resume', server_id))
+    
+    def _chunks(self, job: BulkRoleJob):
+        # Участники по возрастанию ID - ID последнего обработанного и есть точка продолжения
+        check = BULK_FILTERS[job.filter_key][1]
+        members = sorted((member for member in job.guild.members if member.id > job.last_member_id and check(member)),
+                         key=lambda member: member.id)
+        for start in range(0, len(members), BULK_CHUNK_SIZE):
+            yield members[start:start + BULK_CHUNK_SIZE]
+    
+    async def _run(self, job: BulkRoleJob):
+        started = time.monotonic()
+        processed_before = job.processed
+        reported = 0.0
+        try:
+            # После перезапуска участники сервера могли еще не загрузиться
+            await member_chunker.ensure(job.guild)
+            for chunk in self._chunks(job):
+                # В полете не больше одной пачки: очередь ролей сама соблюдает лимиты Discord
+                futures = [role_queue.submit(member, job.role) for member in chunk if job.role not in member.roles]
+                results = await asyncio.gather(*futures, return_exceptions=True)
+                
+                job.granted += sum(1 for result in results if result is True)
+                job.failed += sum(1 for result in results if isinstance(result, Exception))
+                job.processed += len(chunk)
+                job.last_member_id = chunk[-1].id
+                
+                await db.execute('''
+                    UPDATE bulk_role_jobs SET last_member_id = ?, processed = ?, granted = ?, failed = ?
+                    WHERE id = ?
+                ''', (job.last_member_id, job.processed, job.granted, job.failed, job.id))
+                
+                if any(isinstance(result, discord.Forbidden) for result in results):
+                    job.status = 'failed'
+                    break
+                
+                if time.monotonic() - reported >= BULK_PROGRESS_SECONDS:
+                    reported = time.monotonic()
+                    await self._report(job, (job.processed - processed_before) / max(reported - started, 1e-6))
+            else:
+                job.status = 'done'
+        except Exception:
+            log.exception("Ошибка в массовой выдаче #%s", job.id, extra=log_extra('bulk_roles', job.guild))
+            job.status = 'failed'
+        finally:
+            self.tasks.pop(job.id, None)
+        
+        await db.execute("UPDATE bulk_role_jobs SET status = ? WHERE id = ?", (job.status, job.id))
+        await self._report(job, (job.processed - processed_before) / max(time.monotonic() - started, 1e-6))
+    
+    async def _report(self, job: BulkRoleJob, rate: float):
+        percent = job.processed * 100 // job.total if job.total else 100
+        filled = percent // 10
+        status = {'running': "⏳ Выполняется", 'done': "✅ Завершено", 'failed': "❌ Остановлено"}[job.status]
+        
+        embed = discord.Embed(
+            title="🎭 Массовая выдача ролей",
+            description=f"Роль: {job.role.mention}\nФильтр: {BULK_FILTERS[job.filter_key][0]}",
+            color=0x00ff00 if job.status == 'done' else 0xff0000 if job.status == 'failed' else 0x3498db,
+            timestamp=datetime.now()
+        )
+        embed.add_field(name="Статус", value=status, inline=False)
+        embed.add_field(
+            name="Прогресс",
+            value=f"`{'█' * filled}{'░' * (10 - filled)}` {percent}%\n**{job.processed}** из **{job.total}**",
+            inline=False
+        )
+        embed.add_field(name="✅ Выдано", value=str(job.granted), inline=True)
+        embed.add_field(name="❌ Ошибок", value=str(job.failed), inline=True)
+        embed.add_field(name="⚡ Скорость", value=f"{rate:.1f} уч./с", inline=True)
+        if job.status == 'failed':
+            embed.add_field(name="Причина", value="Нет прав на выдачу роли или ошибка Discord", inline=False)
+        embed.set_footer(text=f"Запустил: {job.started_by_name}")
+        
+        try:
+            await job.message.edit(embed=embed)
+        except discord.HTTPException:
+            pass
+
+bulk_roles = BulkRoleAssigner()
+
+# ========== ЗАГРУЗКА УЧАСТНИКОВ ==========
+# По умолчанию участники не грузятся до on_ready: старт и память не растут с числом участников
+CHUNK_AT_STARTUP = os.environ.get("CHUNK_AT_STARTUP", "0") == "1"
+CHUNK_GUILDS_PER_SECOND = float(os.environ.get("CHUNK_GUILDS_PER_SECOND", 1))
+
+class MemberChunker:
+    """Список участников сервера грузится при первом обращении или фоном с ограниченной скоростью"""
+    def __init__(self, rate: float = CHUNK_GUILDS_PER_SECOND):
+        self.rate = rate
+        # server_id -> идущая загрузка, общая для всех ждущих
+        self.inflight: Dict[int, asyncio.Task] = {}
+        self.on_demand = 0
+        self.background = 0
+        self._task: Optional[asyncio.Task] = None
+    
+    def unchunked(self) -> int:
+        return sum(1 for guild in bot.guilds if not guild.chunked)
+    
+    def _chunk(self, guild: discord.Guild) -> asyncio.Task:
+        task = self.inflight.get(guild.id)
+        if task is None:
+            task = self.inflight[guild.id] = asyncio.create_task(guild.chunk(cache=True))
+            task.add_done_callback(lambda _: self.inflight.pop(guild.id, None))
+        return task
+    
+    async def ensure(self, guild: discord.Guild):
+        """Дождаться полного списка участников перед действием, которое от него зависит"""
+        if guild.chunked:
+            return
+        if guild.id not in self.inflight:
+            self.on_demand += 1
+        await asyncio.shield(self._chunk(guild))
+    
+    def start(self):
+        # Без кэша участников загружать их фоном незачем
+        if not MEMBER_CACHE_FLAGS.joined:
+            return
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._run())
+    
+    async def _run(self):
+        await bot.wait_until_ready()
+        bucket = TokenBucket(self.rate, 1)
+        # Сначала маленькие серверы: за то же время готово больше серверов
+        for guild in sorted(bot.guilds, key=lambda guild: guild.member_count or 0):
+            if guild.chunked or guild.id in self.inflight:
+                continue
+            await bucket.acquire()
+            try:
+                await asyncio.shield(self._chunk(guild))
+                self.background += 1
+            except Exception:
+                log.exception("Ошибка при загрузке участников", extra=log_extra('member_chunker', guild))
+
+member_chunker = MemberChunker()
+
+# ========== ОТЛОЖЕННОЕ УДАЛЕНИЕ СООБЩЕНИЙ ==========
+# Через сколько секунд повторить удаление после сбоя
+CLEANUP_RETRY_SECONDS = 60
+
+class MessageCleanupScheduler:
+    """Одна задача удаляет сообщения по сроку из кучи; сроки хранятся в SQLite на случай перезапуска"""
+    def __init__(self):
+        # Куча (время удаления, channel_id, message_id)
+        self.heap: List[Tuple[float, int, int]] = []
+        self._wakeup = asyncio.Event()
+        self._task: Optional[asyncio.Task] = None
+    
+    async def start(self):
+        rows = await db.fetchall(f'SELECT delete_at, channel_id, message_id FROM pending_deletions WHERE TRUE {shard_filter()}')
+        self.heap = list(rows)
+        heapq.heapify(self.heap)
+        self._task = asyncio.create_task(self._run())
+    
+    async def stop(self):
+        # Сроки остаются в pending_deletions - после перезапуска удаление продолжится
+        await cancel_tasks([self._task])
+    
+    async def schedule(self, message: discord.Message, delay: float):
+        delete_at = time.time() + delay
+        await db.execute(
+            'INSERT OR REPLACE INTO pending_deletions (channel_id, message_id, delete_at, server_id) VALUES (?, ?, ?, ?)',
+            (message.channel.id, message.id, delete_at, message.guild.id if message.guild else None)
+        )
+        heapq.heappush(self.heap, (delete_at, message.channel.id, message.id))
+        self._wakeup.set()
+    
+    async def _run(self):
+        # Задачу никто не ждет: ошибка без перехвата молча остановила бы удаление навсегда
+        while True:
+            try:
+                await self._tick()
+            except Exception:
+                log.exception("Ошибка в планировщике удаления сообщений", extra=log_extra('cleanup'))
+                await asyncio.sleep(CLEANUP_RETRY_SECONDS)
+    
+    async def _tick(self):
+        timeout = self.heap[0][0] - time.time() if self.heap else None
+        if timeout is None or timeout > 0:
+            self._wakeup.clear()
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+            return
+        
+        # Забираем все созревшие сообщения и группируем по каналам
+        by_channel: Dict[int, List[int]] = {}
+        now = time.time()
+        while self.heap and self.heap[0][0] <= now:
+            _, channel_id, message_id = heapq.heappop(self.heap)
+            by_channel.setdefault(channel_id, []).append(message_id)
+        
+        handled: List[int] = []
+        for channel_id, message_ids in by_channel.items():
+            try:
+                done = await self._delete(channel_id, message_ids)
+            except Exception:
+                log.exception("Ошибка при удалении сообщений в канале %s", channel_id, extra=log_extra('cleanup'))
+                done = []
+            handled.extend(done)
+            # Необработанные сообщения остаются в pending_deletions и повторяются позже
+            for message_id in set(message_ids).difference(done):
+                heapq.heappush(self.heap, (now + CLEANUP_RETRY_SECONDS, channel_id, message_id))
+        
+        if handled:
+            await db.executemany('DELETE FROM pending_deletions WHERE message_id = ?', [(message_id,) for message_id in handled])
+    
+    async def _delete(self, channel_id: int, message_ids: List[int]) -> List[int]:
+        """Удалить сообщения канала; возвращает id тех, что удалены или удалить нельзя в принципе"""
+        channel = bot.get_channel(channel_id) or bot.get_partial_messageable(channel_id)
+        
+        # Пачкой удаляем одним запросом, если есть право (до 100 сообщений не старше 14 дней)
+        can_bulk = (
+            len(message_ids) > 1
+            and isinstance(channel, discord.TextChannel)
+            and channel.permissions_for(channel.guild.me).manage_messages
+        )
+        if can_bulk:
+            try:
+                for start in range(0, len(message_ids), 100):
+                    await channel.delete_messages([discord.Object(message_id) for message_id in message_ids[start:start + 100]])
+                return message_ids
+            except discord.HTTPException:
+                # Например, сообщение старше 14 дней - удаляем по одному
+                pass
+        
+        handled = []
+        for message_id in message_ids:
+            try:
+                await channel.get_partial_message(message_id).delete()
+            except (discord.NotFound, discord.Forbidden):
+                pass
+            except discord.HTTPException as e:
+                # Сбой Discord: остаток канала повторим позже, а не отметим удаленным
+                log.warning("⚠️ Удаление сообщений в канале %s прервано: %s", channel_id, e, extra=log_extra('cleanup'))
+                break
+            handled.append(message_id)
+        return handled
+
+cleanup = MessageCleanupScheduler()
+
+# ========== ЖУРНАЛ МОДЕРАЦИИ ==========
+MOD_LOG_CHANNEL = "логи"
+MOD_LOG_WINDOW_SECONDS = float(os.environ.get("MOD_LOG_WINDOW_SECONDS", 5))
+MOD_LOG_BANS_PER_EMBED = 20
+MOD_LOG_EMBEDS_PER_MESSAGE = 10
+MOD_LOG_MESSAGE_CHARS = 6000
+
+class ModerationLogSink:
+    """Копит баны по серверам и пишет их в канал логов сводками раз в окно"""
+    def __init__(self, window: float = MOD_LOG_WINDOW_SECONDS):
+        self.window = window
+        # server_id -> id канала логов (None - канала нет), сбрасывается событиями каналов
+        self.channels: Dict[int, Optional[int]] = {}
+        # server_id -> [(пользователь, id, время)]
+        self.pending: Dict[int, List[Tuple[str, int, datetime]]] = {}
+        self.flushers: Dict[int, asyncio.Task] = {}
+        self.messages_sent = 0
+    
+    def channel_for(self, guild: discord.Guild) -> Optional[discord.TextChannel]:
+        if guild.id not in self.channels:
+            channel = discord.utils.get(guild.text_channels, name=MOD_LOG_CHANNEL)
+            self.channels[guild.id] = channel.id if channel else None
+        channel_id = self.channels[guild.id]
+        return guild.get_channel(channel_id) if channel_id else None
+    
+    def invalidate(self, guild_id: int):
+        self.channels.pop(guild_id, None)
+    
+    def record_ban(self, guild: discord.Guild, user_name: str, user_id: int):
+        if not self.channel_for(guild):
+            return
+        self.pending.setdefault(guild.id, []).append((user_name, user_id, datetime.now()))
+        flusher = self.flushers.get(guild.id)
+        if flusher is None or flusher.done():
+            self.flushers[guild.id] = asyncio.create_task(self._flush_later(guild))
+    
+    async def _flush_later(self, guild: discord.Guild):
+        await asyncio.sleep(self.window)
+        try:
+            await self.flush(guild)
+        except Exception:
+            log.exception("Ошибка при записи в журнал модерации", extra=log_extra('mod_log', guild))
+    
+    async def flush(self, guild: discord.Guild):
+        bans = self.pending.pop(guild.id, None)
+        channel = self.channel_for(guild)
+        if not bans or not channel:
+            return
+        
+        # В одном сообщении до 10 эмбедов и не больше 6000 символов суммарно
+        batch, size = [], 0
+        for i in range(0, len(bans), MOD_LOG_BANS_PER_EMBED):
+            embed = self._embed(bans[i:i + MOD_LOG_BANS_PER_EMBED])
+            if batch and (len(batch) == MOD_LOG_EMBEDS_PER_MESSAGE or size + len(embed) > MOD_LOG_MESSAGE_CHARS):
+                await self._send(channel, batch)
+                batch, size = [], 0
+            batch.append(embed)
+            size += len(embed)
+        await self._send(channel, batch)
+    
+    async def _send(self, channel: discord.TextChannel, embeds: List[discord.Embed]):
+        await channel.send(embeds=embeds)
+        self.messages_sent += 1
+    
+    async def flush_all(self):
+        for task in self.flushers.values():
+            task.cancel()
+        for server_id in list(self.pending):
+            guild = bot.get_guild(server_id)
+            if guild:
+                await self.flush(guild)
+    
+    @staticmethod
+    def _embed(bans: List[Tuple[str, int, datetime]]) -> discord.Embed:
+        if len(bans) == 1:
+            name, user_id, banned_at = bans[0]
+            embed = discord.Embed(
+                title="🔨 Автоматический бан",
+                description=f"Пользователь **{name}** забанен при выходе",
+                color=0xff0000,
+                timestamp=banned_at
+            )
+            embed.add_field(name="ID", value=user_id, inline=True)
+            embed.add_field(name="Причина", value="Автоматический бан при выходе", inline=True)
+            return embed
+        
+        embed = discord.Embed(
+            title=f"🔨 Автоматические баны: {len(bans)}",
+            description="\n".join(f"**{name}** (`{user_id}`) - {banned_at:%H:%M:%S}" for name, user_id, banned_at in bans),
+            color=0xff0000,
+            timestamp=bans[-1][2]
+        )
+        embed.add_field(name="Причина", value="Автоматический бан при выходе", inline=True)
+        return embed
+
+mod_log = ModerationLogSink()
+
+MOD_BAN_REASON = "Автоматический бан при выходе"
+MOD_WORKERS = int(os.environ.get("MOD_WORKERS", 4))
+MOD_BANS_PER_SECOND = float(os.environ.get("MOD_BANS_PER_SECOND", 2))
+MOD_BANS_BURST = int(os.environ.get("MOD_BANS_BURST", 5))
+MOD_ACTION_RETRIES = 3
+# Сколько перезапусков подряд повторять бан, завершившийся ошибкой
+MOD_ACTION_MAX_ATTEMPTS = 5
+# Через сколько секунд повторить бан на сервере, который сейчас недоступен
+MOD_DEFER_SECONDS = 60
+
+class ModerationAction:
+    __slots__ = ('id', 'server_id', 'user_id', 'user_name', 'attempts')
+    
+    def __init__(self, action_id: int, server_id: int, user_id: int, user_name: str, attempts: int = 0):
+        self.id = action_id
+        self.server_id = server_id
+        self.user_id = user_id
+        self.user_name = user_name
+        self.attempts = attempts
+
+class ModerationQueue:
+    """Баны при выходе: несколько обработчиков, ведро токенов на сервер, очередь в SQLite"""
+    def __init__(self, workers: int = MOD_WORKERS, rate: float = MOD_BANS_PER_SECOND, burst: int = MOD_BANS_BURST):
+        self.workers_count = workers
+        self.rate = rate
+        self.burst = burst
+        self.queue: asyncio.Queue = asyncio.Queue()
+        self.buckets: Dict[int, TokenBucket] = {}
+        self.workers: List[asyncio.Task] = []
+        # id -> действие, которое ждет в очереди или выполняется
+        self.pending: Dict[int, ModerationAction] = {}
+        # id действий, отложенных до появления сервера
+        self.deferred: set = set()
+        self.processed = 0
+        self.failed = 0
+    
+    async def start(self):
+        """Вернуть в очередь незавершенные и неудавшиеся баны прошлого запуска"""
+        # Только серверы шардов этого процесса: чужие баны выполнит процесс, который их держит
+        await db.execute(
+            f"UPDATE moderation_actions SET status = 'pending' WHERE status = 'failed' AND attempts < ? {shard_filter()}",
+            (MOD_ACTION_MAX_ATTEMPTS,)
+        )
+        rows = await db.fetchall(
+            f"SELECT id, server_id, user_id, user_name, attempts FROM moderation_actions WHERE status = 'pending' {shard_filter()} ORDER BY id"
+        )
+        self.failed = (await db.fetchone(f"SELECT COUNT(*) FROM moderation_actions WHERE status = 'failed' {shard_filter()}"))[0]
+        for row in rows:
+            self._enqueue(ModerationAction(*row))
+        self.workers = [asyncio.create_task(self._worker()) for _ in range(self.workers_count)]
+        if rows:
+            log.info("🔨 Возобновлено банов из очереди: %s", len(rows), extra=log_extra('moderation.start'))
+    
+    async def submit(self, server_id: int, user: discord.abc.User):
+        rows = await db.execute('''
+            INSERT INTO moderation_actions (server_id, user_id, user_name) VALUES (?, ?, ?)
+            ON CONFLICT (server_id, user_id, action) DO UPDATE SET status = 'pending', attempts = 0, last_error = NULL
+            RETURNING id
+        ''', (server_id, user.id, str(user)))
+        action_id = rows[0][0]
+        if action_id not in self.pending:
+            self._enqueue(ModerationAction(action_id, server_id, user.id, str(user)))
+    
+    async def stop(self):
+        # Прерванный бан остается в pending и будет повторен при следующем запуске
+        await cancel_tasks(self.workers)
+    
+    def _enqueue(self, action: ModerationAction):
+        self.pending[action.id] = action
+        self.queue.put_nowait(action)
+    
+    async def _worker(self):
+        # Воркеры стартуют в setup_hook, до того как шлюз прислал серверы
+        await bot.wait_until_ready()
+        while True:
+            action = await self.queue.get()
+            try:
+                await self._process(action)
+            except Exception:
+                log.exception("Ошибка в автобане", extra=log_extra('moderation', action.server_id, action.user_id))
+            finally:
+                if action.id not in self.deferred:
+                    self.pending.pop(action.id, None)
+                self.queue.task_done()
+    
+    def _defer(self, action: ModerationAction):
+        """Вернуть бан в очередь позже; действие остается в pending, чтобы submit не задвоил его"""
+        log.warning("⏳ Сервер недоступен, бан %s отложен на %s с", action.user_name, MOD_DEFER_SECONDS,
+                    extra=log_extra('moderation', action.server_id, action.user_id))
+        self.deferred.add(action.id)
+        asyncio.get_running_loop().call_later(MOD_DEFER_SECONDS, self._requeue, action)
+    
+    def _requeue(self, action: ModerationAction):
+        self.deferred.discard(action.id)
+        self.queue.put_nowait(action)
+    
+    async def _process(self, action: ModerationAction):
+        guild = bot.get_guild(action.server_id)
+        if guild is None:
+            # Воркер стартует после wait_until_ready: сервера нет в кэше - бота на нем больше нет
+            await self._fail(action, "Бот не состоит на сервере")
+            return
+        if guild.unavailable:
+            # Сбой Discord на сервере - это не ошибка бана, попытка не тратится
+            self._defer(action)
+            return
+        
+        bucket = self.buckets.setdefault(guild.id, TokenBucket(self.rate, self.burst))
+        for attempt in range(MOD_ACTION_RETRIES + 1):
+            await bucket.acquire()
+            try:
+                await guild.ban(discord.Object(action.user_id), reason=MOD_BAN_REASON)
+            except discord.Forbidden as e:
+                log.warning("❌ Нет прав для бана пользователя %s", action.user_name,
+                            extra=log_extra('moderation', guild, action.user_id))
+                await self._fail(action, str(e))
+                return
+            except discord.HTTPException as e:
+                retryable = e.status == 429 or e.status >= 500
+                if not retryable or attempt == MOD_ACTION_RETRIES:
+                    log.warning("❌ Ошибка при бане пользователя %s: %s", action.user_name, e,
+                                extra=log_extra('moderation', guild, action.user_id))
+                    await self._fail(action, str(e))
+                    return
+                delay = 2 ** attempt + random.random()
+                if e.status == 429:
+                    bucket.drain(delay)
+                await asyncio.sleep(delay)
+            else:
+                break
+        
+        await db.execute('DELETE FROM moderation_actions WHERE id = ?', (action.id,))
+        self.processed += 1
+        log.info("🔨 Пользователь %s забанен при выходе", action.user_name,
+                 extra=log_extra('moderation', guild, action.user_id, sample='auto_ban'))
+        # Сводка в канал логов уходит раз в окно, а не отдельным сообщением на каждый бан
+        mod_log.record_ban(guild, action.user_name, action.user_id)
+    
+    async def _fail(self, action: ModerationAction, error: str):
+        await db.execute(
+            "UPDATE moderation_actions SET status = 'failed', attempts = attempts + 1, last_error = ? WHERE id = ?",
+            (error, action.id)
+        )
+        self.failed += 1
+    
+    def stats(self) -> Dict[str, int]:
+        return {"processed": self.processed, "pending": len(self.pending), "failed": self.failed}
+
+moderation = ModerationQueue()
+
+class DiscordOAuth:
+    """OAuth2 (scope identify) для погашения кодов по ссылке в браузере"""
+    AUTHORIZE_URL = 'https://discord.com/oauth2/authorize'
+    TOKEN_URL = 'https://discord.com/api/oauth2/token'
+    USER_URL = 'https://discord.com/api/users/@me'
+    
+    def __init__(self):
+        self.client_id = os.environ.get('DISCORD_CLIENT_ID')
+        self.client_secret = os.environ.get('DISCORD_CLIENT_SECRET')
+        self.redirect_uri = f"{role_link_system.base_url}/oauth/callback"
+        self.session: Optional[aiohttp.ClientSession] = None
+    
+    @property
+    def enabled(self) -> bool:
+        return bool(self.client_id and self.client_secret)
+    
+    def authorize_url(self, state: str) -> str:
+        query = urlencode({
+            'client_id': self.client_id,
+            'redirect_uri': self.redirect_uri,
+            'response_type': 'code',
+            'scope': 'identify',
+            'state': state,
+            'prompt': 'none'
+        })
+        return f"{self.AUTHORIZE_URL}?{query}"
+    
+    async def fetch_user_id(self, code: str) -> int:
+        """Обменять код авторизации на токен и получить ID пользователя"""
+        if self.session is None:
+            self.session = aiohttp.ClientSession(timeout=aiohttp.ClientTimeout(total=10))
+        
+        async with self.session.post(self.TOKEN_URL, data={
+            'client_id': self.client_id,
+            'client_secret': self.client_secret,
+            'grant_type': 'authorization_code',
+            'code': code,
+            'redirect_uri': self.redirect_uri
+        }) as response:
+            response.raise_for_status()
+            token = (await response.json())['access_token']
+        
+        async with self.session.get(self.USER_URL, headers={'Authorization': f'Bearer {token}'}) as response:
+            response.raise_for_status()
+            return int((await response.json())['id'])
+    
+    async def close(self):
+        if self.session:
+            await self.session.close()
+
+oauth = DiscordOAuth()
+
+# ========== СКЛЕЙКА ПОВТОРНЫХ НАЖАТИЙ ==========
+INTERACTION_DEDUP_SECONDS = float(os.environ.get("INTERACTION_DEDUP_SECONDS", 5))
+
+class SingleFlight:
+    """Одинаковые нажатия (сервер, пользователь, действие, цель) выполняются один раз:
+    параллельные ждут первое выполнение, повторы в течение ttl получают его результат"""
+    def __init__(self, ttl: float = INTERACTION_DEDUP_SECONDS):
+        self.ttl = ttl
+        self.inflight: Dict[tuple, asyncio.Future] = {}
+        # ключ -> (срок, результат); ttl общий, поэтому порядок вставки совпадает с порядком сроков
+        self.results: OrderedDict = OrderedDict()
+        self.executed = 0
+        self.coalesced = 0
+        self.cached = 0
+    
+    @property
+    def saved(self) -> int:
+        return self.coalesced + self.cached
+    
+    async def run(self, interaction: discord.Interaction, action: str, target, fn) -> Tuple[object, bool]:
+        """Выполнить fn() или взять результат одинакового нажатия: (результат, повтор?)"""
+        key = (interaction.guild_id, interaction.user.id, action, target)
+        now = time.monotonic()
+        while self.results and next(iter(self.results.values()))[0] <= now:
+            self.results.popitem(last=False)
+        
+        if key in self.results:
+            self.cached += 1
+            return self.results[key][1], True
+        
+        future = self.inflight.get(key)
+        if future is not None:
+            self.coalesced += 1
+            return await asyncio.shield(future), True
+        
+        future = self.inflight[key] = asyncio.get_running_loop().create_future()
+        try:
+            result = await fn()
+        except asyncio.CancelledError:
+            future.cancel()
+            raise
+        except Exception as e:
+            future.set_exception(e)
+            # Ошибку получат ждущие дубликаты; без них помечаем ее полученной
+            future.exception()
+            raise
+        else:
+            future.set_result(result)
+            self.results[key] = (time.monotonic() + self.ttl, result)
+        finally:
+            self.inflight.pop(key, None)
+            self.executed += 1
+        return result, False
+
+interaction_dedup = SingleFlight()
+
 # ========== КОМПОНЕНТЫ ИНТЕРФЕЙСА ==========
 
 class CopyLinkModal(Modal):
@@ -210,6 +1838,7 @@ class CopyLinkModal(Modal):
         )
         self.add_item(self.link_field)
     
+    @timed
     async def on_submit(self, interaction: discord.Interaction):
         await interaction.response.send_message("Команда скопирована! Теперь вы можете вставить её в чат.", ephemeral=True)
 
@@ -237,6 +1866,7 @@ class CustomLinkModal(Modal):
         self.add_item(self.uses)
         self.add_item(self.hours)
     
+    @timed
     async def on_submit(self, interaction: discord.Interaction):
         try:
             uses = int(self.uses.value)
@@ -246,7 +1876,7 @@ class CustomLinkModal(Modal):
                 await interaction.response.send_message("❌ Числа должны быть положительными", ephemeral=True)
                 return
             
-            link_code = role_link_system.create_role_link(
+            link_code = await role_link_system.create_role_link(
                 server_id=interaction.guild.id,
                 role_id=self.role.id,
                 role_name=self.role.name,
@@ -272,145 +1902,258 @@ class CustomLinkModal(Modal):
             
             embed.add_field(name="Ограничения", value=" | ".join(limits), inline=True)
             embed.add_field(name="Команда", value=f"```!роль {link_code}```", inline=False)
+            if oauth.enabled:
+                embed.add_field(name="Ссылка", value=role_link_system.link_url(link_code), inline=False)
             embed.add_field(name="Инструкция", value="Отправьте команду в чат чтобы получить роль", inline=False)
             
-            view = LinkActionsView(link_code, self.role.name)
+            view = LinkActionsView(link_code)
             await interaction.response.send_message(embed=embed, view=view, ephemeral=True)
             
         except ValueError:
             await interaction.response.send_message("❌ Введите корректные числа", ephemeral=True)
 
-class LinkActionsView(View):
-    def __init__(self, link_code, role_name):
-        super().__init__(timeout=300)
+class RedeemCodeModal(Modal):
+    def __init__(self):
+        super().__init__(title="Получить роль")
+        
+        self.code = TextInput(
+            label="Код команды",
+            placeholder="Например: AB12CD34",
+            max_length=32,
+            required=True
+        )
+        
+        self.add_item(self.code)
+    
+    @timed
+    async def on_submit(self, interaction: discord.Interaction):
+        text = await redeem_role_code(interaction.guild, interaction.user, self.code.value.strip(), 'RedeemCodeModal')
+        await interaction.response.send_message(text, ephemeral=True)
+
+class StatelessView(View):
+    """Контейнер компонентов без состояния: состояние лежит в custom_id, обработчик находится по шаблону"""
+    def __init__(self):
+        super().__init__(timeout=None)
+        # Остановленный вид discord.py не сохраняет в хранилище видов и не заводит таймер,
+        # поэтому открытые панели не занимают память, а кнопки работают и после перезапуска
+        self.stop()
+
+class LinkActionButton(discord.ui.DynamicItem[Button], template=r'link\|(?P<action>copy|share|send)\|(?P<code>[\w-]+)'):
+    """Действия с созданной командой, в custom_id - код команды"""
+    BUTTONS = {
+        'copy': ("Копировать", discord.ButtonStyle.success, 0),
+        'share': ("Поделиться", discord.ButtonStyle.primary, 0),
+        'send': ("Отправить", discord.ButtonStyle.secondary, 1),
+    }
+    
+    def __init__(self, action: str, link_code: str):
+        label, style, row = self.BUTTONS[action]
+        super().__init__(Button(label=label, style=style, row=row, custom_id=f"link|{action}|{link_code}"))
+        self.action = action
         self.link_code = link_code
-        self.role_name = role_name
     
-    @discord.ui.button(label="Копировать", style=discord.ButtonStyle.success, row=0)
-    async def copy_command(self, interaction: discord.Interaction, button: Button):
-        modal = CopyLinkModal(f"!роль {self.link_code}")
-        await interaction.response.send_modal(modal)
+    @classmethod
+    async def from_custom_id(cls, interaction: discord.Interaction, item: Button, match: re.Match):
+        return cls(match['action'], match['code'])
     
-    @discord.ui.button(label="Поделиться", style=discord.ButtonStyle.primary, row=0)
-    async def share_link(self, interaction: discord.Interaction, button: Button):
-        embed = discord.Embed(
-            title=f"🔗 Получить роль: {self.role_name}",
-            description="Используйте команду ниже чтобы получить роль:",
-            color=0x5865F2
-        )
-        embed.add_field(name="Команда", value=f"```!роль {self.link_code}```", inline=False)
-        embed.set_footer(text="Сообщение автоматически удалится через 1 минуту")
+    @timed
+    async def callback(self, interaction: discord.Interaction):
+        if self.action == 'copy':
+            modal = CopyLinkModal(f"!роль {self.link_code}")
+            await interaction.response.send_modal(modal)
+            return
         
-        message = await interaction.channel.send(embed=embed)
-        await interaction.response.send_message("✅ Сообщение отправлено в чат!", ephemeral=True)
+        entry = role_link_system.index.get(self.link_code)
+        if entry is None:
+            await interaction.response.send_message("❌ Команда больше не действует", ephemeral=True)
+            return
         
-        await asyncio.sleep(60)
-        try:
-            await message.delete()
-        except:
-            pass
+        if self.action == 'share':
+            embed = discord.Embed(
+                title=f"🔗 Получить роль: {entry.role_name}",
+                description="Используйте команду ниже чтобы получить роль:",
+                color=0x5865F2
+            )
+            embed.add_field(name="Команда", value=f"```!роль {self.link_code}```", inline=False)
+            embed.set_footer(text="Сообщение автоматически удалится через 1 минуту")
+            content, lifetime, reply = None, 60, "✅ Сообщение отправлено в чат!"
+        else:
+            embed = None
+            content, lifetime, reply = f"**Получить роль '{entry.role_name}':**\n```!роль {self.link_code}```", 30, "✅ Команда отправлена в чат!"
+        
+        async def post():
+            message = await interaction.channel.send(content, embed=embed)
+            await cleanup.schedule(message, lifetime)
+        
+        # Повторные нажатия не отправляют в чат еще одно сообщение
+        _, repeated = await interaction_dedup.run(interaction, self.action, self.link_code, post)
+        await interaction.response.send_message("✅ Уже отправлено в чат" if repeated else reply, ephemeral=True)
+
+class LinkActionsView(StatelessView):
+    def __init__(self, link_code):
+        super().__init__()
+        for action in LinkActionButton.BUTTONS:
+            self.add_item(LinkActionButton(action, link_code))
+
+def build_links_embed(links: List, page: int, total: int) -> discord.Embed:
+    """Embed со страницей активных команд"""
+    embed = discord.Embed(
+        title=f"🔗 Активные команды (Страница {page + 1})",
+        description=f"Всего активных команд: {total}",
+        color=0x3498db
+    )
     
-    @discord.ui.button(label="Отправить", style=discord.ButtonStyle.secondary, row=1)
-    async def quick_send(self, interaction: discord.Interaction, button: Button):
-        message = await interaction.channel.send(f"**Получить роль '{self.role_name}':**\n```!роль {self.link_code}```")
-        await interaction.response.send_message("✅ Команда отправлена в чат!", ephemeral=True)
+    for link_code, role_name, uses_limit, uses_count, expires_at, created_by, created_at, _ in links:
+        status = "✅ Активна"
+        if uses_limit > 0:
+            status = f"🔄 {uses_count}/{uses_limit}"
         
-        await asyncio.sleep(30)
-        try:
-            await message.delete()
-        except:
-            pass
+        expires_text = "Бессрочно"
+        if expires_at:
+            expires_dt = datetime.fromisoformat(expires_at)
+            expires_text = expires_dt.strftime("%d.%m %H:%M")
+        
+        created_dt = datetime.fromisoformat(created_at)
+        created_text = created_dt.strftime("%d.%m %H:%M")
+        
+        embed.add_field(
+            name=f"🎯 {role_name}",
+            value=(
+                f"**Код:** `{link_code}`\n"
+                f"**Статус:** {status}\n"
+                f"**Создал:** **{created_by}**\n"
+                f"**Создано:** {created_text}\n"
+                f"**Истекает:** {expires_text}"
+            ),
+            inline=False
+        )
+    
+    if not links:
+        embed.description = "❌ На этой странице нет команд"
+    
+    return embed
 
-class ActiveLinksView(View):
-    def __init__(self, links, page=0):
-        super().__init__(timeout=180)
-        self.links = links
+async def show_links_page(interaction: discord.Interaction, page: int, after: Optional[Tuple[str, int]] = None,
+                          before: Optional[Tuple[str, int]] = None, start: Optional[Tuple[str, int]] = None):
+    links, has_prev, has_next = await role_link_system.get_active_links(interaction.guild.id, after, before, start)
+    total = role_link_system.count_active_links(interaction.guild.id)
+    
+    embed = build_links_embed(links, page, total)
+    view = ActiveLinksView(links, page, has_prev, has_next)
+    await interaction.response.edit_message(embed=embed, view=view)
+
+class LinksPageButton(discord.ui.DynamicItem[Button],
+                      template=r'links\|(?P<direction>prev|next|refresh)\|(?P<page>\d+)\|(?P<created>[^|]*)\|(?P<id>\d*)'):
+    """Листание активных команд, в custom_id - страница и курсор (created_at, id)"""
+    BUTTONS = {
+        'prev': ("⬅️", discord.ButtonStyle.secondary),
+        'next': ("➡️", discord.ButtonStyle.secondary),
+        'refresh': ("🔄", discord.ButtonStyle.primary),
+    }
+    
+    def __init__(self, direction: str, page: int, cursor: Optional[Tuple[str, int]] = None, disabled: bool = False):
+        created_at, link_id = cursor or ('', '')
+        label, style = self.BUTTONS[direction]
+        super().__init__(Button(label=label, style=style, disabled=disabled,
+                                custom_id=f"links|{direction}|{page}|{created_at}|{link_id}"))
+        self.direction = direction
         self.page = page
-        self.links_per_page = 5
-        
-    @discord.ui.button(label="⬅️", style=discord.ButtonStyle.secondary)
-    async def previous_page(self, interaction: discord.Interaction, button: Button):
-        if self.page > 0:
-            await self.show_page(interaction, self.page - 1)
+        self.cursor = cursor
     
-    @discord.ui.button(label="➡️", style=discord.ButtonStyle.secondary)
-    async def next_page(self, interaction: discord.Interaction, button: Button):
-        if (self.page + 1) * self.links_per_page < len(self.links):
-            await self.show_page(interaction, self.page + 1)
+    @classmethod
+    async def from_custom_id(cls, interaction: discord.Interaction, item: Button, match: re.Match):
+        cursor = (match['created'], int(match['id'])) if match['id'] else None
+        return cls(match['direction'], int(match['page']), cursor)
     
-    @discord.ui.button(label="🔄", style=discord.ButtonStyle.primary)
-    async def refresh(self, interaction: discord.Interaction, button: Button):
-        await self.show_page(interaction, self.page)
+    @timed
+    async def callback(self, interaction: discord.Interaction):
+        if self.direction == 'prev':
+            await show_links_page(interaction, self.page - 1, before=self.cursor)
+        elif self.direction == 'next':
+            await show_links_page(interaction, self.page + 1, after=self.cursor)
+        else:
+            # Обновление перечитывает текущую страницу с ее первой строки включительно
+            await show_links_page(interaction, self.page if self.cursor else 0, start=self.cursor)
+
+class ActiveLinksView(StatelessView):
+    def __init__(self, links, page=0, has_prev=False, has_next=False):
+        super().__init__()
+        # В кнопках только курсоры границ страницы, а не весь список ссылок
+        first = (links[0][6], links[0][7]) if links else None
+        last = (links[-1][6], links[-1][7]) if links else None
+        self.add_item(LinksPageButton('prev', page, first, disabled=not has_prev))
+        self.add_item(LinksPageButton('next', page, last, disabled=not has_next))
+        # Первая страница обновляется с самого начала, чтобы показать новые команды
+        self.add_item(LinksPageButton('refresh', page, first if page else None))
+
+class RoleSearchModal(Modal):
+    def __init__(self, action_type):
+        super().__init__(title="Поиск роли")
+        self.action_type = action_type
+        
+        self.query = TextInput(
+            label="Название роли",
+            placeholder="Начало или часть названия",
+            max_length=100,
+            required=True
+        )
+        self.add_item(self.query)
     
-    async def show_page(self, interaction: discord.Interaction, page: int):
-        start_idx = page * self.links_per_page
-        end_idx = start_idx + self.links_per_page
-        page_links = self.links[start_idx:end_idx]
+    @timed
+    async def on_submit(self, interaction: discord.Interaction):
+        view = RoleSelectView(interaction.guild, self.action_type, query=self.query.value)
+        if not view.role_ids:
+            await interaction.response.send_message(f"❌ Роли по запросу **{self.query.value}** не найдены", ephemeral=True)
+            return
         
         embed = discord.Embed(
-            title=f"🔗 Активные команды (Страница {page + 1})",
-            description=f"Всего активных команд: {len(self.links)}",
+            title="🔍 Результаты поиска",
+            description=f"Запрос: **{self.query.value}**",
             color=0x3498db
         )
-        
-        for link_code, role_name, uses_limit, uses_count, expires_at, created_by, created_at in page_links:
-            status = "✅ Активна"
-            if uses_limit > 0:
-                status = f"🔄 {uses_count}/{uses_limit}"
-            if expires_at and datetime.now() > datetime.fromisoformat(expires_at):
-                status = "❌ Истекла"
-            
-            expires_text = "Бессрочно"
-            if expires_at:
-                expires_dt = datetime.fromisoformat(expires_at)
-                expires_text = expires_dt.strftime("%d.%m %H:%M")
-            
-            created_dt = datetime.fromisoformat(created_at)
-            created_text = created_dt.strftime("%d.%m %H:%M")
-            
-            embed.add_field(
-                name=f"🎯 {role_name}",
-                value=(
-                    f"**Код:** `{link_code}`\n"
-                    f"**Статус:** {status}\n"
-                    f"**Создал:** **{created_by}**\n"
-                    f"**Создано:** {created_text}\n"
-                    f"**Истекает:** {expires_text}"
-                ),
-                inline=False
-            )
-        
-        if not page_links:
-            embed.description = "❌ На этой странице нет команд"
-        
-        view = ActiveLinksView(self.links, page)
         await interaction.response.edit_message(embed=embed, view=view)
 
-class RoleSelectView(View):
-    def __init__(self, roles, action_type):
-        super().__init__(timeout=180)
-        self.roles = roles
-        self.action_type = action_type
-        
-        self.select = Select(
+class RoleSelectMenu(discord.ui.DynamicItem[Select], template=r'roles\|(?P<action>create|quick|bulk)\|select'):
+    """Выбор роли, в custom_id - что делать с выбранной ролью"""
+    def __init__(self, action_type: str, options: List[discord.SelectOption]):
+        super().__init__(Select(
+            custom_id=f"roles|{action_type}|select",
             placeholder="Выберите роль...",
-            options=[
-                discord.SelectOption(
-                    label=role.name[:25],
-                    value=str(role.id),
-                    description=f"ID: {role.id}"[:50]
-                ) for role in roles[:25]
-            ]
-        )
-        self.select.callback = self.role_selected
-        self.add_item(self.select)
+            options=options or [discord.SelectOption(label="Нет ролей", value="0")],
+            disabled=not options,
+            row=0
+        ))
+        self.action_type = action_type
+    
+    @classmethod
+    async def from_custom_id(cls, interaction: discord.Interaction, item: Select, match: re.Match):
+        return cls(match['action'], item.options)
     
-    async def role_selected(self, interaction: discord.Interaction):
-        role_id = int(self.select.values[0])
+    @timed
+    async def callback(self, interaction: discord.Interaction):
+        role_id = int(self.item.values[0])
         role = interaction.guild.get_role(role_id)
         
-        if self.action_type == "quick":
-            link_code = role_link_system.create_role_link(
+        if not role:
+            await interaction.response.send_message("❌ Роль не найдена на сервере", ephemeral=True)
+            return
+        
+        if self.action_type == "bulk":
+            if not member_outranks(interaction.user, role):
+                await interaction.response.send_message("❌ Роль не ниже вашей высшей роли - выдать её нельзя", ephemeral=True)
+                return
+            
+            embed = discord.Embed(
+                title="🎭 Массовая выдача ролей",
+                description=f"Роль: {role.mention}\nКому выдать роль?",
+                color=0x3498db
+            )
+            
+            view = BulkFilterView(role)
+            await interaction.response.edit_message(embed=embed, view=view)
+            
+        elif self.action_type == "quick":
+            link_code, _ = await interaction_dedup.run(interaction, 'quick', role.id, lambda: role_link_system.create_role_link(
                 server_id=interaction.guild.id,
                 role_id=role.id,
                 role_name=role.name,
@@ -418,7 +2161,7 @@ class RoleSelectView(View):
                 created_by_name=str(interaction.user),
                 uses_limit=0,
                 expires_hours=24
-            )
+            ))
             
             embed = discord.Embed(
                 title="⚡ Команда создана",
@@ -426,9 +2169,11 @@ class RoleSelectView(View):
                 color=0x00ff00
             )
             embed.add_field(name="Команда", value=f"```!роль {link_code}```", inline=False)
+            if oauth.enabled:
+                embed.add_field(name="Ссылка", value=role_link_system.link_url(link_code), inline=False)
             embed.add_field(name="Статус", value="✅ 24 часа без ограничений", inline=True)
             
-            view = LinkActionsView(link_code, role.name)
+            view = LinkActionsView(link_code)
             await interaction.response.edit_message(embed=embed, view=view)
             
         else:
@@ -438,47 +2183,158 @@ class RoleSelectView(View):
                 color=0x3498db
             )
             
-            view = LinkSettingsView(role, interaction.user.id, str(interaction.user))
+            view = LinkSettingsView(role)
             await interaction.response.edit_message(embed=embed, view=view)
 
-class LinkSettingsView(View):
-    def __init__(self, role, creator_id, creator_name):
-        super().__init__(timeout=180)
-        self.role = role
-        self.creator_id = creator_id
-        self.creator_name = creator_name
+class RolePageButton(discord.ui.DynamicItem[Button],
+                     template=r'roles\|(?P<action>create|quick|bulk)\|(?P<op>prev|next|open|search)\|(?P<page>-?\d+)'):
+    """Страницы и поиск в выборе роли, в custom_id - действие и целевая страница"""
+    BUTTONS = {
+        'prev': ("⬅️", None, discord.ButtonStyle.secondary),
+        'next': ("➡️", None, discord.ButtonStyle.secondary),
+        'open': ("Другая роль", "🔍", discord.ButtonStyle.secondary),
+        'search': ("Поиск", "🔍", discord.ButtonStyle.primary),
+    }
     
-    @discord.ui.button(label="Без ограничений", style=discord.ButtonStyle.success, row=0)
-    async def unlimited_button(self, interaction: discord.Interaction, button: Button):
-        await self.create_link(interaction, 0, 0)
+    def __init__(self, action_type: str, op: str, page: int = 0, disabled: bool = False):
+        label, emoji, style = self.BUTTONS[op]
+        super().__init__(Button(label=label, emoji=emoji, style=style, disabled=disabled, row=1,
+                                custom_id=f"roles|{action_type}|{op}|{page}"))
+        self.action_type = action_type
+        self.op = op
+        self.page = page
     
-    @discord.ui.button(label="10 использований", style=discord.ButtonStyle.primary, row=0)
-    async def ten_uses_button(self, interaction: discord.Interaction, button: Button):
-        await self.create_link(interaction, 10, 24)
+    @classmethod
+    async def from_custom_id(cls, interaction: discord.Interaction, item: Button, match: re.Match):
+        return cls(match['action'], match['op'], int(match['page']))
     
-    @discord.ui.button(label="24 часа", style=discord.ButtonStyle.primary, row=1)
-    async def one_day_button(self, interaction: discord.Interaction, button: Button):
-        await self.create_link(interaction, 0, 24)
+    @timed
+    async def callback(self, interaction: discord.Interaction):
+        if self.op == 'search':
+            await interaction.response.send_modal(RoleSearchModal(self.action_type))
+            return
+        view = RoleSelectView(interaction.guild, self.action_type, max(self.page, 0))
+        await interaction.response.edit_message(view=view)
+
+class RoleSelectView(StatelessView):
+    def __init__(self, guild, action_type, page=0, query=None):
+        super().__init__()
+        
+        # Роли берем из индекса: страница по алфавиту или результаты поиска
+        if query:
+            self.role_ids = role_index.search(guild, query)
+            has_next = False
+        else:
+            self.role_ids = role_index.page(guild, page)
+            has_next = (page + 1) * ROLE_PAGE_SIZE < role_index.count(guild)
+        
+        roles = [role for role in map(guild.get_role, self.role_ids) if role]
+        options = [
+            discord.SelectOption(
+                label=role.name[:25],
+                value=str(role.id),
+                description=f"ID: {role.id}"[:50]
+            ) for role in roles
+        ]
+        self.add_item(RoleSelectMenu(action_type, options))
+        self.add_item(RolePageButton(action_type, 'prev', page - 1, disabled=query is not None or page == 0))
+        self.add_item(RolePageButton(action_type, 'next', page + 1, disabled=not has_next))
+        self.add_item(RolePageButton(action_type, 'search'))
+
+class BulkStartButton(discord.ui.DynamicItem[Button], template=r'bulk\|(?P<role>\d+)\|(?P<filter>\w+)'):
+    """Запуск массовой выдачи, в custom_id - роль и фильтр участников"""
+    def __init__(self, role_id: int, filter_key: str):
+        label = BULK_FILTERS[filter_key][0] if filter_key in BULK_FILTERS else filter_key
+        super().__init__(Button(label=label, style=discord.ButtonStyle.primary, custom_id=f"bulk|{role_id}|{filter_key}"))
+        self.role_id = role_id
+        self.filter_key = filter_key
+    
+    @classmethod
+    async def from_custom_id(cls, interaction: discord.Interaction, item: Button, match: re.Match):
+        return cls(int(match['role']), match['filter'])
+    
+    @timed
+    async def callback(self, interaction: discord.Interaction):
+        role = interaction.guild.get_role(self.role_id)
+        if not role or self.filter_key not in BULK_FILTERS:
+            await interaction.response.send_message("❌ Роль не найдена на сервере", ephemeral=True)
+            return
+        if not interaction.user.guild_permissions.manage_roles:
+            await interaction.response.send_message("❌ Нужно право «Управление ролями»", ephemeral=True)
+            return
+        if role >= interaction.guild.me.top_role:
+            await interaction.response.send_message("❌ Роль выше роли бота - выдать её нельзя", ephemeral=True)
+            return
+        if not member_outranks(interaction.user, role):
+            await interaction.response.send_message("❌ Роль не ниже вашей высшей роли - выдать её нельзя", ephemeral=True)
+            return
+        if not bulk_roles.reserve(interaction.guild.id):
+            await interaction.response.send_message("❌ На сервере уже идет массовая выдача", ephemeral=True)
+            return
+        
+        try:
+            await interaction.response.edit_message(
+                embed=discord.Embed(title="🎭 Массовая выдача запущена", description="Прогресс будет в сообщении в этом канале", color=0x00ff00),
+                view=None
+            )
+            await bulk_roles.start(interaction.guild, role, self.filter_key, interaction.channel, str(interaction.user))
+        finally:
+            # Задание уже в tasks (или запуск не удался) - резерв больше не нужен
+            bulk_roles.release(interaction.guild.id)
+
+class BulkFilterView(StatelessView):
+    def __init__(self, role):
+        super().__init__()
+        for filter_key in BULK_FILTERS:
+            self.add_item(BulkStartButton(role.id, filter_key))
+
+class LinkSettingsButton(discord.ui.DynamicItem[Button],
+                         template=r'settings\|(?P<role>\d+)\|(?P<preset>unlimited|ten_uses|one_day|custom)'):
+    """Готовые настройки команды, в custom_id - роль и вариант ограничений"""
+    # вариант -> (надпись, стиль, ряд, лимит использований, часы)
+    PRESETS = {
+        'unlimited': ("Без ограничений", discord.ButtonStyle.success, 0, 0, 0),
+        'ten_uses': ("10 использований", discord.ButtonStyle.primary, 0, 10, 24),
+        'one_day': ("24 часа", discord.ButtonStyle.primary, 1, 0, 24),
+        'custom': ("Кастомные", discord.ButtonStyle.secondary, 1, None, None),
+    }
+    
+    def __init__(self, role_id: int, preset: str):
+        label, style, row, _, _ = self.PRESETS[preset]
+        super().__init__(Button(label=label, style=style, row=row, custom_id=f"settings|{role_id}|{preset}"))
+        self.role_id = role_id
+        self.preset = preset
     
-    @discord.ui.button(label="Кастомные", style=discord.ButtonStyle.secondary, row=1)
-    async def custom_button(self, interaction: discord.Interaction, button: Button):
-        modal = CustomLinkModal(self.role)
-        await interaction.response.send_modal(modal)
+    @classmethod
+    async def from_custom_id(cls, interaction: discord.Interaction, item: Button, match: re.Match):
+        return cls(int(match['role']), match['preset'])
     
-    async def create_link(self, interaction: discord.Interaction, uses: int, hours: int):
-        link_code = role_link_system.create_role_link(
+    @timed
+    async def callback(self, interaction: discord.Interaction):
+        role = interaction.guild.get_role(self.role_id)
+        if not role:
+            await interaction.response.send_message("❌ Роль не найдена на сервере", ephemeral=True)
+            return
+        
+        _, _, _, uses, hours = self.PRESETS[self.preset]
+        if uses is None:
+            modal = CustomLinkModal(role)
+            await interaction.response.send_modal(modal)
+            return
+        
+        link_code, _ = await interaction_dedup.run(interaction, self.preset, role.id, lambda: role_link_system.create_role_link(
             server_id=interaction.guild.id,
-            role_id=self.role.id,
-            role_name=self.role.name,
-            created_by=self.creator_id,
-            created_by_name=self.creator_name,
+            role_id=role.id,
+            role_name=role.name,
+            created_by=interaction.user.id,
+            created_by_name=str(interaction.user),
             uses_limit=uses,
             expires_hours=hours
-        )
+        ))
         
         embed = discord.Embed(
             title="🔗 Команда создана!",
-            description=f"Роль: {self.role.mention}",
+            description=f"Роль: {role.mention}",
             color=0x00ff00
         )
         
@@ -492,59 +2348,74 @@ class LinkSettingsView(View):
         
         embed.add_field(name="Ограничения", value=" | ".join(limits), inline=True)
         embed.add_field(name="Команда", value=f"```!роль {link_code}```", inline=False)
+        if oauth.enabled:
+            embed.add_field(name="Ссылка", value=role_link_system.link_url(link_code), inline=False)
         embed.add_field(name="Инструкция", value="Отправьте команду в чат чтобы получить роль", inline=False)
         
-        view = LinkActionsView(link_code, self.role.name)
+        view = LinkActionsView(link_code)
         await interaction.response.edit_message(embed=embed, view=view)
 
-class QuickRoleView(View):
-    def __init__(self, roles, user_id, user_name):
-        super().__init__(timeout=180)
-        self.roles = roles
-        self.user_id = user_id
-        self.user_name = user_name
-        
+class LinkSettingsView(StatelessView):
+    def __init__(self, role):
+        super().__init__()
+        for preset in LinkSettingsButton.PRESETS:
+            self.add_item(LinkSettingsButton(role.id, preset))
+
+class QuickLinkButton(discord.ui.DynamicItem[Button], template=r'quick_role_(?P<role>\d+)'):
+    """Быстрая команда на 24 часа, в custom_id - роль"""
+    def __init__(self, role_id: int, label: str = "Роль"):
+        super().__init__(Button(label=label[:15], style=discord.ButtonStyle.primary, custom_id=f"quick_role_{role_id}"))
+        self.role_id = role_id
+    
+    @classmethod
+    async def from_custom_id(cls, interaction: discord.Interaction, item: Button, match: re.Match):
+        return cls(int(match['role']))
+    
+    @timed
+    async def callback(self, interaction: discord.Interaction):
+        try:
+            await interaction.response.defer(ephemeral=True)
+            
+            role = interaction.guild.get_role(self.role_id)
+            if not role:
+                await interaction.followup.send("❌ Роль не найдена на сервере", ephemeral=True)
+                return
+            
+            # Двойной клик по кнопке роли не создает вторую команду
+            link_code, _ = await interaction_dedup.run(interaction, 'quick', role.id, lambda: role_link_system.create_role_link(
+                server_id=interaction.guild.id,
+                role_id=role.id,
+                role_name=role.name,
+                created_by=interaction.user.id,
+                created_by_name=str(interaction.user),
+                uses_limit=0,
+                expires_hours=24
+            ))
+            
+            embed = discord.Embed(
+                title="⚡ Команда создана!",
+                description=f"Роль: {role.mention}",
+                color=0x00ff00
+            )
+            embed.add_field(name="Команда", value=f"```!роль {link_code}```", inline=False)
+            if oauth.enabled:
+                embed.add_field(name="Ссылка", value=role_link_system.link_url(link_code), inline=False)
+            embed.add_field(name="Действует", value="24 часа", inline=True)
+            embed.add_field(name="Лимит", value="Без ограничений", inline=True)
+            
+            view = LinkActionsView(link_code)
+            await interaction.followup.send(embed=embed, view=view, ephemeral=True)
+            
+        except Exception:
+            log.exception("Ошибка в quick role callback", extra=log_extra('quick_role', interaction.guild, interaction.user))
+            await interaction.followup.send("❌ Ошибка при создании команды", ephemeral=True)
+
+class QuickRoleView(StatelessView):
+    def __init__(self, roles):
+        super().__init__()
         for role in roles:
-            button = Button(
-                label=role.name[:15],
-                style=discord.ButtonStyle.primary,
-                custom_id=f"quick_role_{role.id}"
-            )
-            button.callback = self.create_quick_link_callback(role)
-            self.add_item(button)
-    
-    def create_quick_link_callback(self, role):
-        async def callback(interaction: discord.Interaction):
-            try:
-                await interaction.response.defer(ephemeral=True)
-                
-                link_code = role_link_system.create_role_link(
-                    server_id=interaction.guild.id,
-                    role_id=role.id,
-                    role_name=role.name,
-                    created_by=self.user_id,
-                    created_by_name=self.user_name,
-                    uses_limit=0,
-                    expires_hours=24
-                )
-                
-                embed = discord.Embed(
-                    title="⚡ Команда создана!",
-                    description=f"Роль: {role.mention}",
-                    color=0x00ff00
-                )
-                embed.add_field(name="Команда", value=f"```!роль {link_code}```", inline=False)
-                embed.add_field(name="Действует", value="24 часа", inline=True)
-                embed.add_field(name="Лимит", value="Без ограничений", inline=True)
-                
-                view = LinkActionsView(link_code, role.name)
-                await interaction.followup.send(embed=embed, view=view, ephemeral=True)
-                
-            except Exception as e:
-                print(f"Ошибка в quick role callback: {e}")
-                await interaction.followup.send("❌ Ошибка при создании команды", ephemeral=True)
-        
-        return callback
+            self.add_item(QuickLinkButton(role.id, role.name))
+        self.add_item(RolePageButton("quick", 'open'))
 
 # ========== СИСТЕМА СКЛАДА - МОДАЛЬНЫЕ ОКНА ==========
 
@@ -578,6 +2449,7 @@ class AddResourceModal(Modal):
         self.add_item(self.amount)
         self.add_item(self.description)
     
+    @timed
     async def on_submit(self, interaction: discord.Interaction):
         try:
             amount = int(self.amount.value)
@@ -585,7 +2457,7 @@ class AddResourceModal(Modal):
                 await interaction.response.send_message("❌ Количество не может быть отрицательным", ephemeral=True)
                 return
             
-            storage_system.add_resource(
+            await storage_system.add_resource(
                 server_id=interaction.guild.id,
                 resource_name=self.resource_name.value,
                 amount=amount,
@@ -614,6 +2486,7 @@ class UpdateResourceModal(Modal):
         
         self.add_item(self.new_amount)
     
+    @timed
     async def on_submit(self, interaction: discord.Interaction):
         try:
             new_amount = int(self.new_amount.value)
@@ -621,7 +2494,7 @@ class UpdateResourceModal(Modal):
                 await interaction.response.send_message("❌ Количество не может быть отрицательным", ephemeral=True)
                 return
             
-            storage_system.update_resource_amount(
+            await storage_system.update_resource_amount(
                 server_id=interaction.guild.id,
                 resource_name=self.resource_name,
                 new_amount=new_amount,
@@ -636,31 +2509,53 @@ class UpdateResourceModal(Modal):
 
 # ========== ПАНЕЛЬ СКЛАДА В 1 ОКНЕ ==========
 
-class StorageMainView(View):
-    def __init__(self):
-        super().__init__(timeout=None)
+class StorageButton(discord.ui.DynamicItem[Button], template=r'storage_(?P<action>refresh|add|stats|manage)'):
+    """Кнопки панели склада; шаблон совпадает с custom_id уже отправленных панелей"""
+    BUTTONS = {
+        'refresh': ("Обновить", "🔄", discord.ButtonStyle.primary, 0),
+        'add': ("Добавить", "📥", discord.ButtonStyle.success, 0),
+        'stats': ("Статистика", "📈", discord.ButtonStyle.primary, 1),
+        'manage': ("Управление", "⚙️", discord.ButtonStyle.secondary, 1),
+    }
     
-    @discord.ui.button(label="Обновить", style=discord.ButtonStyle.primary, emoji="🔄", custom_id="storage_refresh", row=0)
-    async def refresh_button(self, interaction: discord.Interaction, button: Button):
-        await self.show_storage(interaction)
+    def __init__(self, action: str):
+        label, emoji, style, row = self.BUTTONS[action]
+        super().__init__(Button(label=label, emoji=emoji, style=style, row=row, custom_id=f"storage_{action}"))
+        self.action = action
     
-    @discord.ui.button(label="Добавить", style=discord.ButtonStyle.success, emoji="📥", custom_id="storage_add", row=0)
-    async def add_button(self, interaction: discord.Interaction, button: Button):
-        modal = AddResourceModal()
-        await interaction.response.send_modal(modal)
+    @classmethod
+    async def from_custom_id(cls, interaction: discord.Interaction, item: Button, match: re.Match):
+        return cls(match['action'])
     
-    @discord.ui.button(label="Статистика", style=discord.ButtonStyle.primary, emoji="📈", custom_id="storage_stats", row=1)
-    async def stats_button(self, interaction: discord.Interaction, button: Button):
-        await self.show_statistics(interaction)
-    
-    @discord.ui.button(label="Управление", style=discord.ButtonStyle.secondary, emoji="⚙️", custom_id="storage_manage", row=1)
-    async def manage_button(self, interaction: discord.Interaction, button: Button):
-        await self.show_management(interaction)
+    @timed
+    async def callback(self, interaction: discord.Interaction):
+        panel = StorageMainView()
+        if self.action == 'refresh':
+            await panel.show_storage(interaction)
+        elif self.action == 'add':
+            modal = AddResourceModal()
+            await interaction.response.send_modal(modal)
+        elif self.action == 'stats':
+            await panel.show_statistics(interaction)
+        else:
+            await panel.show_management(interaction)
+
+class StorageMainView(StatelessView):
+    def __init__(self):
+        super().__init__()
+        for action in StorageButton.BUTTONS:
+            self.add_item(StorageButton(action))
     
-    async def show_storage(self, interaction: discord.Interaction = None, is_response: bool = True):
-        """Показать склад в одном окне"""
+    async def show_storage(self, interaction: discord.Interaction = None, is_response: bool = True,
+                           page: int = 0, after: Optional[str] = None, before: Optional[str] = None):
+        """Показать страницу склада: новым сообщением или заменой текущего"""
         try:
-            resources = storage_system.get_resources(interaction.guild.id)
+            resources, has_prev, has_next = await storage_system.get_resources_page(interaction.guild.id, after, before)
+            
+            # Страница могла опустеть после удаления ресурсов - возвращаемся к началу
+            if not resources and page > 0:
+                page = 0
+                resources, has_prev, has_next = await storage_system.get_resources_page(interaction.guild.id)
             
             embed = discord.Embed(
                 title="📦 СКЛАД СЕРВЕРА",
@@ -670,91 +2565,89 @@ class StorageMainView(View):
             
             if not resources:
                 embed.description = "📭 Склад пуст. Добавьте ресурсы с помощью кнопки 'Добавить'"
-                if is_response:
-                    await interaction.response.send_message(embed=embed, view=self, ephemeral=True)
-                else:
-                    await interaction.edit_original_response(embed=embed, view=self)
-                return
-            
-            # Общая статистика
-            total_resources = len(resources)
-            total_amount = sum(amount for _, amount, _, _, _ in resources)
-            
-            embed.add_field(
-                name="📊 ОБЩАЯ СТАТИСТИКА",
-                value=f"**Ресурсов:** {total_resources}\n**Всего единиц:** {total_amount}",
-                inline=False
-            )
-            
-            # Улучшенная таблица с правильным выравниванием
-            table_lines = []
-            
-            # Заголовок таблицы
-            table_lines.append("┌──────────────────┬──────────────┬─────────────────┐")
-            table_lines.append("│     РЕСУРС       │  КОЛИЧЕСТВО  │    ОБНОВЛЕНО    │")
-            table_lines.append("├──────────────────┼──────────────┼─────────────────┤")
-            
-            # Данные таблицы
-            for resource_name, amount, description, updated_by, last_updated in resources:
-                # Форматируем название ресурса (максимум 15 символов)
-                name_display = resource_name[:15] + "…" if len(resource_name) > 15 else resource_name
-                name_display = name_display.ljust(15)
+                view = StorageMainView()
+            else:
+                # Общая статистика
+                aggregate = await storage_system.get_aggregate(interaction.guild.id)
+                total_resources = aggregate.count
+                total_amount = aggregate.total
+                total_pages = max(1, -(-total_resources // STORAGE_PAGE_SIZE))
+                
+                embed.add_field(
+                    name="📊 ОБЩАЯ СТАТИСТИКА",
+                    value=f"**Ресурсов:** {total_resources}\n**Всего единиц:** {total_amount}",
+                    inline=False
+                )
                 
-                # Форматируем количество (максимум 12 символов)
-                amount_display = str(amount)
-                amount_display = amount_display.ljust(12)
+                # Улучшенная таблица с правильным выравниванием
+                table_lines = []
                 
-                # Форматируем время
-                last_updated_dt = datetime.fromisoformat(last_updated)
-                time_display = last_updated_dt.strftime("%d.%m %H:%M")
+                # Заголовок таблицы
+                table_lines.append("┌──────────────────┬──────────────┬─────────────────┐")
+                table_lines.append("│     РЕСУРС       │  КОЛИЧЕСТВО  │    ОБНОВЛЕНО    │")
+                table_lines.append("├──────────────────┼──────────────┼─────────────────┤")
                 
-                table_lines.append(f"│ {name_display} │ {amount_display} │ {time_display} │")
-            
-            # Нижняя граница таблицы
-            table_lines.append("└──────────────────┴──────────────┴─────────────────┘")
-            
-            # Объединяем все строки таблицы
-            table_content = "\n".join(table_lines)
-            
-            embed.add_field(
-                name="📋 ТАБЛИЦА РЕСУРСОВ",
-                value=f"```{table_content}```",
-                inline=False
-            )
-            
-            # Информация о последнем обновлении
-            if resources:
-                last_resource = resources[0]
-                embed.set_footer(text=f"Последнее обновление: {last_resource[3]}")
+                # Данные таблицы - только видимая страница
+                for resource_name, amount, description, updated_by, last_updated in resources:
+                    # Форматируем название ресурса (максимум 15 символов)
+                    name_display = resource_name[:15] + "…" if len(resource_name) > 15 else resource_name
+                    name_display = name_display.ljust(15)
+                    
+                    # Форматируем количество (максимум 12 символов)
+                    amount_display = str(amount)[:12]
+                    amount_display = amount_display.ljust(12)
+                    
+                    # Форматируем время
+                    last_updated_dt = datetime.fromisoformat(last_updated)
+                    time_display = last_updated_dt.strftime("%d.%m %H:%M")
+                    
+                    table_lines.append(f"│ {name_display} │ {amount_display} │ {time_display} │")
+                
+                # Нижняя граница таблицы
+                table_lines.append("└──────────────────┴──────────────┴─────────────────┘")
+                
+                # Объединяем все строки таблицы
+                table_content = "\n".join(table_lines)
+                
+                embed.add_field(
+                    name=f"📋 ТАБЛИЦА РЕСУРСОВ (Страница {page + 1}/{max(total_pages, page + 1)})",
+                    value=f"```{table_content}```",
+                    inline=False
+                )
+                
+                # Информация о последнем обновлении
+                embed.set_footer(text=f"Последнее обновление: {resources[0][3]}")
+                
+                view = StoragePageView(page, resources[0][0], resources[-1][0], has_prev, has_next)
             
             if is_response:
-                await interaction.response.send_message(embed=embed, view=self, ephemeral=True)
+                await interaction.response.send_message(embed=embed, view=view, ephemeral=True)
             else:
-                await interaction.edit_original_response(embed=embed, view=self)
+                await interaction.response.edit_message(embed=embed, view=view)
             
-        except Exception as e:
-            print(f"Ошибка в show_storage: {e}")
-            if is_response:
-                await interaction.response.send_message("❌ Ошибка при загрузке склада", ephemeral=True)
-            else:
+        except Exception:
+            log.exception("Ошибка в show_storage", extra=log_extra('show_storage', interaction.guild, interaction.user))
+            if interaction.response.is_done():
                 await interaction.followup.send("❌ Ошибка при загрузке склада", ephemeral=True)
+            else:
+                await interaction.response.send_message("❌ Ошибка при загрузке склада", ephemeral=True)
     
     async def show_statistics(self, interaction: discord.Interaction):
         """Показать статистику склада"""
         try:
-            resources = storage_system.get_resources(interaction.guild.id)
+            aggregate = await storage_system.get_aggregate(interaction.guild.id)
             
-            if not resources:
+            if not aggregate.count:
                 await interaction.response.send_message("📭 Склад пуст", ephemeral=True)
                 return
             
-            total_resources = len(resources)
-            total_amount = sum(amount for _, amount, _, _, _ in resources)
+            total_resources = aggregate.count
+            total_amount = aggregate.total
             avg_amount = total_amount // total_resources if total_resources > 0 else 0
             
             # Самые популярные ресурсы
-            top_resources = sorted(resources, key=lambda x: x[1], reverse=True)[:3]
-            least_resources = sorted(resources, key=lambda x: x[1])[:3]
+            top_resources = aggregate.top(3)
+            least_resources = aggregate.bottom(3)
             
             embed = discord.Embed(
                 title="📈 СТАТИСТИКА СКЛАДА",
@@ -774,7 +2667,7 @@ class StorageMainView(View):
             )
             
             # Топ ресурсов
-            top_text = "\n".join([f"• **{name}** - `{amount}`" for name, amount, _, _, _ in top_resources])
+            top_text = "\n".join([f"• **{name}** - `{amount}`" for name, amount in top_resources])
             embed.add_field(
                 name="🏆 ТОП-3 РЕСУРСА",
                 value=top_text,
@@ -782,7 +2675,7 @@ class StorageMainView(View):
             )
             
             # Наименьшие ресурсы
-            least_text = "\n".join([f"• **{name}** - `{amount}`" for name, amount, _, _, _ in least_resources])
+            least_text = "\n".join([f"• **{name}** - `{amount}`" for name, amount in least_resources])
             embed.add_field(
                 name="📉 МИНИМАЛЬНЫЕ",
                 value=least_text,
@@ -792,7 +2685,7 @@ class StorageMainView(View):
             # Распределение
             if total_amount > 0:
                 distribution = []
-                for name, amount, _, _, _ in top_resources:
+                for name, amount in top_resources:
                     percentage = (amount / total_amount) * 100
                     distribution.append(f"• **{name}** - {percentage:.1f}%")
                 
@@ -805,14 +2698,17 @@ class StorageMainView(View):
             view = StorageMainView()
             await interaction.response.send_message(embed=embed, view=view, ephemeral=True)
             
-        except Exception as e:
-            print(f"Ошибка в show_statistics: {e}")
+        except Exception:
+            log.exception("Ошибка в show_statistics", extra=log_extra('show_statistics', interaction.guild, interaction.user))
             await interaction.response.send_message("❌ Ошибка при загрузке статистики", ephemeral=True)
     
-    async def show_management(self, interaction: discord.Interaction):
+    async def show_management(self, interaction: discord.Interaction, is_response: bool = True,
+                              page: int = 0, after: Optional[str] = None, before: Optional[str] = None):
         """Показать управление ресурсами"""
         try:
-            resources = storage_system.get_resources(interaction.guild.id)
+            resources, has_prev, has_next = await storage_system.get_resources_page(
+                interaction.guild.id, after, before, limit=RESOURCE_SELECT_PAGE_SIZE
+            )
             
             if not resources:
                 await interaction.response.send_message("📭 Склад пуст. Сначала добавьте ресурсы", ephemeral=True)
@@ -820,40 +2716,65 @@ class StorageMainView(View):
             
             embed = discord.Embed(
                 title="⚙️ УПРАВЛЕНИЕ РЕСУРСАМИ",
-                description="Выберите ресурс для управления:",
+                description=f"Выберите ресурс для управления (Страница {page + 1}):",
                 color=0x9567FE
             )
             
-            # Создаем кнопки для каждого ресурса
-            view = ResourceManagementView(resources)
-            await interaction.response.send_message(embed=embed, view=view, ephemeral=True)
+            # Выпадающий список вмещает 25 ресурсов - остальные доступны по страницам
+            view = ResourceManagementView(resources, page, has_prev, has_next)
+            if is_response:
+                await interaction.response.send_message(embed=embed, view=view, ephemeral=True)
+            else:
+                await interaction.response.edit_message(embed=embed, view=view)
             
-        except Exception as e:
-            print(f"Ошибка в show_management: {e}")
+        except Exception:
+            log.exception("Ошибка в show_management", extra=log_extra('show_management', interaction.guild, interaction.user))
             await interaction.response.send_message("❌ Ошибка при загрузке управления", ephemeral=True)
 
-class ResourceManagementView(View):
-    def __init__(self, resources):
-        super().__init__(timeout=180)
-        self.resources = resources
-        
-        # Создаем выпадающий список для выбора ресурса
-        self.select = Select(
-            placeholder="Выберите ресурс...",
-            options=[
-                discord.SelectOption(
-                    label=f"{name} ({amount})",
-                    value=name,
-                    description=description[:50] if description else "Без описания"
-                ) for name, amount, description, _, _ in resources[:25]
-            ]
-        )
-        self.select.callback = self.resource_selected
-        self.add_item(self.select)
+class StoragePageButton(discord.ui.DynamicItem[Button],
+                        template=r'storage_page\|(?P<direction>prev|next)\|(?P<page>\d+)\|(?P<name>.*)'):
+    """Листание склада, в custom_id - страница и ресурс на границе страницы"""
+    def __init__(self, direction: str, page: int, resource_name: str, disabled: bool = False):
+        super().__init__(Button(label="⬅️" if direction == 'prev' else "➡️", style=discord.ButtonStyle.secondary,
+                                disabled=disabled, row=2, custom_id=f"storage_page|{direction}|{page}|{resource_name}"))
+        self.direction = direction
+        self.page = page
+        self.resource_name = resource_name
+    
+    @classmethod
+    async def from_custom_id(cls, interaction: discord.Interaction, item: Button, match: re.Match):
+        return cls(match['direction'], int(match['page']), match['name'])
+    
+    @timed
+    async def callback(self, interaction: discord.Interaction):
+        if self.direction == 'prev':
+            await StorageMainView().show_storage(interaction, is_response=False, page=self.page - 1, before=self.resource_name)
+        else:
+            await StorageMainView().show_storage(interaction, is_response=False, page=self.page + 1, after=self.resource_name)
+
+class StoragePageView(StorageMainView):
+    """Панель склада с переключением страниц"""
+    def __init__(self, page: int, first_name: str, last_name: str, has_prev: bool, has_next: bool):
+        super().__init__()
+        self.add_item(StoragePageButton('prev', page, first_name, disabled=not has_prev))
+        self.add_item(StoragePageButton('next', page, last_name, disabled=not has_next))
+
+class ResourceSelectMenu(discord.ui.DynamicItem[Select], template=r'resources\|select'):
+    """Выбор ресурса для управления; значение опции - название ресурса"""
+    def __init__(self, options: List[discord.SelectOption]):
+        super().__init__(Select(custom_id="resources|select", placeholder="Выберите ресурс...", options=options, row=0))
+    
+    @classmethod
+    async def from_custom_id(cls, interaction: discord.Interaction, item: Select, match: re.Match):
+        return cls(item.options)
     
-    async def resource_selected(self, interaction: discord.Interaction):
-        resource_name = self.select.values[0]
-        current_amount = next((amount for name, amount, _, _, _ in self.resources if name == resource_name), 0)
+    @timed
+    async def callback(self, interaction: discord.Interaction):
+        resource_name = self.item.values[0]
+        current_amount = await storage_system.get_resource_amount(interaction.guild.id, resource_name)
+        if current_amount is None:
+            await interaction.response.send_message("❌ Ресурс не найден на складе", ephemeral=True)
+            return
         
         embed = discord.Embed(
             title=f"⚙️ Управление: {resource_name}",
@@ -861,29 +2782,87 @@ class ResourceManagementView(View):
             color=0x9567FE
         )
         
-        view = ResourceActionsView(resource_name, current_amount)
+        view = ResourceActionsView(resource_name)
         await interaction.response.edit_message(embed=embed, view=view)
 
-class ResourceActionsView(View):
-    def __init__(self, resource_name, current_amount):
-        super().__init__(timeout=180)
+class ResourcePageButton(discord.ui.DynamicItem[Button],
+                         template=r'resources\|(?P<direction>prev|next)\|(?P<page>\d+)\|(?P<name>.*)'):
+    """Листание списка ресурсов, в custom_id - страница и ресурс на границе страницы"""
+    def __init__(self, direction: str, page: int, resource_name: str, disabled: bool = False):
+        super().__init__(Button(label="⬅️" if direction == 'prev' else "➡️", style=discord.ButtonStyle.secondary,
+                                disabled=disabled, row=1, custom_id=f"resources|{direction}|{page}|{resource_name}"))
+        self.direction = direction
+        self.page = page
         self.resource_name = resource_name
-        self.current_amount = current_amount
     
-    @discord.ui.button(label="Изменить количество", style=discord.ButtonStyle.primary, row=0)
-    async def edit_amount(self, interaction: discord.Interaction, button: Button):
-        modal = UpdateResourceModal(self.resource_name, self.current_amount)
-        await interaction.response.send_modal(modal)
+    @classmethod
+    async def from_custom_id(cls, interaction: discord.Interaction, item: Button, match: re.Match):
+        return cls(match['direction'], int(match['page']), match['name'])
     
-    @discord.ui.button(label="Удалить ресурс", style=discord.ButtonStyle.danger, row=0)
-    async def delete_resource(self, interaction: discord.Interaction, button: Button):
-        storage_system.delete_resource(interaction.guild.id, self.resource_name)
-        await interaction.response.send_message(f"✅ Ресурс **{self.resource_name}** удален со склада", ephemeral=True)
+    @timed
+    async def callback(self, interaction: discord.Interaction):
+        if self.direction == 'prev':
+            await StorageMainView().show_management(interaction, is_response=False, page=self.page - 1,
+                                                    before=self.resource_name)
+        else:
+            await StorageMainView().show_management(interaction, is_response=False, page=self.page + 1,
+                                                    after=self.resource_name)
+
+class ResourceManagementView(StatelessView):
+    def __init__(self, resources, page=0, has_prev=False, has_next=False):
+        super().__init__()
+        
+        # Создаем выпадающий список для выбора ресурса
+        self.add_item(ResourceSelectMenu([
+            discord.SelectOption(
+                label=f"{name} ({amount})"[:100],
+                value=name,
+                description=description[:50] if description else "Без описания"
+            ) for name, amount, description, _, _ in resources
+        ]))
+        self.add_item(ResourcePageButton('prev', page, resources[0][0], disabled=not has_prev))
+        self.add_item(ResourcePageButton('next', page, resources[-1][0], disabled=not has_next))
+
+class ResourceActionButton(discord.ui.DynamicItem[Button], template=r'resource\|(?P<action>edit|delete|back)\|(?P<name>.*)'):
+    """Действия с ресурсом, в custom_id - название ресурса"""
+    BUTTONS = {
+        'edit': ("Изменить количество", discord.ButtonStyle.primary, 0),
+        'delete': ("Удалить ресурс", discord.ButtonStyle.danger, 0),
+        'back': ("Назад к складу", discord.ButtonStyle.secondary, 1),
+    }
     
-    @discord.ui.button(label="Назад к складу", style=discord.ButtonStyle.secondary, row=1)
-    async def back_button(self, interaction: discord.Interaction, button: Button):
-        view = StorageMainView()
-        await view.show_storage(interaction, is_response=False)
+    def __init__(self, action: str, resource_name: str):
+        label, style, row = self.BUTTONS[action]
+        super().__init__(Button(label=label, style=style, row=row, custom_id=f"resource|{action}|{resource_name}"))
+        self.action = action
+        self.resource_name = resource_name
+    
+    @classmethod
+    async def from_custom_id(cls, interaction: discord.Interaction, item: Button, match: re.Match):
+        return cls(match['action'], match['name'])
+    
+    @timed
+    async def callback(self, interaction: discord.Interaction):
+        if self.action == 'back':
+            view = StorageMainView()
+            await view.show_storage(interaction, is_response=False)
+        elif self.action == 'delete':
+            await storage_system.delete_resource(interaction.guild.id, self.resource_name)
+            await interaction.response.send_message(f"✅ Ресурс **{self.resource_name}** удален со склада", ephemeral=True)
+        else:
+            # Количество читаем при нажатии: с момента открытия панели его могли изменить
+            current_amount = await storage_system.get_resource_amount(interaction.guild.id, self.resource_name)
+            if current_amount is None:
+                await interaction.response.send_message("❌ Ресурс не найден на складе", ephemeral=True)
+                return
+            modal = UpdateResourceModal(self.resource_name, current_amount)
+            await interaction.response.send_modal(modal)
+
+class ResourceActionsView(StatelessView):
+    def __init__(self, resource_name):
+        super().__init__()
+        for action in ResourceActionButton.BUTTONS:
+            self.add_item(ResourceActionButton(action, resource_name))
 
 # ========== ОСНОВНЫЕ ПАНЕЛИ ==========
 
@@ -892,85 +2871,54 @@ class PermanentRoleView(View):
         super().__init__(timeout=None)
     
     @discord.ui.button(label="Создать команду", style=discord.ButtonStyle.primary, emoji="🎮", custom_id="perm_create_link", row=0)
+    @timed
     async def create_link_button(self, interaction: discord.Interaction, button: Button):
         try:
-            roles = [role for role in interaction.guild.roles if role.name != "@everyone" and not role.managed]
-            
-            if not roles:
+            if not role_index.count(interaction.guild):
                 await interaction.response.send_message("❌ На сервере нет доступных ролей", ephemeral=True)
                 return
             
             embed = discord.Embed(
                 title="🎯 Выберите роль для команды",
-                description="Выберите роль из списка ниже:",
+                description="Выберите роль из списка ниже или найдите её через поиск:",
                 color=0x3498db
             )
             
-            view = RoleSelectView(roles, "create")
+            view = RoleSelectView(interaction.guild, "create")
             await interaction.response.send_message(embed=embed, view=view, ephemeral=True)
             
-        except Exception as e:
-            print(f"Ошибка в create_link_button: {e}")
+        except Exception:
+            log.exception("Ошибка в create_link_button", extra=log_extra('create_link_button', interaction.guild, interaction.user))
             await interaction.response.send_message("❌ Произошла ошибка при создании команды", ephemeral=True)
     
     @discord.ui.button(label="Активные команды", style=discord.ButtonStyle.secondary, emoji="📊", custom_id="perm_active_links", row=0)
+    @timed
     async def active_links_button(self, interaction: discord.Interaction, button: Button):
         try:
-            links = role_link_system.get_active_links(interaction.guild.id)
+            links, has_prev, has_next = await role_link_system.get_active_links(interaction.guild.id)
             
             if not links:
                 await interaction.response.send_message("❌ Нет активных команд", ephemeral=True)
                 return
             
-            embed = discord.Embed(
-                title="🔗 Активные команды",
-                description=f"Всего активных команд: {len(links)}",
-                color=0x3498db
-            )
-            
-            for link_code, role_name, uses_limit, uses_count, expires_at, created_by, created_at in links[:5]:
-                status = "✅ Активна"
-                if uses_limit > 0:
-                    status = f"🔄 {uses_count}/{uses_limit}"
-                if expires_at and datetime.now() > datetime.fromisoformat(expires_at):
-                    status = "❌ Истекла"
-                
-                expires_text = "Бессрочно"
-                if expires_at:
-                    expires_dt = datetime.fromisoformat(expires_at)
-                    expires_text = expires_dt.strftime("%d.%m %H:%M")
-                
-                created_dt = datetime.fromisoformat(created_at)
-                created_text = created_dt.strftime("%d.%m %H:%M")
-                
-                embed.add_field(
-                    name=f"🎯 {role_name}",
-                    value=(
-                        f"**Код:** `{link_code}`\n"
-                        f"**Статус:** {status}\n"
-                        f"**Создал:** **{created_by}**\n"
-                        f"**Создано:** {created_text}\n"
-                        f"**Истекает:** {expires_text}"
-                    ),
-                    inline=False
-                )
+            total = role_link_system.count_active_links(interaction.guild.id)
+            embed = build_links_embed(links, 0, total)
             
-            if len(links) > 5:
-                embed.set_footer(text=f"И еще {len(links) - 5} команд... Используйте кнопки для навигации")
+            if has_next:
+                embed.set_footer(text=f"И еще {max(total - len(links), 0)} команд... Используйте кнопки для навигации")
             
-            view = ActiveLinksView(links)
+            view = ActiveLinksView(links, 0, has_prev, has_next)
             await interaction.response.send_message(embed=embed, view=view, ephemeral=True)
             
-        except Exception as e:
-            print(f"Ошибка в active_links_button: {e}")
+        except Exception:
+            log.exception("Ошибка в active_links_button", extra=log_extra('active_links_button', interaction.guild, interaction.user))
             await interaction.response.send_message("❌ Произошла ошибка при загрузке команд", ephemeral=True)
     
     @discord.ui.button(label="Быстрая команда", style=discord.ButtonStyle.success, emoji="⚡", custom_id="perm_quick_link", row=1)
+    @timed
     async def quick_link_button(self, interaction: discord.Interaction, button: Button):
         try:
-            roles = [role for role in interaction.guild.roles if role.name != "@everyone" and not role.managed]
-            
-            if not roles:
+            if not role_index.count(interaction.guild):
                 await interaction.response.send_message("❌ На сервере нет доступных ролей", ephemeral=True)
                 return
             
@@ -980,15 +2928,21 @@ class PermanentRoleView(View):
                 color=0x00ff00
             )
             
-            popular_roles = roles[:5]
-            view = QuickRoleView(popular_roles, interaction.user.id, str(interaction.user))
+            popular_roles = [role for role in map(interaction.guild.get_role, role_index.page(interaction.guild, 0, 5)) if role]
+            view = QuickRoleView(popular_roles)
             await interaction.response.send_message(embed=embed, view=view, ephemeral=True)
             
-        except Exception as e:
-            print(f"Ошибка в quick_link_button: {e}")
+        except Exception:
+            log.exception("Ошибка в quick_link_button", extra=log_extra('quick_link_button', interaction.guild, interaction.user))
             await interaction.response.send_message("❌ Произошла ошибка при создании быстрой команды", ephemeral=True)
     
+    @discord.ui.button(label="Ввести код", style=discord.ButtonStyle.success, emoji="🎫", custom_id="perm_redeem_code", row=2)
+    @timed
+    async def redeem_code_button(self, interaction: discord.Interaction, button: Button):
+        await interaction.response.send_modal(RedeemCodeModal())
+    
     @discord.ui.button(label="Помощь", style=discord.ButtonStyle.danger, emoji="❓", custom_id="perm_help", row=1)
+    @timed
     async def help_button(self, interaction: discord.Interaction, button: Button):
         embed = discord.Embed(
             title="📋 Помощь по командам",
@@ -1016,17 +2970,47 @@ class PermanentRoleView(View):
         
         embed.add_field(
             name="🎯 Использование",
-            value="Отправьте `!роль КОД` в чат чтобы получить роль",
+            value="Используйте `/роль КОД` или кнопку «Ввести код» - ответ увидите только вы. `!роль КОД` тоже работает",
             inline=False
         )
         
         await interaction.response.send_message(embed=embed, ephemeral=True)
 
+class MembersBulkButton(discord.ui.DynamicItem[Button], template=r'members_bulk'):
+    """Вход в массовую выдачу ролей из панели участников"""
+    def __init__(self):
+        super().__init__(Button(label="Массовая выдача ролей", style=discord.ButtonStyle.primary, emoji="🎭",
+                                custom_id="members_bulk"))
+    
+    @classmethod
+    async def from_custom_id(cls, interaction: discord.Interaction, item: Button, match: re.Match):
+        return cls()
+    
+    @timed
+    async def callback(self, interaction: discord.Interaction):
+        if not interaction.user.guild_permissions.manage_roles:
+            await interaction.response.send_message("❌ Нужно право «Управление ролями»", ephemeral=True)
+            return
+        
+        embed = discord.Embed(
+            title="🎭 Массовая выдача ролей",
+            description="Выберите роль для выдачи:",
+            color=0x3498db
+        )
+        view = RoleSelectView(interaction.guild, "bulk")
+        await interaction.response.edit_message(embed=embed, view=view)
+
+class MembersPanelView(StatelessView):
+    def __init__(self):
+        super().__init__()
+        self.add_item(MembersBulkButton())
+
 class MainPanelView(View):
     def __init__(self):
         super().__init__(timeout=None)
     
     @discord.ui.button(label="Управление ролями", style=discord.ButtonStyle.primary, emoji="🎮", custom_id="main_roles", row=0)
+    @timed
     async def roles_button(self, interaction: discord.Interaction, button: Button):
         embed = discord.Embed(
             title="🎮 Управление ролями",
@@ -1056,6 +3040,7 @@ class MainPanelView(View):
         await interaction.response.send_message(embed=embed, view=view, ephemeral=True)
     
     @discord.ui.button(label="Управление участниками", style=discord.ButtonStyle.secondary, emoji="👥", custom_id="main_members", row=0)
+    @timed
     async def members_button(self, interaction: discord.Interaction, button: Button):
         embed = discord.Embed(
             title="👥 Управление участниками",
@@ -1071,24 +3056,21 @@ class MainPanelView(View):
         
         embed.add_field(
             name="🎭 Массовая выдача ролей",
-            value="Выдача ролей нескольким участникам",
+            value="Выдача роли всем участникам, подходящим под фильтр",
             inline=True
         )
         
-        embed.add_field(
-            name="🔄 В разработке",
-            value="Дополнительные функции скоро будут добавлены",
-            inline=False
-        )
-        
-        await interaction.response.send_message(embed=embed, ephemeral=True)
+        view = MembersPanelView()
+        await interaction.response.send_message(embed=embed, view=view, ephemeral=True)
     
     @discord.ui.button(label="Склад", style=discord.ButtonStyle.success, emoji="📦", custom_id="main_storage", row=1)
+    @timed
     async def storage_button(self, interaction: discord.Interaction, button: Button):
         view = StorageMainView()
         await view.show_storage(interaction)
     
     @discord.ui.button(label="О системе", style=discord.ButtonStyle.danger, emoji="ℹ️", custom_id="main_about", row=1)
+    @timed
     async def about_button(self, interaction: discord.Interaction, button: Button):
         embed = discord.Embed(
             title="ℹ️ О системе Multi Bot",
@@ -1104,13 +3086,23 @@ class MainPanelView(View):
         
         embed.add_field(
             name="📊 Статистика",
-            value=f"• Серверов: {len(bot.guilds)}\n• Задержка: {round(bot.latency * 1000)}мс",
+            value=f"• Серверов: {len(bot.guilds)}\n• Задержка: {round(bot.latency * 1000)}мс\n• Шардов: {bot.shard_count}",
             inline=True
         )
         
+        shards = bot.shard_stats()
+        lines = [
+            f"{'🟢' if shard['connected'] else '🔴'} #{shard['id']}: "
+            f"{shard['latency_ms'] if shard['latency_ms'] is not None else '—'}мс, серверов: {shard['guilds']}"
+            for shard in shards[:15]
+        ]
+        if len(shards) > 15:
+            lines.append(f"... и еще {len(shards) - 15}")
+        embed.add_field(name="🧩 Шарды", value="\n".join(lines) or "Нет подключенных шардов", inline=False)
+        
         embed.add_field(
             name="🔧 Технологии",
-            value="• Python 3.11\n• Discord.py\n• SQLite3\n• Flask",
+            value="• Python 3.11\n• Discord.py\n• SQLite3\n• aiohttp",
             inline=False
         )
         
@@ -1128,53 +3120,228 @@ intents = discord.Intents.default()
 intents.message_content = True
 intents.members = True
 
-bot = commands.Bot(command_prefix='!', intents=intents)
+# Кэш сообщений боту не нужен: команды приходят событиями, удаление идет по id. 0 - кэш выключен
+MAX_MESSAGES = int(os.environ.get("MAX_MESSAGES", 0)) or None
+# Кэш участников: joined - участники сервера без голосовых состояний, all - как по умолчанию в discord.py,
+# none - без кэша (массовая выдача ролей тогда не видит участников)
+MEMBER_CACHE = os.environ.get("MEMBER_CACHE", "joined")
+MEMBER_CACHE_FLAGS = {
+    "all": discord.MemberCacheFlags.from_intents(intents),
+    "joined": discord.MemberCacheFlags(voice=False, joined=True),
+    "none": discord.MemberCacheFlags.none(),
+}[MEMBER_CACHE]
+
+def parse_shard_ids(spec: str) -> Optional[List[int]]:
+    """'0-3,8' -> [0, 1, 2, 3, 8]; пустая строка - все шарды"""
+    shard_ids = []
+    for part in filter(None, (p.strip() for p in spec.split(','))):
+        start, _, end = part.partition('-')
+        shard_ids.extend(range(int(start), int(end or start) + 1))
+    return shard_ids or None
+
+# Без SHARD_COUNT число шардов рекомендует Discord; SHARD_IDS задает диапазон для этого процесса
+SHARD_COUNT = int(os.environ["SHARD_COUNT"]) if os.environ.get("SHARD_COUNT") else None
+SHARD_IDS = parse_shard_ids(os.environ.get("SHARD_IDS", ""))
+
+if SHARD_IDS and not SHARD_COUNT:
+    raise ValueError("❌ SHARD_IDS требует SHARD_COUNT!")
+
+def shard_filter(column: str = 'server_id') -> str:
+    """Условие SQL на строки серверов из шардов этого процесса; пусто, если процесс держит все шарды.
+    Несколько процессов делят одну базу - без фильтра при старте каждый подхватил бы чужие задания"""
+    if not SHARD_IDS:
+        return ""
+    # shard_id = (guild_id >> 22) % shard_count; строки без сервера (ЛС) обслуживает шард 0
+    return f"AND (COALESCE({column}, 0) >> 22) % {SHARD_COUNT} IN ({', '.join(map(str, SHARD_IDS))})"
+
+class MultiBot(commands.AutoShardedBot):
+    async def setup_hook(self):
+        # Индекс кодов должен быть готов до первого события шлюза
+        await role_link_system.load_index()
+        role_link_system.counters.flush_loop.start()
+        role_link_system.sweep_loop.start()
+        await cleanup.start()
+        await moderation.start()
+        self.loop_lag_task = asyncio.create_task(monitor_loop_lag())
+        
+        # Постоянные кнопки регистрируем один раз, а не в on_ready после каждого переподключения
+        self.add_view(PermanentRoleView())
+        self.add_view(MainPanelView())
+        
+        # Обработчики компонентов без состояния: находят кнопку по шаблону custom_id, в том числе после перезапуска
+        self.add_dynamic_items(
+            LinkActionButton, LinksPageButton, RoleSelectMenu, RolePageButton, BulkStartButton, LinkSettingsButton,
+            QuickLinkButton, StorageButton, StoragePageButton, ResourceSelectMenu, ResourcePageButton, ResourceActionButton,
+            MembersBulkButton
+        )
+        
+        # Railway останавливает контейнер через SIGTERM - закрываемся штатно, чтобы сбросить буферы
+        try:
+            asyncio.get_running_loop().add_signal_handler(signal.SIGTERM, lambda: asyncio.create_task(self.close()))
+        except NotImplementedError:
+            pass
+    
+    async def close(self):
+        # Сначала останавливаем всё, что пишет в базу: main() закрывает ее потоки сразу после close()
+        # Прерванная запись счетчиков все равно завершится в потоке записи, финальный flush встанет за ней
+        loops = (role_link_system.sweep_loop, role_link_system.counters.flush_loop)
+        for loop in loops:
+            loop.cancel()
+        await cancel_tasks([loop.get_task() for loop in loops] + [getattr(self, 'loop_lag_task', None)])
+        await cleanup.stop()
+        await moderation.stop()
+        await bulk_roles.stop()
+        await mod_log.flush_all()
+        await super().close()
+        await role_link_system.counters.flush()
+        await oauth.close()
+    
+    def shard_stats(self) -> List[dict]:
+        """Задержка, состояние и число серверов по каждому шарду этого процесса"""
+        guilds: Dict[int, int] = {}
+        for guild in self.guilds:
+            guilds[guild.shard_id] = guilds.get(guild.shard_id, 0) + 1
+        stats = []
+        for shard_id, shard in sorted(self.shards.items()):
+            latency = shard.latency
+            stats.append({
+                "id": shard_id,
+                "connected": not shard.is_closed(),
+                "latency_ms": round(latency * 1000) if math.isfinite(latency) else None,
+                "guilds": guilds.get(shard_id, 0)
+            })
+        return stats
+    
+    def forget_shard(self, shard_id: int):
+        """Сбросить кэши, собранные из событий шлюза, для серверов шарда"""
+        for guild in self.guilds:
+            if guild.shard_id == shard_id:
+                role_index.forget_guild(guild.id)
+                mod_log.invalidate(guild.id)
+
+bot = MultiBot(
+    command_prefix='!',
+    intents=intents,
+    shard_count=SHARD_COUNT,
+    shard_ids=SHARD_IDS,
+    chunk_guilds_at_startup=CHUNK_AT_STARTUP and MEMBER_CACHE != "none",
+    max_messages=MAX_MESSAGES,
+    member_cache_flags=MEMBER_CACHE_FLAGS,
+    # Статус уходит вместе с IDENTIFY - отдельный change_presence не нужен
+    activity=discord.Activity(type=discord.ActivityType.watching, name="за сервером")
+)
+
+@bot.before_invoke
+async def start_command_timer(ctx: commands.Context):
+    ctx.started_at = time.perf_counter()
+
+@bot.after_invoke
+async def stop_command_timer(ctx: commands.Context):
+    metrics.handlers.observe(time.perf_counter() - ctx.started_at, f"command.{ctx.command.qualified_name}")
+
+metrics.gauge('bot_role_queue_depth', 'Изменения ролей в очереди', lambda: role_queue.depth())
+metrics.counter('bot_role_edits_applied', 'Применено изменений ролей', lambda: role_queue.applied)
+metrics.counter('bot_role_edits_coalesced', 'Изменений ролей объединено в очереди', lambda: role_queue.coalesced)
+metrics.counter('bot_role_edits_retried', 'Повторов после ошибок API', lambda: role_queue.retried)
+metrics.counter('bot_role_edits_failed', 'Изменений ролей с ошибкой', lambda: role_queue.failed)
+metrics.counter('bot_storage_cache_hits', 'Попадания в кэш склада', lambda: storage_system.cache.hits)
+metrics.counter('bot_storage_cache_misses', 'Промахи кэша склада', lambda: storage_system.cache.misses)
+metrics.gauge('bot_link_counter_pending', 'Использования ссылок, ожидающие записи', lambda: role_link_system.counters.pending_events)
+metrics.counter('bot_link_counter_commits', 'Пакетных записей счетчиков ссылок', lambda: role_link_system.counters.commits)
+metrics.gauge('bot_pending_deletions', 'Сообщения, ожидающие удаления', lambda: len(cleanup.heap))
+metrics.counter('bot_log_records_dropped', 'Записи лога, отброшенные при переполнении очереди', lambda: log_handler.dropped)
+metrics.gauge('bot_mod_log_pending', 'Баны, ожидающие записи в журнал', lambda: sum(map(len, mod_log.pending.values())))
+metrics.counter('bot_mod_log_messages', 'Отправлено сводок в журнал модерации', lambda: mod_log.messages_sent)
+metrics.counter('bot_bans_processed', 'Выполнено банов при выходе', lambda: moderation.processed)
+metrics.gauge('bot_bans_pending', 'Баны в очереди модерации', lambda: len(moderation.pending))
+metrics.gauge('bot_bans_failed', 'Баны, завершившиеся ошибкой', lambda: moderation.failed)
+metrics.counter('bot_interactions_executed', 'Нажатий, выполненных полностью', lambda: interaction_dedup.executed)
+metrics.counter('bot_interactions_coalesced', 'Нажатий, дождавшихся одинакового выполняющегося', lambda: interaction_dedup.coalesced)
+metrics.counter('bot_interactions_cached', 'Повторных нажатий, получивших готовый результат', lambda: interaction_dedup.cached)
+metrics.counter('bot_interactions_saved', 'Выполнений, сэкономленных склейкой нажатий', lambda: interaction_dedup.saved)
+metrics.gauge('bot_guilds_unchunked', 'Серверы, участники которых еще не загружены', lambda: member_chunker.unchunked())
+metrics.counter('bot_guild_chunks_on_demand', 'Загрузок участников по первому обращению', lambda: member_chunker.on_demand)
+metrics.counter('bot_guild_chunks_background', 'Фоновых загрузок участников', lambda: member_chunker.background)
+metrics.gauge('bot_guilds', 'Подключенные серверы', lambda: len(bot.guilds))
 
 # ========== ОБРАБОТЧИКИ СОБЫТИЙ ==========
 
 @bot.event
+@timed
 async def on_ready():
-    print(f'🎉 Бот {bot.user} запущен!')
-    print(f'📊 Подключен к {len(bot.guilds)} серверам')
-    
-    # Регистрируем постоянные кнопки
-    bot.add_view(PermanentRoleView())
-    bot.add_view(MainPanelView())
-    bot.add_view(StorageMainView())
+    log.info('🎉 Бот %s запущен! Подключен к %s серверам', bot.user, len(bot.guilds), extra=log_extra('on_ready'))
     
-    # Устанавливаем статус
-    activity = discord.Activity(type=discord.ActivityType.watching, name="за сервером")
-    await bot.change_presence(activity=activity)
+    # Продолжаем массовые выдачи, прерванные перезапуском (уже идущие повторно не запускаются)
+    await bulk_roles.resume()
+    # Участников догружаем фоном, не задерживая готовность
+    member_chunker.start()
+
+@bot.event
+@timed
+async def on_shard_ready(shard_id):
+    # После новой сессии (не resume) события, пропущенные шардом, не придут - кэши ролей и каналов строим заново
+    bot.forget_shard(shard_id)
+    log.info('🧩 Шард %s готов', shard_id, extra=log_extra('on_shard_ready'))
+
+@bot.event
+@timed
+async def on_shard_disconnect(shard_id):
+    log.warning('🧩 Шард %s отключен', shard_id, extra=log_extra('on_shard_disconnect'))
 
 @bot.event
-async def on_member_remove(member):
+@timed
+async def on_shard_resumed(shard_id):
+    log.info('🧩 Шард %s восстановил сессию', shard_id, extra=log_extra('on_shard_resumed'))
+
+@bot.event
+@timed
+async def on_guild_role_create(role):
+    role_index.add(role)
+
+@bot.event
+@timed
+async def on_guild_role_update(before, after):
+    role_index.update(before, after)
+
+@bot.event
+@timed
+async def on_guild_role_delete(role):
+    role_index.remove(role)
+
+@bot.event
+@timed
+async def on_guild_remove(guild):
+    role_index.forget_guild(guild.id)
+    mod_log.invalidate(guild.id)
+
+@bot.event
+@timed
+async def on_guild_channel_create(channel):
+    if isinstance(channel, discord.TextChannel):
+        mod_log.invalidate(channel.guild.id)
+
+@bot.event
+@timed
+async def on_guild_channel_update(before, after):
+    if isinstance(after, discord.TextChannel) and before.name != after.name:
+        mod_log.invalidate(after.guild.id)
+
+@bot.event
+@timed
+async def on_guild_channel_delete(channel):
+    if isinstance(channel, discord.TextChannel):
+        mod_log.invalidate(channel.guild.id)
+
+@bot.event
+@timed
+async def on_raw_member_remove(payload: discord.RawMemberRemoveEvent):
     """Автоматический бан при выходе пользователя"""
+    # Raw-событие приходит и для участников, которых нет в кэше: сервер мог быть еще не загружен
+    # загрузчиком участников, а при MEMBER_CACHE=none кэша нет совсем
     try:
-        # Баним всех, кто покидает сервер
-        try:
-            await member.ban(reason="Автоматический бан при выходе")
-            print(f"🔨 Пользователь {member} забанен при выходе")
-            
-            # Логируем в канал
-            log_channel = discord.utils.get(member.guild.text_channels, name="логи")
-            if log_channel:
-                embed = discord.Embed(
-                    title="🔨 Автоматический бан",
-                    description=f"Пользователь **{member}** забанен при выходе",
-                    color=0xff0000,
-                    timestamp=datetime.now()
-                )
-                embed.add_field(name="ID", value=member.id, inline=True)
-                embed.add_field(name="Причина", value="Автоматический бан при выходе", inline=True)
-                await log_channel.send(embed=embed)
-                
-        except discord.Forbidden:
-            print(f"❌ Нет прав для бана пользователя {member}")
-        except discord.HTTPException as e:
-            print(f"❌ Ошибка при бане пользователя {member}: {e}")
-                
-    except Exception as e:
-        print(f"Ошибка в автобане: {e}")
+        await moderation.submit(payload.guild_id, payload.user)
+    except Exception:
+        log.exception("Ошибка в автобане", extra=log_extra('on_raw_member_remove', payload.guild_id, payload.user))
 
 # ========== КОМАНДЫ ДЛЯ СОЗДАНИЯ ПАНЕЛЕЙ ==========
 
@@ -1207,6 +3374,11 @@ async def создать_панель(ctx):
         value="Инструкция по использованию", 
         inline=True
     )
+    embed.add_field(
+        name="🎫 ВВЕСТИ КОД", 
+        value="Получить роль по коду команды", 
+        inline=True
+    )
     
     view = PermanentRoleView()
     message = await ctx.send(embed=embed, view=view)
@@ -1310,57 +3482,325 @@ async def роль(ctx, код: str = None):
     """Получить роль по коду команды (секретно)"""
     if not код:
         # Секретное сообщение, которое удалится сразу
-        message = await ctx.send("❌ Укажите код команды: `!роль КОД`")
-        await asyncio.sleep(5)
-        await ctx.message.delete()
-        await message.delete()
+        message = await ctx.send("❌ Укажите код команды: `/роль КОД` или `!роль КОД`")
+        await cleanup.schedule(ctx.message, 5)
+        await cleanup.schedule(message, 5)
         return
     
     # Сразу удаляем команду пользователя
     await ctx.message.delete()
     
-    result = role_link_system.use_role_link(код, ctx.guild.id)
+    text = await redeem_role_code(ctx.guild, ctx.author, код, 'роль', wait=True)
     
-    if result["success"]:
-        role_id = result["role_id"]
-        role = ctx.guild.get_role(role_id)
-        
-        if role:
-            try:
-                if role in ctx.author.roles:
-                    await ctx.author.remove_roles(role)
-                    # Отправляем секретное сообщение в ЛС
-                    try:
-                        await ctx.author.send(f"✅ Роль **{role.name}** убрана!")
-                    except:
-                        # Если ЛС закрыты, отправляем временное сообщение в чат
-                        message = await ctx.send(f"✅ {ctx.author.mention}, роль **{role.name}** убрана!", delete_after=5)
-                else:
-                    await ctx.author.add_roles(role)
-                    # Отправляем секретное сообщение в ЛС
-                    try:
-                        await ctx.author.send(f"✅ Роль **{role.name}** выдана!")
-                    except:
-                        # Если ЛС закрыты, отправляем временное сообщение в чат
-                        message = await ctx.send(f"✅ {ctx.author.mention}, роль **{role.name}** выдана!", delete_after=5)
-                
-            except discord.Forbidden:
-                try:
-                    await ctx.author.send("❌ У бота нет прав для выдачи ролей")
-                except:
-                    message = await ctx.send("❌ У бота нет прав для выдачи ролей", delete_after=5)
-        else:
-            try:
-                await ctx.author.send("❌ Роль не найдена на сервере")
-            except:
-                message = await ctx.send("❌ Роль не найдена на сервере", delete_after=5)
+    # Отправляем секретное сообщение в ЛС
+    try:
+        await ctx.author.send(text)
+    except:
+        # Если ЛС закрыты, отправляем временное сообщение в чат
+        await cleanup.schedule(await ctx.send(f"{ctx.author.mention}, {text}"), 5)
+
+@bot.tree.command(name="роль", description="Получить роль по коду команды")
+@app_commands.describe(код="Код команды")
+@app_commands.guild_only()
+@timed
+async def роль_slash(interaction: discord.Interaction, код: str):
+    # Один эфемерный ответ на взаимодействие вместо удаления, ЛС и запасного сообщения в чат
+    text = await redeem_role_code(interaction.guild, interaction.user, код.strip(), 'роль_slash')
+    await interaction.response.send_message(text, ephemeral=True)
+
+@bot.command()
+@commands.has_permissions(administrator=True)
+async def синхронизировать(ctx, область: str = None):
+    """Зарегистрировать слеш-команды: глобально или мгновенно для этого сервера (!синхронизировать сервер)"""
+    if область == "сервер":
+        bot.tree.copy_global_to(guild=ctx.guild)
+        synced = await bot.tree.sync(guild=ctx.guild)
+    else:
+        synced = await bot.tree.sync()
+    await cleanup.schedule(await ctx.send(f"✅ Синхронизировано слеш-команд: {len(synced)}"), 10)
+
+# ========== ОТЧЕТ О ПАМЯТИ ==========
+# Число кадров стека для tracemalloc; 0 - трассировка выключена (она замедляет выделение памяти)
+MEMORY_TRACE_FRAMES = int(os.environ.get("MEMORY_TRACE_FRAMES", 0))
+MEMORY_SAMPLE_SIZE = 200
+
+if MEMORY_TRACE_FRAMES:
+    tracemalloc.start(MEMORY_TRACE_FRAMES)
+
+# Общие объекты, на которые ссылаются все элементы кэшей - их размер к элементу не относится
+MEMORY_SHARED_TYPES = (
+    discord.Client, discord.Guild, discord.abc.GuildChannel, discord.Role, asyncio.AbstractEventLoop,
+    type, types.ModuleType, types.FunctionType, types.MethodType
+)
+
+def approx_bytes(obj, seen: set, depth: int = 0) -> int:
+    """Размер объекта вместе с содержимым; в общие объекты discord не спускаемся"""
+    if id(obj) in seen or (depth and isinstance(obj, MEMORY_SHARED_TYPES)) or type(obj).__name__ == 'ConnectionState':
+        return 0
+    seen.add(id(obj))
+    size = sys.getsizeof(obj)
+    if depth >= 6 or isinstance(obj, (str, bytes, int, float)):
+        return size
+    
+    if isinstance(obj, dict):
+        children = itertools.chain(obj.keys(), obj.values())
+    elif isinstance(obj, (list, tuple, set, frozenset, deque)):
+        children = obj
+    else:
+        # Объекты discord.py хранят поля в __slots__, объекты бота - в __dict__
+        slots = set()
+        for cls in type(obj).__mro__:
+            names = cls.__dict__.get('__slots__', ())
+            slots.update((names,) if isinstance(names, str) else names)
+        children = [getattr(obj, slot, None) for slot in slots if slot not in ('__dict__', '__weakref__')]
+        if hasattr(obj, '__dict__'):
+            children.append(obj.__dict__)
+    return size + sum(approx_bytes(child, seen, depth + 1) for child in children)
+
+def estimate_cache(items, count: int) -> Tuple[int, int]:
+    """(число объектов, примерный размер в байтах) по выборке из первых MEMORY_SAMPLE_SIZE объектов"""
+    sample = list(itertools.islice(items, MEMORY_SAMPLE_SIZE))
+    if not sample:
+        return count, 0
+    seen: set = set()
+    sampled = sum(approx_bytes(item, seen) for item in sample)
+    return count, sampled * count // len(sample)
+
+def memory_report(top: int = 10) -> dict:
+    """Объекты и примерный размер по кэшам, RSS процесса и главные места выделения памяти"""
+    members = sum(len(guild.members) for guild in bot.guilds)
+    caches = {
+        # Кэши discord.py
+        "discord.messages": estimate_cache(iter(bot.cached_messages), len(bot.cached_messages)),
+        "discord.members": estimate_cache(itertools.chain.from_iterable(guild.members for guild in bot.guilds), members),
+        "discord.users": estimate_cache(iter(bot.users), len(bot.users)),
+        "discord.guilds": (len(bot.guilds), 0),
+        "discord.persistent_views": (len(bot.persistent_views), 0),
+        # Кэши бота
+        "role_links.index": estimate_cache(iter(role_link_system.index.values()), len(role_link_system.index)),
+        "role_links.expiry_heap": estimate_cache(iter(role_link_system.expiry_heap), len(role_link_system.expiry_heap)),
+        "storage.pages": estimate_cache(itertools.chain.from_iterable(entries.items() for entries in storage_system.cache._guilds.values()), len(storage_system.cache)),
+        "storage.aggregates": estimate_cache(iter(storage_system.aggregates.values()), len(storage_system.aggregates)),
+        "role_index": estimate_cache(itertools.chain.from_iterable(role_index._guilds.values()), len(role_index)),
+        "role_queue.pending": estimate_cache(iter(role_queue.pending.values()), role_queue.depth()),
+        "moderation.pending": estimate_cache(iter(moderation.pending.values()), len(moderation.pending)),
+        "mod_log.pending": estimate_cache(itertools.chain.from_iterable(mod_log.pending.values()), sum(map(len, mod_log.pending.values()))),
+        "interaction_dedup.results": estimate_cache(iter(interaction_dedup.results.items()), len(interaction_dedup.results)),
+        "cleanup.heap": estimate_cache(iter(cleanup.heap), len(cleanup.heap)),
+    }
+    
+    rss = None
+    try:
+        with open('/proc/self/status') as status:
+            rss = next(int(line.split()[1]) * 1024 for line in status if line.startswith('VmRSS:'))
+    except (OSError, StopIteration):
+        pass
+    
+    allocations = []
+    if tracemalloc.is_tracing():
+        for stat in tracemalloc.take_snapshot().statistics('lineno')[:top]:
+            frame = stat.traceback[0]
+            allocations.append((f"{os.path.basename(frame.filename)}:{frame.lineno}", stat.size, stat.count))
+    
+    return {"rss": rss, "caches": caches, "allocations": allocations, "tracing": tracemalloc.is_tracing()}
+
+def format_bytes(size: Optional[int]) -> str:
+    if size is None:
+        return "—"
+    for unit in ("Б", "КБ", "МБ"):
+        if size < 1024:
+            return f"{size:.0f} {unit}"
+        size /= 1024
+    return f"{size:.1f} ГБ"
+
+@bot.command()
+@commands.has_permissions(administrator=True)
+async def память(ctx, режим: str = None):
+    """Отчет о памяти: объекты и размер кэшей, RSS, главные выделения (!память трассировка - включить tracemalloc)"""
+    if режим == "трассировка" and not tracemalloc.is_tracing():
+        tracemalloc.start(MEMORY_TRACE_FRAMES or 1)
+        await ctx.send("🔬 Трассировка памяти включена - повторите `!память` через некоторое время")
+        return
+    
+    # Считаем в цикле событий: обход из потока мог бы застать кэши во время изменения
+    report = memory_report()
+    
+    embed = discord.Embed(
+        title="🧠 Память бота",
+        description=f"RSS процесса: **{format_bytes(report['rss'])}**",
+        color=0x5865F2,
+        timestamp=datetime.now()
+    )
+    
+    for prefix, title in (("discord.", "📦 Кэши discord.py"), ("", "🗂️ Кэши бота")):
+        lines = [
+            f"`{name.removeprefix(prefix)}`: {count} (~{format_bytes(size)})"
+            for name, (count, size) in report["caches"].items()
+            if name.startswith("discord.") == bool(prefix)
+        ]
+        embed.add_field(name=title, value="\n".join(lines), inline=False)
+    
+    embed.add_field(
+        name="⚙️ Настройки",
+        value=f"max_messages: {MAX_MESSAGES or 'выключен'}\nКэш участников: {MEMBER_CACHE}\n"
+              f"Склад: {STORAGE_CACHE_GUILDS} серв. × {STORAGE_CACHE_KEYS_PER_GUILD} страниц\nИндекс ролей: {ROLE_INDEX_GUILDS} серв.",
+        inline=False
+    )
+    
+    if report["allocations"]:
+        lines = [f"{size // 1024:>7} КБ {count:>6}  {place}" for place, size, count in report["allocations"]]
+        embed.add_field(name="🔬 Топ выделений (tracemalloc)", value="```" + "\n".join(lines)[:1000] + "```", inline=False)
     else:
+        embed.add_field(name="🔬 Топ выделений", value="Трассировка выключена: `!память трассировка` или MEMORY_TRACE_FRAMES", inline=False)
+    
+    await ctx.send(embed=embed)
+
+# ========== ВЕБ-СЕРВЕР ==========
+# HTTP работает в том же цикле событий, что и бот, - без отдельного потока
+routes = web.RouteTableDef()
+
+@web.middleware
+async def error_middleware(request: web.Request, handler):
+    try:
+        return await handler(request)
+    except web.HTTPNotFound:
+        return web.Response(text="🔍 Page Not Found", status=404)
+    except web.HTTPException:
+        raise
+    except Exception:
+        log.exception("Ошибка HTTP %s", request.path, extra=log_extra('http'))
+        return web.Response(text="❌ Internal Server Error", status=500)
+
+@routes.get('/')
+async def home(request: web.Request):
+    return web.Response(text="🟢 Multi Bot System Online")
+
+@routes.get('/healthz')
+async def healthz(request: web.Request):
+    """Состояние шлюза и доступность базы данных"""
+    try:
+        await asyncio.wait_for(db.fetchone('SELECT 1'), timeout=2)
+        db_ok = True
+    except Exception:
+        db_ok = False
+    
+    latency = bot.latency
+    gateway_ok = bot.is_ready() and not bot.is_closed() and math.isfinite(latency)
+    
+    return web.json_response({
+        "status": "ok" if db_ok and gateway_ok else "degraded",
+        "gateway": {
+            "connected": gateway_ok,
+            "latency_ms": round(latency * 1000) if math.isfinite(latency) else None,
+            "guilds": len(bot.guilds),
+            "shard_count": bot.shard_count,
+            "shards": bot.shard_stats()
+        },
+        "database": {"reachable": db_ok},
+        "moderation": moderation.stats()
+    }, status=200 if db_ok and gateway_ok else 503)
+
+@routes.get('/readyz')
+async def readyz(request: web.Request):
+    """Готовность принимать трафик: шлюз подключен и кэш серверов загружен"""
+    if bot.is_ready() and not bot.is_closed():
+        return web.Response(text="ready")
+    return web.Response(text="not ready", status=503)
+
+@routes.get('/metrics')
+async def metrics_endpoint(request: web.Request):
+    """Метрики в текстовом формате Prometheus"""
+    return web.Response(text=metrics.render(), headers={'Content-Type': 'text/plain; version=0.0.4; charset=utf-8'})
+
+OAUTH_STATE_COOKIE = 'role_oauth_state'
+
+@routes.get('/role/{code}')
+async def redeem_link(request: web.Request):
+    """Ссылка на роль: проверяем код и отправляем на авторизацию Discord"""
+    link_code = request.match_info['code']
+    if not oauth.enabled:
+        return web.Response(text=f"Используйте команду в Discord: !роль {link_code}", status=404)
+    
+    entry = role_link_system.index.get(link_code)
+    if entry is None:
+        return web.Response(text="❌ Ссылка не найдена", status=404)
+    
+    # Nonce в cookie и в state защищает callback от подделки запроса
+    nonce = secrets.token_urlsafe(16)
+    response = web.HTTPFound(oauth.authorize_url(f"{nonce}.{link_code}"))
+    response.set_cookie(OAUTH_STATE_COOKIE, nonce, max_age=600, httponly=True, secure=oauth.redirect_uri.startswith('https'))
+    raise response
+
+@routes.get('/oauth/callback')
+async def oauth_callback(request: web.Request):
+    """Возврат с авторизации Discord: гасим код и ставим выдачу роли в очередь"""
+    state = request.query.get('state', '')
+    nonce, _, link_code = state.partition('.')
+    if not nonce or not secrets.compare_digest(nonce, request.cookies.get(OAUTH_STATE_COOKIE, '')):
+        return web.Response(text="❌ Сессия авторизации устарела, откройте ссылку заново", status=400)
+    if 'code' not in request.query:
+        return web.Response(text="❌ Авторизация отменена", status=400)
+    
+    entry = role_link_system.index.get(link_code)
+    guild = bot.get_guild(entry.server_id) if entry else None
+    if guild is None:
+        return web.Response(text="❌ Ссылка не найдена", status=404)
+    
+    try:
+        user_id = await oauth.fetch_user_id(request.query['code'])
+    except aiohttp.ClientError:
+        return web.Response(text="❌ Не удалось подтвердить аккаунт Discord", status=502)
+    
+    # Участие в сервере проверяем до погашения, чтобы не тратить использование
+    member = guild.get_member(user_id)
+    if member is None:
         try:
-            await ctx.author.send(f"❌ {result['error']}")
-        except:
-            message = await ctx.send(f"❌ {result['error']}", delete_after=5)
+            member = await guild.fetch_member(user_id)
+        except discord.NotFound:
+            return web.Response(text="❌ Вы не состоите на этом сервере", status=403)
+    
+    # По ссылке роль только выдается: уже выданная роль не тратит использование
+    role = guild.get_role(entry.role_id)
+    if role is not None and role in member.roles:
+        return web.Response(text=f"✅ Роль {role.name} у вас уже есть")
+    
+    role, error = await claim_role_code(guild, member, link_code, 'oauth_callback')
+    if role is None:
+        return web.Response(text=error, status=410)
+    
+    role_queue.submit(member, role)
+    
+    response = web.Response(text=f"✅ Роль {role.name} выдана на сервере {guild.name}! Можно закрыть эту вкладку.")
+    response.del_cookie(OAUTH_STATE_COOKIE)
+    return response
+
+def create_web_app() -> web.Application:
+    app = web.Application(middlewares=[error_middleware])
+    app.add_routes(routes)
+    return app
+
+async def start_web_server() -> web.AppRunner:
+    runner = web.AppRunner(create_web_app(), access_log=None)
+    await runner.setup()
+    await web.TCPSite(runner, '0.0.0.0', port).start()
+    return runner
 
 # ========== ЗАПУСК ПРИЛОЖЕНИЯ ==========
+async def main():
+    runner = None
+    try:
+        async with bot:
+            # HTTP-сервер поднимается параллельно с логином в шлюз
+            runner, _ = await asyncio.gather(start_web_server(), bot.login(TOKEN))
+            await bot.connect()
+    finally:
+        if runner:
+            await runner.cleanup()
+        db.close()
+        log_listener.stop()
+
 if __name__ == "__main__":
-    keep_alive()
-    bot.run(TOKEN)
+    try:
+        asyncio.run(main())
+    except KeyboardInterrupt:
+        pass
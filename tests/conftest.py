@@ -0,0 +1,8 @@
+import os
+import sys
+import tempfile
+
+# bot.py читает настройки при импорте: токен-заглушка и база во временном каталоге
+os.environ.setdefault('DISCORD_TOKEN', 'test')
+os.environ['DB_PATH'] = os.path.join(tempfile.mkdtemp(prefix='multibot-'), 'test.db')
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
@@ -0,0 +1,71 @@
+import asyncio
+import time
+
+import bot
+
+# Медленный fsync: каждая запись в SQLite держит поток 20 мс
+SLOW_COMMIT = 0.02
+REDEMPTIONS = 25
+
+
+def p99(samples: list) -> float:
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * 0.99))]
+
+
+async def interaction_latencies(load) -> list:
+    """Насколько позже срока отвечает «взаимодействие» (таймер на 1 мс), пока идет нагрузка"""
+    latencies = []
+    stop = asyncio.Event()
+    
+    async def interaction():
+        while not stop.is_set():
+            started = time.perf_counter()
+            await asyncio.sleep(0.001)
+            latencies.append(time.perf_counter() - started - 0.001)
+    
+    task = asyncio.create_task(interaction())
+    await load()
+    stop.set()
+    await task
+    return latencies
+
+
+def test_slow_commits_do_not_block_the_event_loop(monkeypatch):
+    """p99 задержки взаимодействий под одновременными !роль: запись в цикле событий (как было) и через поток записи"""
+    write = bot.db._write
+    
+    def slow_write(fn):
+        time.sleep(SLOW_COMMIT)
+        return write(fn)
+    
+    monkeypatch.setattr(bot.db, '_write', slow_write)
+    
+    async def scenario():
+        system = bot.role_link_system
+        code = await system.create_role_link(10, 2, 'роль', 3, 'админ')
+        link_id = system.index[code].id
+        bump = 'UPDATE role_links SET uses_count = uses_count + 1 WHERE id = ?'
+        
+        async def blocking_load():
+            # Прежняя схема: commit на каждое погашение прямо в цикле событий
+            for _ in range(REDEMPTIONS):
+                await system.use_role_link(code, 10)
+                bot.db._write(lambda conn: conn.execute(bump, (link_id,)))
+                await asyncio.sleep(0)
+        
+        async def async_load():
+            async def redeem():
+                await system.use_role_link(code, 10)
+                await bot.db.execute(bump, (link_id,))
+                await system.get_active_links(10)
+            await asyncio.gather(*(redeem() for _ in range(REDEMPTIONS)))
+        
+        return await interaction_latencies(blocking_load), await interaction_latencies(async_load)
+    
+    blocking, non_blocking = asyncio.run(scenario())
+    print(f"\np99 задержки взаимодействия: в цикле событий {p99(blocking) * 1000:.1f} мс, "
+          f"через поток записи {p99(non_blocking) * 1000:.1f} мс")
+    
+    assert p99(blocking) >= SLOW_COMMIT * 0.9
+    assert p99(non_blocking) < SLOW_COMMIT / 2
@@ -0,0 +1,57 @@
+import asyncio
+
+import pytest
+
+import bot
+
+
+@pytest.fixture
+def recorded_queries(monkeypatch):
+    """Запросы, которые методы реально отправляют в базу: (sql, параметры)"""
+    queries = []
+    for name in ('fetchall', 'fetchone', 'execute'):
+        original = getattr(bot.db, name)
+        
+        def record(sql, params=(), original=original):
+            queries.append((sql, params))
+            return original(sql, params)
+        
+        monkeypatch.setattr(bot.db, name, record)
+    return queries
+
+
+def query_plan(sql: str, params: tuple) -> list:
+    return [row[3] for row in bot.db.conn.execute('EXPLAIN QUERY PLAN ' + sql, params)]
+
+
+def test_hot_queries_use_indexes(recorded_queries):
+    """Страницы ссылок и склада, обновление и удаление ресурса - поиск по индексу без временного B-дерева"""
+    async def scenario():
+        links = bot.role_link_system
+        await links.get_active_links(1)
+        await links.get_active_links(1, after=('2026-01-01 00:00:00', 5))
+        await links.get_active_links(1, before=('2026-01-01 00:00:00', 5))
+        await links.get_active_links(1, start=('2026-01-01 00:00:00', 5))
+        # Исчерпанная, но еще не деактивированная ссылка исключается прямо в запросе
+        code = await links.create_role_link(1, 2, 'роль', 3, 'админ', uses_limit=1)
+        await links.use_role_link(code, 1)
+        await links.get_active_links(1)
+        await links.get_active_links(1, after=('2026-01-01 00:00:00', 5))
+        
+        storage = bot.storage_system
+        await storage.get_resources_page(1)
+        await storage.get_resources_page(1, after='железо')
+        await storage.get_resources_page(1, before='железо')
+        await storage.update_resource_amount(1, 'железо', 5, 2, 'админ')
+        await storage.delete_resource(1, 'железо')
+    
+    asyncio.run(scenario())
+    
+    # INSERT новой ссылки плана поиска не имеет
+    queries = [(sql, params) for sql, params in recorded_queries if not sql.lstrip().startswith('INSERT')]
+    assert len(queries) == 11
+    assert any('NOT IN' in sql for sql, _ in queries)
+    for sql, params in queries:
+        plan = query_plan(sql, params)
+        assert any(step.startswith('SEARCH') and 'USING INDEX' in step for step in plan), (sql, plan)
+        assert not any('TEMP B-TREE' in step or step.startswith('SCAN') for step in plan), (sql, plan)
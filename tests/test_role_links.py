@@ -0,0 +1,114 @@
+import asyncio
+import heapq
+import time
+from datetime import datetime, timedelta
+
+import bot
+
+
+def test_concurrent_redemptions_respect_uses_limit():
+    """2000 одновременных погашений кода на 10 использований - ровно 10 успешных"""
+    async def scenario():
+        system = bot.role_link_system
+        code = await system.create_role_link(1, 2, 'роль', 3, 'админ', uses_limit=10)
+        results = await asyncio.gather(*(system.use_role_link(code, 1) for _ in range(2000)))
+        await system.counters.flush()
+        row = await bot.db.fetchone('SELECT uses_count FROM role_links WHERE link_code = ?', (code,))
+        return results, row[0]
+    
+    results, stored = asyncio.run(scenario())
+    
+    assert sum(result["success"] for result in results) == 10
+    assert {result["error"] for result in results if not result["success"]} == {"Лимит использований исчерпан"}
+    assert stored == 10
+
+
+def test_finished_links_leave_total_and_page_before_sweep():
+    """Исчерпанная и истекшая ссылки сразу пропадают и из счетчика, и из списка - не дожидаясь очистки"""
+    async def scenario():
+        system = bot.role_link_system
+        single = await system.create_role_link(2, 2, 'роль', 3, 'админ', uses_limit=1)
+        expiring = await system.create_role_link(2, 2, 'роль', 3, 'админ', expires_hours=1)
+        kept = await system.create_role_link(2, 2, 'роль', 3, 'админ')
+        before = system.count_active_links(2)
+        
+        await system.use_role_link(single, 2)
+        system.index[expiring].expires_at = datetime.now() - timedelta(seconds=1)
+        for i, (expires_at, code) in enumerate(system.expiry_heap):
+            if code == expiring:
+                system.expiry_heap[i] = (system.index[expiring].expires_at, code)
+        heapq.heapify(system.expiry_heap)
+        
+        links, _, _ = await system.get_active_links(2)
+        after = system.count_active_links(2)
+        
+        await system.sweep()
+        rows = await bot.db.fetchall('SELECT link_code FROM role_links WHERE server_id = 2 AND is_active = TRUE')
+        return before, after, [link[0] for link in links], [row[0] for row in rows], kept
+    
+    before, after, page, stored, kept = asyncio.run(scenario())
+    
+    assert before == 3
+    assert after == 1
+    assert page == [kept]
+    assert stored == [kept]
+
+
+def test_page_skips_redeemed_links_in_sql():
+    """Пять новейших из шести ссылок исчерпаны: первая страница - единственная действующая, а не пустая"""
+    async def scenario():
+        system = bot.role_link_system
+        codes = [await system.create_role_link(3, 2, 'роль', 3, 'админ', uses_limit=1) for _ in range(6)]
+        for code in codes[1:]:
+            await system.use_role_link(code, 3)
+        page = await system.get_active_links(3)
+        return codes, page, system.count_active_links(3)
+    
+    codes, (links, has_prev, has_next), total = asyncio.run(scenario())
+    
+    assert [link[0] for link in links] == [codes[0]]
+    assert (has_prev, has_next, total) == (False, False, 1)
+
+
+def test_refresh_rereads_current_page_from_its_first_row():
+    async def scenario():
+        system = bot.role_link_system
+        codes = [await system.create_role_link(4, 2, 'роль', 3, 'админ') for _ in range(7)]
+        first, _, _ = await system.get_active_links(4, limit=3)
+        second, _, _ = await system.get_active_links(4, after=(first[-1][6], first[-1][7]), limit=3)
+        refreshed, has_prev, _ = await system.get_active_links(4, start=(second[0][6], second[0][7]), limit=3)
+        return second, refreshed, has_prev
+    
+    second, refreshed, has_prev = asyncio.run(scenario())
+    
+    assert [link[0] for link in refreshed] == [link[0] for link in second]
+    assert has_prev
+
+
+def test_counter_buffer_batches_commits():
+    """Погашения подтверждаются из памяти, а счетчики пишутся пачками по COUNTER_FLUSH_EVENTS"""
+    redemptions = 2000
+    
+    async def scenario():
+        system = bot.RoleLinkSystem()
+        codes = [await system.create_role_link(5, 2, 'роль', 3, 'админ') for _ in range(20)]
+        
+        started = time.perf_counter()
+        results = []
+        for i in range(redemptions):
+            results.append(await system.use_role_link(codes[i % len(codes)], 5))
+            # Погашения приходят отдельными событиями - буфер успевает сбрасываться в фоне
+            await asyncio.sleep(0)
+        await system.counters.flush()
+        elapsed = time.perf_counter() - started
+        
+        stored = await bot.db.fetchone('SELECT SUM(uses_count) FROM role_links WHERE server_id = 5')
+        return results, elapsed, system.counters.commits, stored[0]
+    
+    results, elapsed, commits, stored = asyncio.run(scenario())
+    print(f"\n{redemptions} погашений: {redemptions / elapsed:.0f}/с, {commits} транзакций вместо {redemptions} "
+          f"({commits / elapsed:.0f} commit/с)")
+    
+    assert all(result["success"] for result in results)
+    assert stored == redemptions
+    assert commits <= redemptions // bot.COUNTER_FLUSH_EVENTS + 1
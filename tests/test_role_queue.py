@@ -0,0 +1,68 @@
+import asyncio
+from types import SimpleNamespace
+
+import discord
+
+import bot
+
+
+class RateLimitedMember:
+    """Участник, у которого первый запрос к Discord получает 429"""
+    def __init__(self, member_id: int, rate_limits: int = 1):
+        self.id = member_id
+        self.guild = SimpleNamespace(id=1)
+        self.roles = []
+        self.rate_limits = rate_limits
+        self.calls = 0
+    
+    async def add_roles(self, role, reason=None):
+        self.calls += 1
+        if self.rate_limits:
+            self.rate_limits -= 1
+            raise discord.HTTPException(SimpleNamespace(status=429, reason='Too Many Requests'), 'rate limited')
+        self.roles.append(role)
+
+
+def test_rate_limited_edits_are_retried_and_coalesced():
+    async def scenario():
+        queue = bot.RoleAssignmentQueue(rate=100, burst=10)
+        member = RateLimitedMember(10)
+        other = RateLimitedMember(11, rate_limits=0)
+        first, second = discord.Object(1), discord.Object(2)
+        
+        # Два изменения одного участника склеиваются в одну запись очереди
+        futures = [queue.submit(member, first), queue.submit(member, second), queue.submit(other, first)]
+        depth = (queue.depth(), queue.depth(1), queue.coalesced)
+        
+        results = await asyncio.gather(*futures)
+        return queue, member, other, depth, results
+    
+    queue, member, other, depth, results = asyncio.run(scenario())
+    
+    assert depth == (2, 2, 1)
+    assert results == [True, True, True]
+    assert [role.id for role in member.roles] == [1, 2]
+    assert member.calls == 3
+    assert queue.retried == 1
+    assert queue.applied == 3
+    assert queue.failed == 0
+    assert queue.depth() == 0
+
+
+def test_forbidden_is_not_retried():
+    class ForbiddenMember(RateLimitedMember):
+        async def add_roles(self, role, reason=None):
+            self.calls += 1
+            raise discord.Forbidden(SimpleNamespace(status=403, reason='Forbidden'), 'missing permissions')
+    
+    async def scenario():
+        queue = bot.RoleAssignmentQueue(rate=100, burst=10)
+        member = ForbiddenMember(10)
+        results = await asyncio.gather(queue.submit(member, discord.Object(1)), return_exceptions=True)
+        return queue, member, results
+    
+    queue, member, results = asyncio.run(scenario())
+    
+    assert isinstance(results[0], discord.Forbidden)
+    assert member.calls == 1
+    assert (queue.retried, queue.failed, queue.depth()) == (0, 1, 0)
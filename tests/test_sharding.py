@@ -0,0 +1,46 @@
+import asyncio
+
+import bot
+
+# Серверы из шарда 0 и шарда 1 при двух шардах: shard_id = (guild_id >> 22) % 2
+SHARD_0_GUILD = 2 << 22
+SHARD_1_GUILD = 3 << 22
+
+
+def test_startup_loads_only_rows_of_own_shards(monkeypatch):
+    """Процесс с SHARD_IDS=1 из двух не поднимает ссылки, баны и удаления серверов шарда 0"""
+    monkeypatch.setattr(bot, 'SHARD_COUNT', 2)
+    monkeypatch.setattr(bot, 'SHARD_IDS', [1])
+    
+    async def scenario():
+        for guild_id in (SHARD_0_GUILD, SHARD_1_GUILD):
+            await bot.db.execute(
+                "INSERT INTO role_links (server_id, role_id, role_name, link_code) VALUES (?, 1, 'роль', ?)",
+                (guild_id, f'shard-{guild_id}')
+            )
+            await bot.db.execute(
+                "INSERT INTO moderation_actions (server_id, user_id, user_name) VALUES (?, 1, 'user')", (guild_id,)
+            )
+            await bot.db.execute(
+                'INSERT INTO pending_deletions (channel_id, message_id, delete_at, server_id) VALUES (1, ?, 0, ?)',
+                (guild_id, guild_id)
+            )
+        
+        links = bot.RoleLinkSystem()
+        await links.load_index()
+        queue = bot.ModerationQueue(workers=0)
+        await queue.start()
+        cleanup = bot.MessageCleanupScheduler()
+        await cleanup.start()
+        cleanup._task.cancel()
+        return links, queue, cleanup
+    
+    links, queue, cleanup = asyncio.run(scenario())
+    
+    assert {entry.server_id for entry in links.index.values()} == {SHARD_1_GUILD}
+    assert {action.server_id for action in queue.pending.values()} == {SHARD_1_GUILD}
+    assert [message_id for _, _, message_id in cleanup.heap] == [SHARD_1_GUILD]
+
+
+def test_single_process_has_no_shard_filter():
+    assert bot.shard_filter() == ""
@@ -0,0 +1,93 @@
+import asyncio
+import time
+
+import bot
+
+GUILDS = 20
+MEMBERS = 1000
+# Задержка ответа шлюза на один запрос участников
+CHUNK_DELAY = 0.02
+
+
+def member_payload(user_id: int) -> dict:
+    return {
+        'user': {'id': str(user_id), 'username': f'user{user_id}', 'discriminator': '0', 'avatar': None},
+        'roles': [], 'joined_at': '2024-01-01T00:00:00+00:00', 'deaf': False, 'mute': False, 'flags': 0,
+    }
+
+
+def guild_payload(guild_id: int) -> dict:
+    return {
+        'id': str(guild_id), 'name': f'guild{guild_id}', 'member_count': MEMBERS, 'large': True,
+        'unavailable': False, 'channels': [], 'roles': [], 'members': [], 'threads': [],
+        'stage_instances': [], 'guild_scheduled_events': [], 'soundboard_sounds': [],
+    }
+
+
+class FakeGateway:
+    """Шлюз-заглушка: запросы участников обрабатываются по одному, как при лимите запросов шлюза"""
+    def __init__(self, state):
+        self.state = state
+        self.lock = asyncio.Lock()
+        self.requests = 0
+
+    async def request_chunks(self, guild_id, query='', limit=0, presences=False, nonce=None, user_ids=None):
+        self.requests += 1
+        asyncio.create_task(self._answer(guild_id, nonce))
+
+    async def _answer(self, guild_id, nonce):
+        async with self.lock:
+            await asyncio.sleep(CHUNK_DELAY)
+            self.state.parse_guild_members_chunk({
+                'guild_id': str(guild_id), 'nonce': nonce, 'chunk_index': 0, 'chunk_count': 1,
+                'members': [member_payload(guild_id * 10000 + i) for i in range(MEMBERS)],
+            })
+
+
+def run_startup(monkeypatch, chunk_at_startup: bool):
+    """READY и GUILD_CREATE всех серверов через заглушку шлюза; возвращает время до готовности"""
+    state = bot.bot._connection
+
+    async def scenario():
+        gateway = FakeGateway(state)
+        monkeypatch.setattr(state, '_chunk_guilds', chunk_at_startup)
+        monkeypatch.setattr(state, 'loop', asyncio.get_running_loop())
+        monkeypatch.setattr(state, 'shard_count', 1)
+        monkeypatch.setattr(state, 'shard_ids', [0])
+        monkeypatch.setattr(state, 'guild_ready_timeout', 0.05)
+        monkeypatch.setattr(state, '_get_websocket', lambda *args, **kwargs: gateway)
+        # Обработчики событий бота здесь не нужны - меряем только сам старт
+        monkeypatch.setattr(state, 'dispatch', lambda *args, **kwargs: None)
+        monkeypatch.setattr(bot.bot, '_ready', asyncio.Event())
+
+        started = time.perf_counter()
+        state.parse_ready({
+            'user': {'id': '1', 'username': 'bot', 'discriminator': '0', 'avatar': None, 'bot': True},
+            'guilds': [{'id': str(guild_id), 'unavailable': True} for guild_id in range(1, GUILDS + 1)],
+            'shard': [0, 1], 'session_id': 'session',
+        })
+        for guild_id in range(1, GUILDS + 1):
+            state.parse_guild_create(guild_payload(guild_id))
+        await asyncio.wait_for(bot.bot._ready.wait(), 30)
+        elapsed = time.perf_counter() - started
+
+        members = sum(len(guild.members) for guild in bot.bot.guilds)
+        return elapsed, members, gateway.requests
+
+    return asyncio.run(scenario())
+
+
+def test_startup_without_chunking_is_ready_before_member_lists(monkeypatch):
+    """Без CHUNK_AT_STARTUP бот готов сразу после GUILD_CREATE, не дожидаясь списков участников"""
+    # По умолчанию бот стартует без загрузки участников
+    assert bot.bot._connection._chunk_guilds is False
+    eager, eager_members, eager_requests = run_startup(monkeypatch, True)
+    lazy, lazy_members, lazy_requests = run_startup(monkeypatch, False)
+    print(f"\nстарт {GUILDS} серверов по {MEMBERS} участников: с загрузкой участников {eager * 1000:.0f} мс "
+          f"({eager_requests} запросов), без неё {lazy * 1000:.0f} мс")
+
+    assert (eager_members, eager_requests) == (GUILDS * MEMBERS, GUILDS)
+    assert (lazy_members, lazy_requests) == (0, 0)
+    # Запросы участников идут последовательно, так что загрузка не быстрее GUILDS * CHUNK_DELAY
+    assert eager >= GUILDS * CHUNK_DELAY
+    assert lazy < eager / 2
@@ -0,0 +1,62 @@
+import asyncio
+import random
+import time
+
+import bot
+
+RESOURCES = 10_000
+SERVER_ID = 20
+
+
+def test_aggregate_matches_rebuild_after_mixed_writes():
+    """10k ресурсов: агрегаты после добавлений, изменений и удалений совпадают с пересчетом с нуля"""
+    rng = random.Random(7)
+    
+    async def scenario():
+        storage = bot.storage_system
+        await bot.db.executemany(
+            'INSERT INTO storage (server_id, resource_name, resource_amount) VALUES (?, ?, ?)',
+            [(SERVER_ID, f'ресурс-{i:05d}', rng.randint(0, 10_000)) for i in range(RESOURCES)]
+        )
+        aggregate = await storage.get_aggregate(SERVER_ID)
+        
+        for i in range(300):
+            name = f'ресурс-{rng.randrange(RESOURCES + 100):05d}'
+            action = rng.choice(('add', 'update', 'delete'))
+            if action == 'add':
+                await storage.add_resource(SERVER_ID, name, rng.randint(0, 20_000), '', 1, 'админ')
+            elif action == 'update':
+                await storage.update_resource_amount(SERVER_ID, name, rng.randint(0, 20_000), 1, 'админ')
+            else:
+                await storage.delete_resource(SERVER_ID, name)
+        
+        rows = await bot.db.fetchall(
+            'SELECT resource_name, resource_amount FROM storage WHERE server_id = ?', (SERVER_ID,)
+        )
+        return aggregate, await storage.get_aggregate(SERVER_ID), bot.StorageAggregate(rows), rows
+    
+    aggregate, current, rebuilt, rows = asyncio.run(scenario())
+    
+    # Поддерживаемый объект не пересоздавался - проверяем именно инкрементальные обновления
+    assert current is aggregate
+    assert (aggregate.total, aggregate.count) == (rebuilt.total, rebuilt.count)
+    assert aggregate.top(3) == rebuilt.top(3)
+    assert aggregate.bottom(3) == rebuilt.bottom(3)
+    
+    # Прежний способ на каждое нажатие: sum и две полные сортировки
+    renders = 200
+    started = time.perf_counter()
+    for _ in range(renders):
+        total = sum(amount for _, amount in rows)
+        top = sorted(rows, key=lambda row: row[1], reverse=True)[:3]
+        bottom = sorted(rows, key=lambda row: row[1])[:3]
+    recomputed = (time.perf_counter() - started) / renders
+    
+    started = time.perf_counter()
+    for _ in range(renders):
+        total, top, bottom = aggregate.total, aggregate.top(3), aggregate.bottom(3)
+    maintained = (time.perf_counter() - started) / renders
+    
+    print(f"\nСтатистика склада из {RESOURCES} ресурсов: пересчет {recomputed * 1e6:.0f} мкс, "
+          f"агрегаты {maintained * 1e6:.1f} мкс на отрисовку")
+    assert maintained * 100 < recomputed
@@ -0,0 +1,61 @@
+import asyncio
+import time
+
+from aiohttp.test_utils import TestClient, TestServer
+
+import bot
+
+REQUESTS = 500
+CONCURRENCY = 20
+
+
+def test_healthz_under_load_while_processing_events():
+    """Нагрузка на /healthz в том же цикле событий, где бот обрабатывает погашения кодов"""
+    async def scenario():
+        system = bot.role_link_system
+        code = await system.create_role_link(30, 2, 'роль', 3, 'админ')
+        stop = asyncio.Event()
+        processed = 0
+        
+        async def gateway_events():
+            nonlocal processed
+            while not stop.is_set():
+                await system.use_role_link(code, 30)
+                await system.get_active_links(30)
+                processed += 1
+        
+        latencies = []
+        statuses = []
+        
+        server = TestServer(bot.create_web_app())
+        # Как и в start_web_server - без access-лога на каждый запрос
+        await server.start_server(access_log=None)
+        async with TestClient(server) as client:
+            async def worker(count: int):
+                for _ in range(count):
+                    started = time.perf_counter()
+                    async with client.get('/healthz') as response:
+                        body = await response.json()
+                        statuses.append((response.status, body["database"]["reachable"]))
+                    latencies.append(time.perf_counter() - started)
+            
+            events = asyncio.create_task(gateway_events())
+            started = time.perf_counter()
+            await asyncio.gather(*(worker(REQUESTS // CONCURRENCY) for _ in range(CONCURRENCY)))
+            elapsed = time.perf_counter() - started
+            stop.set()
+            await events
+        
+        return latencies, statuses, elapsed, processed
+    
+    latencies, statuses, elapsed, processed = asyncio.run(scenario())
+    latencies.sort()
+    p99 = latencies[int(len(latencies) * 0.99) - 1]
+    print(f"\n/healthz: {REQUESTS / elapsed:.0f} запросов/с, p99 {p99 * 1000:.1f} мс; "
+          f"событий обработано параллельно: {processed}")
+    
+    assert len(statuses) == REQUESTS
+    # Шлюз в тесте не подключен - статус 503 "degraded", но база отвечает
+    assert set(statuses) == {(503, True)}
+    assert processed > 0
+    assert p99 < 1.0